@@ -1,32 +1,407 @@
 # app.py - final backend: register/login/verify/admin/profiles with lockout
-from flask import Flask, request, jsonify
+#
+# create_app() builds the Flask app without touching the database or loading NumPy; the scorer and
+# the schema check wait for prepare(), which runs once, on the first request or /readyz. Schema
+# changes are applied by `python app.py migrate` (or by that first request when DB_MIGRATE=auto).
+from time import perf_counter, time
+_started = perf_counter()
+
+import os, io, sys, json, threading
+from collections import Counter
+from functools import partial, wraps
+from random import random
+from flask import Blueprint, Flask, Response, request, jsonify, g, has_request_context, redirect, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-import os, json, numpy as np
-from time import time
-import psycopg2
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
+from db_pool import ConnectionPool, PoolExhausted
+from verify_sql import VERIFY_FUNCTIONS_SQL, verify_single_trip
+from history_queue import HistoryWriter
+from export_stream import EXPORT_FORMATS, stream_query
+from partitions import HistoryPartitions, LOCK_KEY as HISTORY_LOCK_KEY
+from rollups import RESOLUTIONS, install as install_rollups, prune as prune_rollups, fetch_analytics
+from telemetry import TELEMETRY_CONTENT_TYPE, TelemetryFormatError, decode_telemetry, unpack_fields
+from workers import WorkerLane, WorkerBusy
+from ratelimit import LoginGuard
+from storage import POSTGRES_VERSION_SQL, POSTGRES_HISTORY_VERSION_SQL, StoreBusy, storage_from_url
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics, SamplingProfiler
+from response_cache import ResponseCache
+import bulk_import
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# Storage backend: STORAGE=postgres (DATABASE_URL), STORAGE=sqlite:<path>, an embedded
+# single-file database on this machine (see storage.py), or STORAGE=sharded, users spread over
+# the SHARDS stores (see sharding.py). Only STORAGE=postgres has DATABASE_URL's pool, and with
+# it the features that use that pool directly.
+STORAGE = os.getenv("STORAGE", "postgres")
+EMBEDDED = STORAGE != "postgres"
+SHARDED = STORAGE == "sharded"
 
 # Database configuration
 DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is not set. Please check your .env file.")
 
 ADMIN_SECRET = "ADMIN123"
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+# VERIFY_SINGLE_TRIP=1 runs /verify as one call to the authguard_verify() stored function
+VERIFY_SINGLE_TRIP = os.getenv("VERIFY_SINGLE_TRIP", "0") == "1"
+
+# SCORER=ema scores perc_dev against the stored means; SCORER=baseline scores against each
+# user's variance and quantile sketch in users.baseline (see baseline.py)
+SCORER = os.getenv("SCORER", "ema")
+
+# PROXY_HOPS=n trusts the last n X-Forwarded-For entries, so request.remote_addr (the login
+# guard's IP bucket) is the client rather than the reverse proxy in front of the app
+PROXY_HOPS = int(os.getenv("PROXY_HOPS", "0"))
+
+# payloads with fewer raw path points than this cost less to parse than to send to a worker
+WORKER_SCORE_MIN_POINTS = int(os.getenv("WORKER_SCORE_MIN_POINTS", "200"))
+
+# /analytics rollups: minute buckets are pruned after ROLLUP_MINUTE_DAYS, hour buckets are kept
+ROLLUP_MINUTE_DAYS = int(os.getenv("ROLLUP_MINUTE_DAYS", "14"))
+
+# DB_MIGRATE=auto lets the first request run init_db() on a database older than SCHEMA_VERSION;
+# DB_MIGRATE=check only reports it (503) and leaves the upgrade to `python app.py migrate`
+DB_MIGRATE = os.getenv("DB_MIGRATE", "auto")
+if DB_MIGRATE not in ("auto", "check"):
+    raise ValueError("DB_MIGRATE must be auto or check")
+# Bump whenever init_db() changes the schema
+SCHEMA_VERSION = 4
+
+bp = Blueprint("authguard", __name__)
+
+# Set up by create_app(); scoring, baseline (the NumPy-backed modules) and scorer by load_scoring()
+_app = None
+auth_lane = score_lane = import_lane = pool = store = None
+profile_cache = history_writer = history_partitions = login_guard = similarity_index = response_cache = None
+metrics = profiler = None
+# STORAGE=sharded: the pool and partition upkeep of each Postgres shard, by shard name
+shard_pools = {}
+shard_partitions = {}
+scoring = baseline = scorer = None
+
+# Cold-start timings (ms), reported by /readyz and /stats; prepare_ms includes scoring_ms and schema_ms
+startup = {"import_ms": None, "create_app_ms": None, "prepare_ms": None, "scoring_ms": None, "schema_ms": None}
+
+def elapsed_ms(since):
+    return round((perf_counter() - since) * 1000, 1)
+
+def create_app():
+    """The Flask app for this process, built on the first call. Opens no database connection."""
+    global _app, auth_lane, score_lane, import_lane, pool, store, profile_cache, history_writer, history_partitions, login_guard
+    global similarity_index, response_cache, metrics, profiler
+    if _app is not None:
+        return _app
+    started = perf_counter()
+
+    if not DATABASE_URL and not EMBEDDED:
+        raise ValueError("DATABASE_URL environment variable is not set. Please check your .env file.")
+    if VERIFY_SINGLE_TRIP and SCORER != "ema":
+        raise ValueError("VERIFY_SINGLE_TRIP=1 needs SCORER=ema: authguard_verify() only scores against the EMA means")
+    if EMBEDDED:
+        # the embedded store is already local; these all exist to save Postgres round trips
+        for name, default in (("VERIFY_SINGLE_TRIP", "0"), ("PROFILE_CACHE_SIZE", "0"), ("HISTORY_ASYNC", "0")):
+            if os.getenv(name, default) != default:
+                raise ValueError("%s needs STORAGE=postgres" % name)
+
+    # Process-pool lanes for password hashing (auth: register/login) and payload parsing (score:
+    # /verify), sized via WORKER_AUTH_PROCESSES / WORKER_SCORE_PROCESSES; 0, the default, runs the
+    # work on the request thread (see workers.py). Started before the connection pool so the workers
+    # fork from a process with no sockets or threads yet.
+    auth_lane = WorkerLane.from_env("auth", "WORKER_AUTH_PROCESSES").start()
+    score_lane = WorkerLane.from_env("score", "WORKER_SCORE_PROCESSES").start()
+    # POST /admin/import hashes on its own lane (WORKER_IMPORT_PROCESSES), away from logins
+    import_lane = WorkerLane.from_env("import", "WORKER_IMPORT_PROCESSES").start()
+
+    # Connection pool (sized via DB_POOL_MIN / DB_POOL_MAX, see db_pool.py); filled by prepare()
+    pool = None if EMBEDDED else ConnectionPool.from_env(DATABASE_URL, cursor_factory=RealDictCursor)
+    if SHARDED:
+        from sharding import ShardedStore
+        store = ShardedStore.from_env(shard_connector)
+    else:
+        store = storage_from_url(STORAGE, get_db_connection)
+
+    # Write-behind profile cache for /verify, enabled with PROFILE_CACHE_SIZE > 0 (see profile_cache.py)
+    if int(os.getenv("PROFILE_CACHE_SIZE", "0")) > 0:
+        from profile_cache import ProfileCache  # imports scoring, and with it NumPy
+        profile_cache = ProfileCache.from_env(pool)
+        profile_cache.start()
+
+    # Background user_history writer for /verify, enabled with HISTORY_ASYNC=1 (see history_queue.py)
+    if os.getenv("HISTORY_ASYNC", "0") == "1":
+        history_writer = HistoryWriter.from_env(pool)
+        history_writer.start()
+
+    # user_history partition layout and retention (HISTORY_PARTITION, HISTORY_RETENTION_DAYS, see
+    # partitions.py); maintenance starts once ensure_schema() has seen a partitioned table
+    if not EMBEDDED:
+        history_partitions = HistoryPartitions.from_env(pool)
+        history_partitions.hooks.append(lambda cursor, now_ms: prune_rollups(cursor, ROLLUP_MINUTE_DAYS, now_ms))
+
+    # /login throttling and rejected-login caches, enabled with LOGIN_GUARD=1 (see ratelimit.py)
+    if os.getenv("LOGIN_GUARD", "0") == "1":
+        login_guard = LoginGuard.from_env()
+
+    # Nearest-neighbour index over profiles behind /admin/users/<username>/similar and
+    # /admin/clusters, enabled with SIMILARITY_INDEX=1; prepare() starts its background builds (see similarity.py)
+    if os.getenv("SIMILARITY_INDEX", "0") == "1":
+        from similarity import SimilarityIndex  # NumPy
+        similarity_index = SimilarityIndex.from_env()
+
+    # Rendered /profiles and /admin responses, reused until the users data changes; enabled with
+    # RESPONSE_CACHE_SIZE > 0 (see response_cache.py)
+    if int(os.getenv("RESPONSE_CACHE_SIZE", "0")) > 0:
+        response_cache = ResponseCache.from_env()
+
+    # Per-stage timings and /verify outcome counts behind /metrics (METRICS=0 turns them off), and
+    # the sampling profiler behind /metrics/profile, off unless METRICS_PROFILE_HZ > 0 (see metrics.py)
+    metrics = Metrics.from_env()
+    profiler = SamplingProfiler.from_env().start()
+
+    app = Flask(__name__)
+    if PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+    CORS(app, expose_headers=["X-Next-Cursor", "Accept-Post", "ETag", "X-Change-Version"])
+    app.register_blueprint(bp)
+    startup["create_app_ms"] = elapsed_ms(started)
+    _app = app
+    return app
+
+_scoring_lock = threading.Lock()
+
+def load_scoring():
+    """Import NumPy and the scorers and build SCORER's scorer; later calls return it."""
+    global scoring, baseline, scorer
+    with _scoring_lock:
+        if scorer is None:
+            started = perf_counter()
+            import scoring, baseline
+            scorer = baseline.scorer_from_name(SCORER)
+            startup["scoring_ms"] = elapsed_ms(started)
+    return scorer
+
+class SchemaOutdated(Exception):
+    """The database predates SCHEMA_VERSION and DB_MIGRATE=check leaves it alone."""
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def ensure_schema():
+    # One version read per process; init_db() only runs when the database is behind
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        started = perf_counter()
+        with store.transaction(readonly=True) as tx:
+            version = tx.schema_version()
+            partitioned = history_partitions.is_partitioned(tx.cursor) if history_partitions else False
+        if version < SCHEMA_VERSION:
+            if DB_MIGRATE == "check":
+                raise SchemaOutdated("database schema is at version %d, this code needs %d; run `python app.py migrate`"
+                                     % (version, SCHEMA_VERSION))
+            _app.logger.info("migrating database schema from version %d to %d", version, SCHEMA_VERSION)
+            partitioned = init_db()
+        elif history_partitions and not partitioned:
+            _app.logger.warning("user_history is not partitioned; run `python partitions.py migrate`")
+            with store.transaction() as tx:
+                prune_rollups(tx.cursor, ROLLUP_MINUTE_DAYS, int(time()*1000))
+        # Postgres partitions are kept up by a background thread; its first pass runs right away
+        if partitioned:
+            history_partitions.start(delay=0)
+        for partitions in shard_partitions.values():
+            partitions.start(delay=0)
+        startup["schema_ms"] = elapsed_ms(started)
+        _schema_ready = True
+
+_prepared = False
+
+def prepare():
+    """Everything create_app() defers: the scorer, the schema check and the pool's idle connections."""
+    global _prepared
+    if _prepared:
+        return
+    started = perf_counter()
+    create_app()
+    load_scoring()
+    ensure_schema()
+    if pool:
+        pool.fill()
+    for shard_pool in shard_pools.values():
+        shard_pool.fill()
+    if similarity_index:
+        similarity_index.start(load_profiles)
+    startup["prepare_ms"] = elapsed_ms(started)
+    _prepared = True
+
+@bp.before_app_request
+def prepare_app():
+    # the probes answer on their own; every other endpoint needs the scorer and the schema
+    if not _prepared and request.endpoint not in ("authguard.healthz", "authguard.readyz"):
+        prepare()
+    if profiler.enabled:
+        profiler.enter()
+
+def get_db_connection(from_pool=None):
+    conn = (from_pool or pool).getconn()
+    if has_request_context():
+        # remembered so teardown can release it if the handler bails out early
+        g.setdefault("db_conns", []).append(conn)
+    return conn
+
+def shard_connector(name, dsn):
+    # a Postgres shard of STORAGE=sharded gets a pool (DB_POOL_* apply to each) and its own
+    # user_history partition upkeep
+    shard_pool = shard_pools[name] = ConnectionPool.from_env(dsn, cursor_factory=RealDictCursor)
+    shard_partitions[name] = HistoryPartitions.from_env(shard_pool)
+    shard_partitions[name].hooks.append(lambda cursor, now_ms: prune_rollups(cursor, ROLLUP_MINUTE_DAYS, now_ms))
+    return partial(get_db_connection, shard_pool)
+
+def owner_redirect(username):
+    # With SHARD_NODES set, a user's requests are served by the node owning their shard
+    node = store.node_for(username) if SHARDED and isinstance(username, str) else None
+    if node is None:
+        return None
+    return redirect(node + request.full_path.rstrip("?"), code=307)
+
+def user_created(username):
+    # a new users row invalidates a cached "user not found" for /login
+    if login_guard:
+        login_guard.user_created(username)
+
+def profile_changed(username, profile):
+    # called after commit with every profile /verify, /verify/batch or /register wrote
+    if similarity_index:
+        similarity_index.update(username, profile)
+
+def load_profiles():
+    # every users row, for a similarity index rebuild; pending cache writes go first
+    if profile_cache:
+        profile_cache.flush()
+    with store.transaction(readonly=True) as tx:
+        return tx.profiles()
+
+def save_history(tx, rows):
+    # With the async writer on, the caller's transaction is committed first (the rows may reference
+    # a users row inserted in it) and the rows are queued; a queue that stays full falls back to an
+    # inline INSERT, which is what pushes back on request threads.
+    if history_writer:
+        tx.commit()
+        for i, row in enumerate(rows):
+            if not history_writer.submit(row):
+                tx.append_history(rows[i:])
+                return
+        return
+    tx.append_history(rows)
+
+@bp.teardown_app_request
+def release_db_connections(exc):
+    # close() is a no-op for connections the handler already released; anything still
+    # checked out (e.g. after an exception) is rolled back and returned to the pool
+    for conn in g.pop("db_conns", []):
+        conn.close()
+    if profiler.enabled:
+        profiler.leave()
+
+@bp.app_errorhandler(PoolExhausted)
+def pool_exhausted(err):
+    return jsonify({"error":"database busy, retry shortly"}), 503
+
+@bp.app_errorhandler(StoreBusy)
+def store_busy(err):
+    return jsonify({"error":"database busy, retry shortly"}), 503
+
+@bp.app_errorhandler(SchemaOutdated)
+def schema_outdated(err):
+    return jsonify({"error":str(err)}), 503
+
+@bp.app_errorhandler(WorkerBusy)
+def workers_busy(err):
+    return jsonify({"error":"server busy, retry shortly"}), 503
+
+@bp.app_errorhandler(TelemetryFormatError)
+def bad_telemetry(err):
+    return jsonify({"error":"bad telemetry: %s" % err}), 400
+
+def telemetry_payload():
+    # Content-Type application/vnd.authguard.telemetry carries a binary frame (telemetry.py);
+    # JSON bodies may carry the same frame base64-encoded in a "packed" field
+    if request.mimetype == TELEMETRY_CONTENT_TYPE:
+        return decode_telemetry(request.get_data(cache=False))
+    return unpack_fields(request.json or {})
+
+def parse_features(items):
+    # parse_payload for each item, split across the score lane's workers when the payloads carry
+    # enough raw path points to be worth shipping there
+    if not score_lane.enabled or sum(map(scoring.raw_path_points, items)) < WORKER_SCORE_MIN_POINTS:
+        return scoring.parse_payloads(items)
+    size = -(-len(items) // score_lane.processes)
+    futures = [score_lane.submit(scoring.parse_payloads, items[i:i + size]) for i in range(0, len(items), size)]
+    return [feat for future in futures for feat in score_lane.result(future)]
+
+def postgres_only(view):
+    # exports and /analytics read Postgres-side machinery (server-side cursors, rollup triggers)
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if EMBEDDED:
+            return jsonify({"error":"not available with STORAGE=%s" % STORAGE}), 501
+        return view(*args, **kwargs)
+    return wrapper
+
+def similarity_required(view):
+    # the /admin similarity routes, while the index is off or has not finished its first build
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not similarity_index:
+            return jsonify({"error":"similarity index disabled; set SIMILARITY_INDEX=1"}), 501
+        if not similarity_index.ready:
+            return jsonify({"error":"similarity index is still building, retry shortly"}), 503
+        return view(*args, **kwargs)
+    return wrapper
+
+def timed(endpoint):
+    # The view's StageTimer is g.timer (see metrics.py); the request histogram gets the time to
+    # the view's return, whichever return that is. Requests that raise are not recorded.
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            timer = g.timer = metrics.timer(endpoint)
+            response = view(*args, **kwargs)
+            timer.done()
+            return response
+        return wrapper
+    return decorate
 
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Creates or upgrades the schema to SCHEMA_VERSION; safe to repeat. Returns whether
+    # user_history is partitioned (in DATABASE_URL; shards keep up their own partitions).
+    if SHARDED:
+        for name, shard in store.shards.items():
+            if shard.name == "sqlite":
+                shard.init()
+            else:
+                init_postgres(shard, shard_partitions[name])
+        with store.transaction() as tx:
+            tx.set_schema_version(SCHEMA_VERSION)
+        return False
+    if EMBEDDED:
+        store.init()
+        with store.transaction() as tx:
+            tx.set_schema_version(SCHEMA_VERSION)
+        return False
+    return init_postgres(store, history_partitions)
+
+def init_postgres(pg_store, partitions):
+    # init_db() for one Postgres database: DATABASE_URL's, or a shard's
+    tx = pg_store.transaction()
+    cursor = tx.cursor
+
+    # App processes starting together would otherwise race on CREATE OR REPLACE FUNCTION and
+    # the first rollup backfill; the schema is set up in this one transaction
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (HISTORY_LOCK_KEY,))
 
     # Create users table
     cursor.execute('''
@@ -43,61 +418,79 @@ def init_db():
             fraud INTEGER DEFAULT 0,
             status VARCHAR(50) DEFAULT 'Registered',
             last_update BIGINT DEFAULT 0,
-            locked_until BIGINT DEFAULT 0
+            locked_until BIGINT DEFAULT 0,
+            baseline BYTEA
         )
     ''')
+    # SCORER=baseline state (baseline.py); NULL until a user's first session scored with it
+    cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS baseline BYTEA")
+    # users.version, stamped by a trigger, behind ETags and ?changed_since= (see conditional())
+    cursor.execute(POSTGRES_VERSION_SQL)
+
+    # Create history table, partitioned by ts (see partitions.py); a plain table from an older
+    # install keeps working until it is converted with `python partitions.py migrate`
+    partitioned = partitions.is_partitioned(cursor)
+    if partitioned is None:
+        partitions.create(cursor)
+        partitioned = True
+    elif not partitioned:
+        _app.logger.warning("user_history is not partitioned; run `python partitions.py migrate`")
 
-    # Create history table
+    # Per-user history reads (admin pages, exports) walk this index newest-first
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_history (
-            id SERIAL PRIMARY KEY,
-            username VARCHAR(255) REFERENCES users(username),
-            ts BIGINT NOT NULL,
-            flight REAL,
-            dwell REAL,
-            mouse_speed REAL,
-            mouse_metrics JSONB,
-            touch_speed REAL,
-            touch_metrics JSONB,
-            click_positions JSONB,
-            scrolls INTEGER,
-            scroll_speed REAL,
-            scroll_speeds JSONB,
-            clicks INTEGER,
-            fraud INTEGER,
-            status VARCHAR(50)
-        )
+        CREATE INDEX IF NOT EXISTS user_history_username_ts_idx
+        ON user_history (username, ts DESC)
     ''')
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+    # history written apart from its users row moves the ETag too (see storage.py)
+    cursor.execute(POSTGRES_HISTORY_VERSION_SQL)
 
-# Initialize database on startup
-init_db()
+    # Stored functions backing VERIFY_SINGLE_TRIP (see verify_sql.py)
+    cursor.execute(VERIFY_FUNCTIONS_SQL)
 
-def safe_mean(arr):
-    try:
-        return float(np.mean(arr)) if arr and len(arr) else 0.0
-    except:
-        return 0.0
+    # Per-minute/hour aggregates and click grids kept up by a user_history trigger (see
+    # rollups.py); backfilled from existing history the first time
+    if install_rollups(cursor):
+        _app.logger.info("built /analytics rollups from existing user_history")
+
+    # This period's partition and the next HISTORY_PARTITION_PREMAKE, minus expired ones
+    if partitioned:
+        partitions.maintain(cursor)
+    else:
+        prune_rollups(cursor, ROLLUP_MINUTE_DAYS, int(time()*1000))
+
+    tx.set_schema_version(SCHEMA_VERSION)
+    tx.commit()
+    tx.close()
+    return partitioned
 
-@app.route("/register", methods=["POST"])
+_empty_password_hash = None
+
+def empty_password_hash():
+    # verify() auto-creates unknown users with an empty password; hash it once per process
+    global _empty_password_hash
+    if _empty_password_hash is None:
+        _empty_password_hash = generate_password_hash("")
+    return _empty_password_hash
+
+@bp.route("/register", methods=["POST"])
 def register():
     d = request.json or {}
     username = d.get("username")
     password = d.get("password")
     if not username or not password:
         return jsonify({"error":"username and password required"}), 400
+    moved = owner_redirect(username)
+    if moved:
+        return moved
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # hashed before the transaction: the embedded store holds its write lock until commit
+    password_hash = auth_lane.run(generate_password_hash, password)
+    tx = store.transaction()
 
     # Check if user exists
-    cursor.execute("SELECT username FROM users WHERE username = %s", (username,))
-    if cursor.fetchone():
-        cursor.close()
-        conn.close()
+    if tx.user_exists(username):
+        tx.close()
         return jsonify({"error":"user already exists"}), 400
 
     flight = d.get("flight", [])
@@ -108,8 +501,8 @@ def register():
     touch_interactions = d.get("touch_interactions", 0)
 
     profile = {
-        "flight_mean": round(safe_mean(flight), 2),
-        "dwell_mean": round(safe_mean(dwell), 2),
+        "flight_mean": round(scoring.safe_mean(flight), 2),
+        "dwell_mean": round(scoring.safe_mean(dwell), 2),
         "mouse_mean": round(float(mouse_speed), 2),
         "scroll_mean": int(scrolls),
         "scroll_speed": round(float(scroll_speed), 2),
@@ -117,372 +510,664 @@ def register():
     }
 
     # Insert user
-    cursor.execute('''
-        INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
-                          scroll_mean, scroll_speed, touch_mean, status, last_update)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (
-        username,
-        generate_password_hash(password),
-        'customer',
-        profile["flight_mean"],
-        profile["dwell_mean"],
-        profile["mouse_mean"],
-        profile["scroll_mean"],
-        profile["scroll_speed"],
-        profile["touch_mean"],
-        'Registered',
-        int(time()*1000)
-    ))
+    tx.insert_users([dict(profile, username=username, password_hash=password_hash,
+                          role='customer', status='Registered', last_update=int(time()*1000))])
 
-    # Insert initial history entry
-    cursor.execute('''
-        INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
-                                touch_metrics, click_positions, scrolls, scroll_speed, clicks, fraud, status)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (
+    # Insert initial history entry (no touch_speed or scroll_speeds yet)
+    tx.append_history([(
         username,
         int(time()*1000),
         profile["flight_mean"],
         profile["dwell_mean"],
         profile["mouse_mean"],
         json.dumps({}),
+        None,
         json.dumps({}),
         json.dumps([]),
         profile["scroll_mean"],
         profile["scroll_speed"],
+        None,
         0,
         0,
         'Registered'
-    ))
+    )])
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+    tx.commit()
+    tx.close()
+    user_created(username)
+    profile_changed(username, profile)
 
     return jsonify({"status":"registered","profile":profile})
 
-@app.route("/login", methods=["POST"])
+@bp.route("/login", methods=["POST"])
+@timed("login")
 def login():
+    timer = g.timer
     d = request.json or {}
     username = d.get("username")
     password = d.get("password")
     role = d.get("role", "customer")
     secret = d.get("secret", "")
+    moved = owner_redirect(username)
+    if moved:
+        return moved
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # throttled and known-bad attempts are answered before any DB or password-hash work
+    rejected = login_guard.check(username, request.remote_addr, cached=role != "admin") if login_guard else None
+    timer.mark("guard")
+    if rejected:
+        reason, detail = rejected
+        if reason == "limited":
+            return jsonify({"error":"too many attempts, retry later"}), 429, {"Retry-After": str(int(detail) + 1)}
+        if reason == "missing":
+            return jsonify({"error":"user not found"}), 404
+        return jsonify({"error":"locked","locked_until": detail}), 403
 
     if role == "admin":
         if secret != ADMIN_SECRET:
-            cursor.close()
-            conn.close()
             return jsonify({"error":"invalid admin secret"}), 403
 
         # Check if admin exists, create if not
-        cursor.execute("SELECT username FROM users WHERE username = %s", (username,))
-        if not cursor.fetchone():
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, role, status, last_update)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (username, generate_password_hash(password or ""), 'admin', 'Admin', int(time()*1000)))
+        tx = store.transaction()
+        timer.mark("connect")
+        if not tx.user_exists(username):
+            tx.insert_users([{"username": username, "password_hash": auth_lane.run(generate_password_hash, password or ""),
+                              "role": 'admin', "status": 'Admin', "last_update": int(time()*1000)}])
         else:
-            cursor.execute("UPDATE users SET role = %s WHERE username = %s", ('admin', username))
+            tx.set_role(username, 'admin')
+        timer.mark("update")
 
-        conn.commit()
-        cursor.close()
-        conn.close()
+        tx.commit()
+        tx.close()
+        timer.mark("commit")
+        user_created(username)
         return jsonify({"status":"ok","role":"admin"})
 
     # Regular user login
-    cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    tx = store.transaction(readonly=True)
+    timer.mark("connect")
+    user = tx.get_user(username)
+    tx.close()
+    timer.mark("profile")
 
     if not user:
+        if login_guard:
+            login_guard.user_missing(username)
         return jsonify({"error":"user not found"}), 404
 
     now_ms = int(time()*1000)
     locked_until = user.get("locked_until", 0)
     if locked_until and locked_until > now_ms:
+        if login_guard:
+            login_guard.user_locked(username, locked_until)
         return jsonify({"error":"locked","locked_until": locked_until}), 403
 
-    if not user.get("password_hash") or not check_password_hash(user["password_hash"], password):
+    valid = user.get("password_hash") and auth_lane.run(check_password_hash, user["password_hash"], password)
+    timer.mark("hash")
+    if not valid:
         return jsonify({"error":"invalid credentials"}), 403
 
     return jsonify({"status":"ok","role":user.get("role","customer")})
 
-@app.route("/verify", methods=["POST"])
+# Summary-mode clients (see scoring.parse_payload) are asked to send their raw arrays as well
+# on this fraction of requests, so their summaries can be audited against them
+RAW_AUDIT_RATE = float(os.getenv("RAW_AUDIT_RATE", "0.02"))
+telemetry_counts = Counter()
+telemetry_lock = threading.Lock()
+
+def annotate(body, feat, username):
+    # malformed mouse_path/touch_path are scored as absent; tell the client why
+    if feat["path_errors"]:
+        body["warnings"] = feat["path_errors"]
+    audit = feat["audit"]
+    if audit:
+        _app.logger.warning("summary from %s disagrees with its raw data: %s", username, ", ".join(audit))
+    with telemetry_lock:
+        telemetry_counts[feat["mode"] + "_requests"] += 1
+        if audit is not None:
+            telemetry_counts["audits"] += 1
+            telemetry_counts["audit_mismatches"] += bool(audit)
+    if feat["mode"] == "summary" and random() < RAW_AUDIT_RATE:
+        body["send_raw"] = True
+    metrics.outcome(body["status"])
+    return body
+
+@bp.after_app_request
+def advertise_telemetry(response):
+    # lets script.js switch from JSON to binary frames after its first /verify
+    if request.endpoint == "authguard.verify":
+        response.headers["Accept-Post"] = "application/json, " + TELEMETRY_CONTENT_TYPE
+    return response
+
+@bp.route("/verify", methods=["POST"])
+@timed("verify")
 def verify():
-    d = request.json or {}
+    timer = g.timer
+    d = telemetry_payload()
     username = d.get("username", "default_user")
     initial = d.get("initial", False)
     ts = int(d.get("ts", time()*1000))
+    timer.mark("decode")
+    moved = owner_redirect(username)
+    if moved:
+        return moved
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    tx = store.transaction()
+    timer.mark("connect")
 
-    # Check lock status
-    cursor.execute("SELECT locked_until, fraud FROM users WHERE username = %s", (username,))
-    user_lock = cursor.fetchone()
-    if user_lock and user_lock["locked_until"] and user_lock["locked_until"] > int(time()*1000):
-        cursor.close()
-        conn.close()
-        return jsonify({"status":"Locked","fraud_score": user_lock["fraud"], "locked_until": user_lock["locked_until"]})
+    # Check lock status (single-trip mode does this inside authguard_verify)
+    if not VERIFY_SINGLE_TRIP:
+        user_lock = tx.lock_state(username)
+        timer.mark("lock")
+        if user_lock and user_lock["locked_until"] and user_lock["locked_until"] > int(time()*1000):
+            tx.close()
+            # answered without scoring, but counted like single-trip mode's locked answers
+            metrics.outcome("Locked")
+            return jsonify({"status":"Locked","fraud_score": user_lock["fraud"], "locked_until": user_lock["locked_until"]})
 
     # Parse incoming data
-    flight = d.get("flight", []) or []
-    dwell = d.get("dwell", []) or []
-    mouse_speed = float(d.get("mouse_speed", 0.0) or 0.0)
-    mouse_path = d.get("mouse_path", []) or []
-    touch_speed = float(d.get("touch_speed", 0.0) or 0.0)
-    touch_path = d.get("touch_path", []) or []
-    click_positions = d.get("click_positions", []) or []
-    clicks = int(d.get("clicks", 0) or 0)
-    scrolls = int(d.get("scrolls", 0) or 0)
-    scroll_speed = float(d.get("scroll_speed", 0.0) or 0.0)
-    incoming_score = int(d.get("fraud_score", 0) or 0)
-
-    f = safe_mean(flight)
-    dw = safe_mean(dwell)
+    feat = parse_features([d])[0]
+    timer.mark("parse")
+
+    if VERIFY_SINGLE_TRIP:
+        body = verify_single_trip(tx.cursor, username, ts, int(time()*1000), empty_password_hash(), feat)
+        timer.mark("single_trip")
+        tx.commit()
+        tx.close()
+        timer.mark("commit")
+        # authguard_verify() may have created the user; it does not say
+        user_created(username)
+        return jsonify(annotate(body, feat, username))
 
     # Get or create user profile
-    cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-    user = cursor.fetchone()
+    user = profile_cache.get(username) if profile_cache else None
+    if user is None:
+        user = tx.get_user(username)
+        if user and profile_cache:
+            profile_cache.put(username, user)
 
     if not user:
         # Create new user profile
-        cursor.execute('''
-            INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
-                              scroll_mean, scroll_speed, touch_mean, status, last_update)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (
-            username,
-            generate_password_hash(""),
-            'customer',
-            round(f, 2),
-            round(dw, 2),
-            round(mouse_speed, 2),
-            scrolls,
-            round(scroll_speed, 2),
-            round(touch_speed, 2),
-            'Profiled',
-            ts
-        ))
-        profile = {
-            "flight_mean": round(f, 2),
-            "dwell_mean": round(dw, 2),
-            "mouse_mean": round(mouse_speed, 2),
-            "scroll_mean": scrolls,
-            "scroll_speed": round(scroll_speed, 2),
-            "touch_mean": round(touch_speed, 2)
-        }
+        profile = scoring.new_profile(feat)
+        tx.insert_users([dict(profile, username=username, password_hash=empty_password_hash(),
+                              role='customer', status='Profiled', last_update=ts)])
+        if profile_cache:
+            profile_cache.put(username, dict(profile, fraud=0, status='Profiled', last_update=ts))
+        created = True
     else:
-        profile = {
-            "flight_mean": float(user["flight_mean"] or f or 1.0),
-            "dwell_mean": float(user["dwell_mean"] or dw or 1.0),
-            "mouse_mean": float(user["mouse_mean"] or mouse_speed or 1.0),
-            "scroll_mean": int(user["scroll_mean"] or scrolls or 0),
-            "scroll_speed": float(user["scroll_speed"] or scroll_speed or 0.0),
-            "touch_mean": float(user["touch_mean"] or touch_speed or 0.0)
-        }
-
-    # Calculate deviations
-    def perc_dev(a, b):
-        try:
-            if b == 0:
-                return 0 if a == 0 else 100
-            return abs((a-b)/b)*100
-        except:
-            return 100
-
-    dev_f = perc_dev(f, profile["flight_mean"])
-    dev_dw = perc_dev(dw, profile["dwell_mean"])
-    dev_m = perc_dev(mouse_speed, profile["mouse_mean"])
-    dev_s = perc_dev(scrolls, profile["scroll_mean"])
-    dev_ss = perc_dev(scroll_speed, profile["scroll_speed"])
-    dev_touch = perc_dev(touch_speed, profile["touch_mean"])
-
-    # Calculate path metrics
-    def path_metrics(path):
-        try:
-            if not path or len(path) < 2: return {}
-            xs = np.array([p['x'] for p in path], dtype=float)
-            ys = np.array([p['y'] for p in path], dtype=float)
-            ts_arr = np.array([p['t'] for p in path], dtype=float)
-            dx = np.diff(xs)
-            dy = np.diff(ys)
-            dts = np.diff(ts_arr)/1000.0
-            dts[dts==0] = 0.001
-            dists = np.hypot(dx,dy)
-            speeds = dists / dts
-            total = float(np.sum(dists))
-            avg = float(np.mean(speeds)) if speeds.size else 0.0
-            var = float(np.var(speeds)) if speeds.size else 0.0
-            angles = np.arctan2(dy,dx)
-            ang_diff = np.abs(np.diff(angles))
-            ang_diff = np.minimum(ang_diff, 2*np.pi - ang_diff)
-            changes = float(np.sum(ang_diff > (np.pi/6)))
-            duration = float((ts_arr[-1] - ts_arr[0]) / 1000.0) if ts_arr.size else 1.0
-            dir_changes = changes / max(duration, 1.0)
-            bins = 12
-            hist, _ = np.histogram(angles, bins=bins, range=(-np.pi, np.pi))
-            probs = hist / (hist.sum() if hist.sum() else 1)
-            entropy = float(-np.sum([p*np.log2(p) for p in probs if p>0])) if probs.size else 0.0
-            return {
-                "path_length": round(float(total), 2),
-                "avg_speed": round(float(avg),2),
-                "speed_var": round(float(var),2),
-                "direction_changes_per_sec": round(float(dir_changes),2),
-                "angular_entropy": round(float(entropy),2)
-            }
-        except:
-            return {}
-
-    mouse_metrics = path_metrics(mouse_path)
-    touch_metrics = path_metrics(touch_path)
+        profile = scoring.effective_profile(user, feat)
+        created = False
+    timer.mark("profile")
 
     # Calculate fraud score
-    score = 0
-    score += min(dev_f * 0.25, 40)
-    score += min(dev_dw * 0.2, 30)
-    score += min(dev_m * 0.15, 20)
-    score += min(dev_s * 0.1, 10)
-    score += min(dev_ss * 0.1, 10)
-    score += min(dev_touch * 0.08, 8)
-
-    if mouse_metrics and mouse_metrics.get("angular_entropy", 0) < 1.0:
-        score += 5
-    if touch_metrics and touch_metrics.get("angular_entropy", 0) < 1.0:
-        score += 3
-
-    score = score * 0.7 + incoming_score * 0.3
-    score = int(round(min(score, 100)))
-
-    lock_threshold = 60
+    score = int(scorer.score([feat], [profile], [user])[0])
     now_ms = int(time()*1000)
+    timer.mark("score")
 
-    if score > lock_threshold:
+    if score > scoring.LOCK_THRESHOLD:
         # Lock user
-        cursor.execute('''
-            UPDATE users SET locked_until = %s, status = %s, fraud = %s, last_update = %s
-            WHERE username = %s
-        ''', (now_ms + (60 * 1000), 'Locked', score, ts, username))
+        tx.lock_user(username, now_ms + scoring.LOCK_MS, score, ts)
+        timer.mark("update")
 
         # Add history entry
-        cursor.execute('''
-            INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
-                                    touch_speed, touch_metrics, click_positions, scrolls, scroll_speed,
-                                    scroll_speeds, clicks, fraud, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (
-            username, ts, round(f,2), round(dw,2), round(mouse_speed,2), json.dumps(mouse_metrics),
-            round(touch_speed,2), json.dumps(touch_metrics), json.dumps(click_positions),
-            scrolls, round(scroll_speed,2), json.dumps(d.get("scroll_speeds", [])),
-            clicks, score, 'Locked'
-        ))
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return jsonify({"status":"Locked","fraud_score":score,"locked_until": now_ms + (60 * 1000)})
+        save_history(tx, [scoring.history_row(username, ts, feat, score, 'Locked')])
+        timer.mark("history")
+
+        tx.commit()
+        if profile_cache:
+            profile_cache.mark_locked(username, score, ts)
+        tx.close()
+        timer.mark("commit")
+        if created:
+            user_created(username)
+            profile_changed(username, profile)
+        return jsonify(annotate({"status":"Locked","fraud_score":score,"locked_until": now_ms + scoring.LOCK_MS}, feat, username))
 
     # Normal update
-    status = "Authenticated" if score < 40 else ("Suspicious" if score < 70 else "Fraud Detected")
+    status = scoring.status_for(score)
+
+    # Update user profile with exponential moving average (and the scorer's baseline, if any)
+    updated = scoring.ema_update(profile, feat)
+    baseline = scorer.update(user, feat)
+    if profile_cache:
+        # coalesced into the cache's next batched UPDATE
+        profile_cache.update(username, updated, score, status, ts, baseline)
+    else:
+        tx.update_profile(username, updated, score, status, ts, baseline)
+    timer.mark("update")
 
     # Add history entry
-    cursor.execute('''
-        INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
-                                touch_speed, touch_metrics, click_positions, scrolls, scroll_speed,
-                                scroll_speeds, clicks, fraud, status)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (
-        username, ts, round(f,2), round(dw,2), round(mouse_speed,2), json.dumps(mouse_metrics),
-        round(touch_speed,2), json.dumps(touch_metrics), json.dumps(click_positions),
-        scrolls, round(scroll_speed,2), json.dumps(d.get("scroll_speeds", [])),
-        clicks, score, status
-    ))
-
-    # Update user profile with exponential moving average
-    alpha = 0.02
-    new_flight = round((1-alpha)*profile["flight_mean"] + alpha * f, 2)
-    new_dwell = round((1-alpha)*profile["dwell_mean"] + alpha * dw, 2)
-    new_mouse = round((1-alpha)*profile["mouse_mean"] + alpha * mouse_speed, 2)
-    new_scroll = int(round((1-alpha)*profile["scroll_mean"] + alpha * scrolls))
-    new_scroll_speed = round((1-alpha)*profile["scroll_speed"] + alpha * scroll_speed, 2)
-    new_touch = round((1-alpha)*profile["touch_mean"] + alpha * touch_speed, 2)
+    save_history(tx, [scoring.history_row(username, ts, feat, score, status)])
+    timer.mark("history")
 
-    cursor.execute('''
-        UPDATE users SET flight_mean = %s, dwell_mean = %s, mouse_mean = %s, scroll_mean = %s,
-                         scroll_speed = %s, touch_mean = %s, fraud = %s, status = %s, last_update = %s
-        WHERE username = %s
-    ''', (
-        new_flight, new_dwell, new_mouse, new_scroll, new_scroll_speed, new_touch,
-        score, status, ts, username
-    ))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    tx.commit()
+    tx.close()
+    timer.mark("commit")
+    if created:
+        user_created(username)
+    profile_changed(username, updated)
 
-    return jsonify({"status": status, "fraud_score": score, "confidence": max(0, 100-score)})
+    return jsonify(annotate({"status": status, "fraud_score": score, "confidence": max(0, 100-score)}, feat, username))
 
-@app.route("/admin")
-def admin():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+VERIFY_BATCH_MAX = int(os.getenv("VERIFY_BATCH_MAX", "5000"))
 
-    # Get all users
-    cursor.execute("SELECT * FROM users")
-    users = cursor.fetchall()
+@bp.route("/verify/batch", methods=["POST"])
+@timed("verify_batch")
+def verify_batch():
+    # Body: {"items": [<verify payload>, ...]} (or a bare list). Answers {"results": [...]} with
+    # exactly what /verify would have answered for each item, in order.
+    d = request.json
+    items = d.get("items") if isinstance(d, dict) else d
+    if not isinstance(items, list):
+        return jsonify({"error":"items list required"}), 400
+    if len(items) > VERIFY_BATCH_MAX:
+        return jsonify({"error":"at most %d items per batch" % VERIFY_BATCH_MAX}), 413
+
+    timer = g.timer
+    items = [unpack_fields(it) for it in items]
+    now_ms = int(time()*1000)
+    usernames = [it.get("username", "default_user") for it in items]
+    stamps = [int(it.get("ts", now_ms)) for it in items]
+    timer.mark("decode")
+    feats = parse_features(items)
+    timer.mark("parse")
+
+    tx = store.transaction()
+    timer.mark("connect")
+    state = {row["username"]: dict(row) for row in tx.get_users(set(usernames))}
+    if profile_cache:
+        # unflushed EMA updates are newer than the table; lock state stays the table's
+        for name in state:
+            cached = profile_cache.get(name)
+            if cached:
+                state[name].update((k, cached[k]) for k in scoring.PROFILE_FIELDS + ("baseline", "status", "last_update"))
+    timer.mark("profile")
+
+    results, scored, created, touched, history = scoring.score_rounds(usernames, stamps, feats, state, now_ms, scorer)
+    for i in scored:
+        annotate(results[i], feats[i], usernames[i])
+    for i in set(range(len(results))).difference(scored):
+        metrics.outcome(results[i]["status"])  # already locked
+    timer.mark("score")
+
+    # One INSERT for new users, one UPDATE for every touched profile, one INSERT for history
+    if created:
+        password_hash = empty_password_hash()
+        tx.insert_users([dict(u, password_hash=password_hash, role='customer', status='Profiled')
+                         for u in created.values()])
+    if touched:
+        tx.update_users([state[name] for name in touched])
+    timer.mark("update")
+    if history:
+        save_history(tx, history)
+    timer.mark("history")
+    tx.commit()
+    tx.close()
+    timer.mark("commit")
+
+    if profile_cache:
+        for name in touched:
+            profile_cache.put(name, state[name])
+    for name in created:
+        user_created(name)
+    for name in touched:
+        profile_changed(name, state[name])
+    return jsonify({"results": results})
+
+ADMIN_PAGE_SIZE = 100
+ADMIN_HISTORY_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 1000
+
+def conditional(render):
+    # A read of users behind an ETag: the change token (see change_state() in storage.py) answers
+    # a matching If-None-Match with 304 and keys the response cache; render(tx) queries, closes
+    # tx and returns the response. X-Change-Version is the ?changed_since= that picks up every
+    # write this response may have missed.
+    timer = g.timer
+    tx = store.transaction(readonly=True)
+    timer.mark("connect")
+    token, since = tx.change_state()
+    timer.mark("version")
+    not_modified = token is not None and request.if_none_match.contains_weak(token)
+    cached = None
+    if response_cache and token is not None and not not_modified:
+        cached = response_cache.get(request.full_path, token)
+    if not_modified:
+        tx.close()
+        response = Response(status=304)
+    elif cached is not None:
+        tx.close()
+        response = Response(*cached)
+    else:
+        response = render(tx)
+        if response_cache and token is not None:
+            response_cache.put(request.full_path, token, response.get_data(), response.status_code,
+                               [(k, v) for k, v in response.headers if k in ("Content-Type", "X-Next-Cursor")])
+    if token is not None:
+        response.set_etag(token)
+    # revalidated on every fetch; a browser's If-None-Match makes that a 304 while nothing changed
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Change-Version"] = str(since)
+    return response
 
-    # Get history for each user
-    result = {}
+def fetch_admin_users(tx, **query):
+    # one statement per page on either backend (see the admin_users implementations in storage.py)
+    users = tx.admin_users(**query)
+    tx.close()
+    g.timer.mark("query")
     for user in users:
-        username = user["username"]
-        cursor.execute("SELECT * FROM user_history WHERE username = %s ORDER BY ts DESC", (username,))
-        history = cursor.fetchall()
-        result[username] = dict(user)
-        result[username]["history"] = [dict(entry) for entry in history]
+        user["baseline"] = baseline.summary(user["baseline"])
+        del user["version"]
+    return users
 
-    cursor.close()
-    conn.close()
-    return jsonify(result)
+@bp.route("/admin")
+@timed("admin")
+def admin():
+    # ?limit= users per page, ?cursor= last username of the previous page (next one comes back
+    # in X-Next-Cursor), ?history= rows per user (newest first), ?since= minimum history ts,
+    # ?changed_since= only users written since that X-Change-Version
+    limit = min(max(request.args.get("limit", ADMIN_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    history_limit = min(max(request.args.get("history", ADMIN_HISTORY_SIZE, type=int), 0), ADMIN_MAX_PAGE_SIZE)
+    since = request.args.get("since", type=int)
+    changed_since = request.args.get("changed_since", type=store.parse_version)
+    after = request.args.get("cursor", "")
+
+    if profile_cache:
+        profile_cache.flush()
+    g.timer.mark("flush")
+
+    def render(tx):
+        users = fetch_admin_users(tx, after=after, limit=limit + 1, history_limit=history_limit, since=since,
+                                  changed_since=changed_since)
+        result = {}
+        for user in users[:limit]:
+            result[user["username"]] = dict(user)
+        response = jsonify(result)
+        g.timer.mark("render")
+        if len(users) > limit:
+            response.headers["X-Next-Cursor"] = users[limit - 1]["username"]
+        return response
+    return conditional(render)
+
+# Per-user views live under /admin/users/: a rule like /admin/<username> would be shadowed by
+# every fixed /admin/... route, which Werkzeug tries first
+@bp.route("/admin/users/<username>")
+@timed("admin_user")
+def admin_user(username):
+    # Same shape as /admin for a single user; page back through history with ?before=<ts>
+    history_limit = min(max(request.args.get("history", ADMIN_HISTORY_SIZE, type=int), 0), ADMIN_MAX_PAGE_SIZE)
+    since = request.args.get("since", type=int)
+    before = request.args.get("before", type=int)
+
+    if profile_cache:
+        profile_cache.flush()
+    g.timer.mark("flush")
+
+    def render(tx):
+        users = fetch_admin_users(tx, username=username, history_limit=history_limit + 1, since=since, before=before)
+        if not users:
+            response = jsonify({"error":"user not found"})
+            response.status_code = 404
+            return response
+        user = dict(users[0])
+        response_more = len(user["history"]) > history_limit
+        user["history"] = user["history"][:history_limit]
+        response = jsonify({username: user})
+        g.timer.mark("render")
+        if response_more and user["history"]:
+            response.headers["X-Next-Cursor"] = str(user["history"][-1]["ts"])
+        return response
+    return conditional(render)
+
+@bp.route("/admin/users/<username>/similar")
+@similarity_required
+def similar_users(username):
+    # ?k= accounts whose profiles are closest to this user's (default 10), most similar first
+    k = min(max(request.args.get("k", 10, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    similar = similarity_index.nearest(username, k)
+    if similar is None:
+        return jsonify({"error":"user not indexed (not found, or never profiled)"}), 404
+    return jsonify({"username": username,
+                    "similar": [{"username": name, "similarity": round(sim, 4)} for name, sim in similar]})
 
-@app.route("/profiles")
+@bp.route("/admin/clusters")
+@similarity_required
+def similar_clusters():
+    # ?similarity= minimum similarity linking two accounts (default 0.9), ?min_size= smallest
+    # cluster reported (default 2), ?limit= clusters (default 100), largest first
+    try:
+        clusters, skipped = similarity_index.clusters(
+            similarity=request.args.get("similarity", 0.9, type=float),
+            min_size=request.args.get("min_size", 2, type=int),
+            limit=min(max(request.args.get("limit", 100, type=int), 1), ADMIN_MAX_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"clusters": [{"size": size, "usernames": names} for names, size in clusters],
+                    "skipped_cells": skipped})
+
+@bp.route("/admin/import", methods=["POST"])
+def import_users():
+    # Body: JSON, NDJSON or CSV records (see bulk_import.py), by Content-Type; ?chunk= records per
+    # transaction, ?skip=N resumes after record N. Answers NDJSON: the running totals after each
+    # committed chunk with that chunk's rejected records, then the totals with "done": true, or
+    # with an "error" and the `records` to resume from.
+    if request.headers.get("X-Admin-Secret") != ADMIN_SECRET:
+        return jsonify({"error":"invalid admin secret"}), 403
+    fmt = bulk_import.CONTENT_TYPES.get(request.mimetype)
+    if fmt is None:
+        return jsonify({"error":"Content-Type must be one of: %s" % ", ".join(bulk_import.CONTENT_TYPES)}), 415
+    skip = request.args.get("skip", 0, type=int)
+    chunk = request.args.get("chunk", bulk_import.IMPORT_CHUNK, type=int)
+    if skip < 0 or chunk < 1:
+        return jsonify({"error":"skip must be >= 0 and chunk >= 1"}), 400
+    body = io.TextIOWrapper(request.stream, encoding=request.mimetype_params.get("charset", "utf-8"),
+                            newline="" if fmt == "csv" else None)
+    try:
+        records = bulk_import.read_records(body, fmt)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        progress = {"records": skip, "imported": 0, "skipped": 0, "errors": 0}
+        try:
+            for progress, inserted, errors in bulk_import.import_users(store, records, import_lane, chunk, skip):
+                for row in inserted:
+                    user_created(row["username"])
+                    profile_changed(row["username"], row)
+                yield json.dumps(dict(progress, rejected=errors)) + "\n"
+        except Exception as err:
+            # the status line is long gone; the client resumes with ?skip=records
+            _app.logger.exception("import stopped after record %d", progress["records"])
+            yield json.dumps(dict(progress, error=str(err))) + "\n"
+            return
+        yield json.dumps(dict(progress, done=True)) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@bp.route("/profiles")
+@timed("profiles")
 def profiles():
+    # ?changed_since= only users written since that X-Change-Version
+    timer = g.timer
+    changed_since = request.args.get("changed_since", type=store.parse_version)
+    if profile_cache:
+        profile_cache.flush()
+    timer.mark("flush")
+
+    def render(tx):
+        users = tx.profiles(changed_since=changed_since)
+        tx.close()
+        timer.mark("query")
+
+        result = {}
+        for user in users:
+            username = user["username"]
+            result[username] = {
+                "profile": {
+                    "flight_mean": user["flight_mean"],
+                    "dwell_mean": user["dwell_mean"],
+                    "mouse_mean": user["mouse_mean"],
+                    "scroll_mean": user["scroll_mean"],
+                    "scroll_speed": user["scroll_speed"],
+                    "touch_mean": user["touch_mean"]
+                },
+                "status": user["status"],
+                "fraud": user["fraud"],
+                "last_update": user["last_update"]
+            }
+
+        response = jsonify(result)
+        timer.mark("render")
+        return response
+    return conditional(render)
+
+# Rows fetched per server-side cursor round trip in the streaming exports
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", "2000"))
+
+def export_response(name, sql, ts_column, order_by, user_order_by):
+    # ?format=ndjson|csv, ?username=, ?since= / ?until= (ms, half-open range on ts_column)
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error":"format must be one of: %s" % ", ".join(EXPORT_FORMATS)}), 400
+    where, params = [], []
+    username = request.args.get("username")
+    if username:
+        where.append("username = %s")
+        params.append(username)
+    since = request.args.get("since", type=int)
+    if since is not None:
+        where.append("%s >= %%s" % ts_column)
+        params.append(since)
+    until = request.args.get("until", type=int)
+    if until is not None:
+        where.append("%s < %%s" % ts_column)
+        params.append(until)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + (user_order_by if username else order_by)
+
+    if profile_cache:
+        profile_cache.flush()
     conn = get_db_connection()
-    cursor = conn.cursor()
+    return Response(
+        stream_with_context(stream_query(conn, sql, tuple(params), fmt, EXPORT_ITERSIZE)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": "attachment; filename=%s.%s" % (name, fmt)}
+    )
 
-    cursor.execute("""
+@bp.route("/profiles/stream")
+@postgres_only
+def profiles_stream():
+    return export_response("profiles", '''
         SELECT username,
                flight_mean, dwell_mean, mouse_mean, scroll_mean, scroll_speed, touch_mean,
                status, fraud, last_update
-        FROM users
-    """)
-    users = cursor.fetchall()
+        FROM users''', "last_update", "username", "username")
 
-    result = {}
-    for user in users:
-        username = user["username"]
-        result[username] = {
-            "profile": {
-                "flight_mean": user["flight_mean"],
-                "dwell_mean": user["dwell_mean"],
-                "mouse_mean": user["mouse_mean"],
-                "scroll_mean": user["scroll_mean"],
-                "scroll_speed": user["scroll_speed"],
-                "touch_mean": user["touch_mean"]
-            },
-            "status": user["status"],
-            "fraud": user["fraud"],
-            "last_update": user["last_update"]
-        }
+@bp.route("/admin/stream")
+@postgres_only
+def history_stream():
+    # Without a username filter rows come in id order, so the scan streams without a sort
+    return export_response("user_history", "SELECT * FROM user_history", "ts", "id", "ts")
+
+# /analytics/<username> without ?since covers this much time before ?until (default now)
+ANALYTICS_DEFAULT_SPAN = {"minute": 6 * 60 * 60 * 1000, "hour": 30 * 24 * 60 * 60 * 1000}
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", "2000"))
+
+@bp.route("/analytics/<username>")
+@postgres_only
+def analytics(username):
+    # ?resolution=minute|hour, ?since= / ?until= (ms, half-open). Chart series and click heatmap
+    # come from the rollup tables, so the cost depends on the range, not on history size.
+    resolution = request.args.get("resolution", "hour")
+    if resolution not in RESOLUTIONS:
+        return jsonify({"error":"resolution must be one of: %s" % ", ".join(RESOLUTIONS)}), 400
+    until = request.args.get("until", type=int)
+    if until is None:
+        until = int(time()*1000)
+    since = request.args.get("since", type=int)
+    if since is None:
+        since = until - ANALYTICS_DEFAULT_SPAN[resolution]
+    bucket_ms = RESOLUTIONS[resolution]
+    if since >= until:
+        return jsonify({"error":"since must be before until"}), 400
+    if (until - since) // bucket_ms > ANALYTICS_MAX_BUCKETS:
+        return jsonify({"error":"at most %d %s buckets per request" % (ANALYTICS_MAX_BUCKETS, resolution)}), 400
 
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    result = fetch_analytics(cursor, username, bucket_ms, since, until)
     cursor.close()
     conn.close()
+    result.update({"username": username, "resolution": resolution, "bucket_ms": bucket_ms,
+                   "since": since, "until": until})
     return jsonify(result)
 
+def stats_snapshot():
+    result = {"storage": store.name, "scorer": scorer.name, "startup": startup}
+    if pool:
+        result["pool"] = pool.stats()
+    if SHARDED:
+        result["sharding"] = dict(store.stats(), pools={name: p.stats() for name, p in shard_pools.items()},
+                                  partitions={name: p.stats() for name, p in shard_partitions.items()})
+    with telemetry_lock:
+        result["telemetry"] = dict(telemetry_counts, raw_audit_rate=RAW_AUDIT_RATE)
+    if profile_cache:
+        result["profile_cache"] = profile_cache.stats()
+    if history_writer:
+        result["history_writer"] = history_writer.stats()
+    if history_partitions:
+        result["history_partitions"] = history_partitions.stats()
+    if login_guard:
+        result["login_guard"] = login_guard.stats()
+    if similarity_index:
+        result["similarity_index"] = similarity_index.stats()
+    if response_cache:
+        result["response_cache"] = response_cache.stats()
+    if auth_lane.enabled or score_lane.enabled or import_lane.enabled:
+        result["workers"] = {"auth": auth_lane.stats(), "score": score_lane.stats(), "import": import_lane.stats()}
+    if profiler.enabled:
+        result["profiler"] = profiler.stats()
+    return result
+
+@bp.route("/stats")
+def stats():
+    return jsonify(stats_snapshot())
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    # stage histograms and outcome counts, then every number /stats reports, as gauges
+    return Response(metrics.render(stats_snapshot()), content_type=METRICS_CONTENT_TYPE)
+
+@bp.route("/metrics/profile")
+def sampled_profile():
+    # collapsed stacks ("frame;frame;frame count" per line) for flamegraph.pl or speedscope
+    if not profiler.enabled:
+        return jsonify({"error":"profiler disabled; set METRICS_PROFILE_HZ"}), 404
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
+@bp.route("/healthz")
+def healthz():
+    # liveness: the process answers; never touches the database
+    return jsonify({"status":"ok"})
+
+@bp.route("/readyz")
+def readyz():
+    # readiness: scorer loaded, schema current and the database answering
+    try:
+        prepare()
+        with store.transaction(readonly=True) as tx:
+            tx.ping()
+    except Exception as err:
+        _app.logger.warning("not ready: %s", err)
+        return jsonify({"status":"unavailable","error":str(err)}), 503
+    return jsonify({"status":"ready","startup":startup})
+
+startup["import_ms"] = elapsed_ms(_started)
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    if sys.argv[1:] == ["migrate"]:
+        create_app()
+        init_db()
+        print("database schema at version %d" % SCHEMA_VERSION)
+    else:
+        create_app().run(debug=True)
\ No newline at end of file
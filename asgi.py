@@ -0,0 +1,510 @@
+# asgi.py - asyncio serving mode (Starlette + asyncpg)
+#
+#     uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+#     python asgi.py                      (same, configured from ASGI_HOST/ASGI_PORT/ASGI_WORKERS)
+#
+# /verify, /verify/batch, /stats and /metrics run natively on an asyncpg pool, so a session waiting on
+# NeonDB holds a coroutine rather than a thread. So does the /verify/stream WebSocket, which only
+# exists in this mode (uvicorn needs the websockets package for it). They reuse app.py's scoring, profile cache,
+# history writer, response annotations and JSON encoder, and answer with the same bodies and
+# status codes. Every other route (register/login, which are dominated by password hashing, and
+# the admin/profile/export pages) is the Flask app itself, run in a thread pool via a2wsgi.
+import os, json, asyncio
+from contextlib import asynccontextmanager
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+import app as flask_app
+from history_queue import HISTORY_COLUMNS
+from scoring import (PROFILE_FIELDS, REAL_FIELDS, LOCK_THRESHOLD, LOCK_MS, as_stored_real, parse_payloads,
+                     raw_path_points, new_profile, effective_profile, score_rounds, status_for, ema_update,
+                     history_row)
+from stream import StreamFormatError, StreamSession
+from telemetry import TELEMETRY_CONTENT_TYPE, TelemetryFormatError, decode_telemetry, unpack_fields
+from verify_sql import SINGLE_TRIP_SQL, single_trip_params, single_trip_body
+from workers import WorkerBusy
+
+ASYNC_POOL_MIN = int(os.getenv("ASYNC_POOL_MIN", "2"))
+ASYNC_POOL_MAX = int(os.getenv("ASYNC_POOL_MAX", "20"))
+ASYNC_POOL_TIMEOUT = float(os.getenv("ASYNC_POOL_TIMEOUT", "5"))
+
+# a stream is scored at most this often; events arriving in between wait in its windows
+STREAM_SCORE_MS = int(os.getenv("STREAM_SCORE_MS", "500"))
+
+ACCEPT_POST = ("application/json, " + TELEMETRY_CONTENT_TYPE).encode("latin-1")
+
+if flask_app.EMBEDDED:
+    # the embedded store serves /verify in-process already; run app.py (flask) instead
+    raise ValueError("asgi.py needs STORAGE=postgres")
+
+# The native routes below read app.py's scorer and components straight away; the schema check
+# and pool fill still wait for lifespan
+flask_wsgi = flask_app.create_app()
+flask_app.load_scoring()
+profile_cache = flask_app.profile_cache
+scorer = flask_app.scorer
+score_lane = flask_app.score_lane
+history_writer = flask_app.history_writer
+pool = None
+pool_timeouts = 0
+stream_counts = {"open": 0, "frames": 0, "rejected": 0, "scored": 0, "pushed": 0}
+
+
+def asyncpg_dsn(url):
+    # asyncpg passes unknown query parameters to the server as settings; Neon URLs carry
+    # channel_binding, which only libpq understands
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != "channel_binding"]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def numbered(sql):
+    # psycopg2 %s placeholders -> asyncpg $1, $2, ...
+    pieces = sql.split("%s")
+    return "".join(p + ("$%d" % i if i < len(pieces) else "") for i, p in enumerate(pieces, 1))
+
+
+def pg_real(value):
+    # REAL parameters go over as text, like psycopg2 sends them, so Postgres rounds the decimal
+    # to float4 itself; a binary float4 would be rounded twice (decimal -> double -> float4)
+    return None if value is None else repr(float(value))
+
+
+def as_row(record):
+    """A users record as the dict psycopg2's RealDictCursor would have returned."""
+    row = dict(record)
+    for k in REAL_FIELDS:
+        if row.get(k) is not None:
+            row[k] = as_stored_real(row[k])
+    return row
+
+
+def json_response(body, status=200):
+    # rendered by app.json, the provider behind jsonify, so the bytes match the Flask routes
+    rendered = flask_wsgi.json.response(body)
+    return Response(rendered.get_data(), status_code=status, media_type=rendered.mimetype)
+
+
+@asynccontextmanager
+async def connection():
+    global pool_timeouts
+    try:
+        conn = await pool.acquire(timeout=ASYNC_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_timeouts += 1
+        raise flask_app.PoolExhausted("no connection within %.1fs" % ASYNC_POOL_TIMEOUT)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+SINGLE_TRIP_ASYNC_SQL = numbered(SINGLE_TRIP_SQL)
+
+_HISTORY_TYPES = {"username": "text", "ts": "bigint", "scrolls": "integer", "clicks": "integer",
+                  "fraud": "integer", "status": "text", "flight": "real", "dwell": "real",
+                  "mouse_speed": "real", "touch_speed": "real", "scroll_speed": "real"}  # rest jsonb
+# one statement for any number of rows: column arrays unnested into a single INSERT
+HISTORY_SQL = "INSERT INTO user_history (%s) SELECT %s FROM unnest(%s) AS h(%s)" % (
+    ", ".join(HISTORY_COLUMNS),
+    ", ".join("h.%s::%s" % (c, _HISTORY_TYPES.get(c, "jsonb")) for c in HISTORY_COLUMNS),
+    ", ".join("$%d::%s[]" % (i, _HISTORY_TYPES[c] if _HISTORY_TYPES.get(c) in ("bigint", "integer") else "text")
+              for i, c in enumerate(HISTORY_COLUMNS, 1)),
+    ", ".join(HISTORY_COLUMNS))
+_HISTORY_REAL = [_HISTORY_TYPES.get(c) == "real" for c in HISTORY_COLUMNS]
+
+
+def history_columns(rows):
+    columns = [list(c) for c in zip(*rows)]
+    return [[pg_real(v) for v in col] if real else col for col, real in zip(columns, _HISTORY_REAL)]
+
+
+async def queue_history(conn, rows):
+    # app.save_history after commit: queue on the background writer, insert what it refuses
+    for i, row in enumerate(rows):
+        if not await asyncio.to_thread(history_writer.submit, row):
+            await conn.execute(HISTORY_SQL, *history_columns(rows[i:]))
+            return
+
+
+async def telemetry_payload(request, binary=True):
+    body = await request.body()
+    mimetype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if binary and mimetype == TELEMETRY_CONTENT_TYPE:
+        return decode_telemetry(body)
+    # Flask's request.json: JSON content types only, 400 on a body that does not parse
+    if not (mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))):
+        raise HTTPException(415)
+    try:
+        d = json.loads(body)
+    except ValueError:
+        raise HTTPException(400)
+    return unpack_fields(d or {}) if binary else d
+
+
+async def parse_features(items):
+    # app.parse_features, awaiting the score lane instead of blocking the loop on it
+    if not score_lane.enabled or sum(map(raw_path_points, items)) < flask_app.WORKER_SCORE_MIN_POINTS:
+        return parse_payloads(items)
+    size = -(-len(items) // score_lane.processes)
+    chunks = await asyncio.gather(*(score_lane.run_async(parse_payloads, items[i:i + size])
+                                    for i in range(0, len(items), size)))
+    return [feat for chunk in chunks for feat in chunk]
+
+
+async def verify(request):
+    # same stages as app.verify; with other requests interleaved on the loop they are wall time
+    timer = flask_app.metrics.timer("verify")
+    d = await telemetry_payload(request)
+    timer.mark("decode")
+    return json_response(await verify_payload(d, timer))
+
+
+async def verify_payload(d, timer):
+    """app.verify from a decoded payload on: the response body, with the timer done."""
+    username = d.get("username", "default_user")
+    ts = int(d.get("ts", time()*1000))
+
+    async with connection() as conn:
+        timer.mark("connect")
+        if not flask_app.VERIFY_SINGLE_TRIP:
+            user_lock = await conn.fetchrow("SELECT locked_until, fraud FROM users WHERE username = $1", username)
+            timer.mark("lock")
+            if user_lock and user_lock["locked_until"] and user_lock["locked_until"] > int(time()*1000):
+                flask_app.metrics.outcome("Locked")
+                timer.done()
+                return {"status":"Locked","fraud_score": user_lock["fraud"], "locked_until": user_lock["locked_until"]}
+
+        feat = (await parse_features([d]))[0]
+        timer.mark("parse")
+
+        if flask_app.VERIFY_SINGLE_TRIP:
+            row = await conn.fetchrow(SINGLE_TRIP_ASYNC_SQL, *single_trip_params(
+                username, ts, int(time()*1000), flask_app.empty_password_hash(), feat))
+            timer.mark("single_trip")
+            flask_app.user_created(username)
+            timer.done()
+            return flask_app.annotate(single_trip_body(row), feat, username)
+
+        user = profile_cache.get(username) if profile_cache else None
+        password_hash = None
+        if user is None:
+            record = await conn.fetchrow("SELECT * FROM users WHERE username = $1", username)
+            user = as_row(record) if record else None
+            if user and profile_cache:
+                profile_cache.put(username, user)
+            elif not user:
+                # hashed once per process, like the single-trip path above
+                password_hash = flask_app.empty_password_hash()
+
+        async with conn.transaction():
+            if not user:
+                profile = new_profile(feat)
+                await conn.execute('''
+                    INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
+                                      scroll_mean, scroll_speed, touch_mean, status, last_update)
+                    VALUES ($1, $2, 'customer', $3::text::real, $4::text::real, $5::text::real,
+                            $6, $7::text::real, $8::text::real, 'Profiled', $9)
+                ''', username, password_hash, pg_real(profile["flight_mean"]), pg_real(profile["dwell_mean"]),
+                    pg_real(profile["mouse_mean"]), profile["scroll_mean"], pg_real(profile["scroll_speed"]),
+                    pg_real(profile["touch_mean"]), ts)
+                if profile_cache:
+                    profile_cache.put(username, dict(profile, fraud=0, status='Profiled', last_update=ts))
+            else:
+                profile = effective_profile(user, feat)
+            timer.mark("profile")
+
+            score = int(scorer.score([feat], [profile], [user])[0])
+            now_ms = int(time()*1000)
+            timer.mark("score")
+
+            if score > LOCK_THRESHOLD:
+                status = 'Locked'
+                await conn.execute('''
+                    UPDATE users SET locked_until = $1, status = $2, fraud = $3, last_update = $4
+                    WHERE username = $5
+                ''', now_ms + LOCK_MS, status, score, ts, username)
+                body = {"status":"Locked","fraud_score":score,"locked_until": now_ms + LOCK_MS}
+            else:
+                status = status_for(score)
+                updated = ema_update(profile, feat)
+                baseline = scorer.update(user, feat)
+                if profile_cache:
+                    profile_cache.update(username, updated, score, status, ts, baseline)
+                else:
+                    await conn.execute('''
+                        UPDATE users SET flight_mean = $1::text::real, dwell_mean = $2::text::real,
+                                         mouse_mean = $3::text::real, scroll_mean = $4,
+                                         scroll_speed = $5::text::real, touch_mean = $6::text::real,
+                                         fraud = $7, status = $8, last_update = $9,
+                                         baseline = coalesce($11::bytea, baseline)
+                        WHERE username = $10
+                    ''', *(updated[k] if k == "scroll_mean" else pg_real(updated[k]) for k in PROFILE_FIELDS),
+                        score, status, ts, username, baseline)
+                body = {"status": status, "fraud_score": score, "confidence": max(0, 100-score)}
+            timer.mark("update")
+
+            row = history_row(username, ts, feat, score, status)
+            if not history_writer:
+                await conn.execute(HISTORY_SQL, *history_columns([row]))
+            timer.mark("history")
+        timer.mark("commit")
+
+        if history_writer:
+            await queue_history(conn, [row])
+            timer.mark("history")
+        if profile_cache and status == 'Locked':
+            profile_cache.mark_locked(username, score, ts)
+    if password_hash is not None:
+        flask_app.user_created(username)
+    if status != 'Locked':
+        flask_app.profile_changed(username, updated)
+    elif password_hash is not None:
+        flask_app.profile_changed(username, profile)
+    timer.done()
+    return flask_app.annotate(body, feat, username)
+
+
+async def verify_batch(request):
+    d = await telemetry_payload(request, binary=False)
+    items = d.get("items") if isinstance(d, dict) else d
+    if not isinstance(items, list):
+        return json_response({"error":"items list required"}, 400)
+    if len(items) > flask_app.VERIFY_BATCH_MAX:
+        return json_response({"error":"at most %d items per batch" % flask_app.VERIFY_BATCH_MAX}, 413)
+
+    timer = flask_app.metrics.timer("verify_batch")
+    items = [unpack_fields(it) for it in items]
+    now_ms = int(time()*1000)
+    usernames = [it.get("username", "default_user") for it in items]
+    stamps = [int(it.get("ts", now_ms)) for it in items]
+    timer.mark("decode")
+    feats = await parse_features(items)
+    timer.mark("parse")
+
+    async with connection() as conn:
+        timer.mark("connect")
+        async with conn.transaction():
+            records = await conn.fetch("SELECT * FROM users WHERE username = ANY($1::text[])", list(set(usernames)))
+            state = {r["username"]: as_row(r) for r in records}
+            if profile_cache:
+                for name in state:
+                    cached = profile_cache.get(name)
+                    if cached:
+                        state[name].update((k, cached[k]) for k in PROFILE_FIELDS + ("baseline", "status", "last_update"))
+            timer.mark("profile")
+
+            results, scored, created, touched, history = score_rounds(usernames, stamps, feats, state, now_ms, scorer)
+            for i in scored:
+                flask_app.annotate(results[i], feats[i], usernames[i])
+            for i in set(range(len(results))).difference(scored):
+                flask_app.metrics.outcome(results[i]["status"])  # already locked
+            timer.mark("score")
+
+            if created:
+                users = list(created.values())
+                await conn.execute('''
+                    INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
+                                      scroll_mean, scroll_speed, touch_mean, status, last_update)
+                    SELECT u.username, $2, 'customer', u.flight_mean::real, u.dwell_mean::real,
+                           u.mouse_mean::real, u.scroll_mean, u.scroll_speed::real, u.touch_mean::real,
+                           'Profiled', u.last_update
+                    FROM unnest($1::text[], $3::text[], $4::text[], $5::text[], $6::integer[], $7::text[],
+                                $8::text[], $9::bigint[])
+                         AS u(username, flight_mean, dwell_mean, mouse_mean, scroll_mean, scroll_speed,
+                              touch_mean, last_update)
+                ''', list(created), flask_app.empty_password_hash(),
+                    *([u[k] for u in users] if k == "scroll_mean" else [pg_real(u[k]) for u in users]
+                      for k in PROFILE_FIELDS),
+                    [u["last_update"] for u in users])
+            if touched:
+                names = list(touched)
+                rows = [state[name] for name in names]
+                await conn.execute('''
+                    UPDATE users AS u SET
+                        flight_mean = v.flight_mean::real, dwell_mean = v.dwell_mean::real,
+                        mouse_mean = v.mouse_mean::real, scroll_mean = v.scroll_mean,
+                        scroll_speed = v.scroll_speed::real, touch_mean = v.touch_mean::real,
+                        fraud = v.fraud, status = v.status, last_update = v.last_update,
+                        locked_until = v.locked_until, baseline = coalesce(v.baseline, u.baseline)
+                    FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::integer[], $6::text[],
+                                $7::text[], $8::integer[], $9::text[], $10::bigint[], $11::bigint[], $12::bytea[])
+                         AS v(username, flight_mean, dwell_mean, mouse_mean, scroll_mean, scroll_speed,
+                              touch_mean, fraud, status, last_update, locked_until, baseline)
+                    WHERE u.username = v.username
+                ''', names,
+                    *([r[k] for r in rows] if k == "scroll_mean" else [pg_real(r[k]) for r in rows]
+                      for k in PROFILE_FIELDS),
+                    [r["fraud"] for r in rows], [r["status"] for r in rows],
+                    [r["last_update"] for r in rows], [r["locked_until"] or 0 for r in rows],
+                    [r.get("baseline") for r in rows])
+            timer.mark("update")
+            if history and not history_writer:
+                await conn.execute(HISTORY_SQL, *history_columns(history))
+            timer.mark("history")
+        timer.mark("commit")
+
+        if history and history_writer:
+            await queue_history(conn, history)
+            timer.mark("history")
+
+    if profile_cache:
+        for name in touched:
+            profile_cache.put(name, state[name])
+    for name in created:
+        flask_app.user_created(name)
+    for name in touched:
+        flask_app.profile_changed(name, state[name])
+    timer.done()
+    return json_response({"results": results})
+
+
+async def verify_stream(websocket):
+    """/verify/stream: JSON frames holding the events recorded since the previous frame come in
+    (see stream.py), and the /verify body goes out each time status, fraud_score or locked_until
+    changes. Every score is a full /verify of the session's windows: profile update, history row
+    and lock included."""
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    session = StreamSession()
+    interval = STREAM_SCORE_MS / 1000
+    due = None  # loop time at which the pending events are scored
+    scored_at = -interval
+    stream_counts["open"] += 1
+    try:
+        while True:
+            try:
+                timeout = None if due is None else max(0.0, due - loop.time())
+                message = await asyncio.wait_for(websocket.receive(), timeout)
+            except asyncio.TimeoutError:
+                message = None
+            if message is not None:
+                if message["type"] == "websocket.disconnect":
+                    return
+                stream_counts["frames"] += 1
+                try:
+                    if message.get("text") is None:
+                        raise StreamFormatError("frames are JSON text")
+                    session.apply(json.loads(message["text"]))
+                except ValueError as exc:  # StreamFormatError or a JSONDecodeError
+                    stream_counts["rejected"] += 1
+                    await websocket.send_text(json.dumps({"error": "bad frame: %s" % exc}))
+                    continue
+                if session.pending and due is None:
+                    due = max(loop.time(), scored_at + interval)
+            if due is None or loop.time() < due:
+                continue
+
+            timer = flask_app.metrics.timer("verify_stream")
+            payload = session.payload()
+            timer.mark("window")
+            try:
+                body = await verify_payload(payload, timer)
+            except (flask_app.PoolExhausted, WorkerBusy):
+                due = loop.time() + interval
+                await websocket.send_text(json.dumps({"error": "server busy, retrying"}))
+                continue
+            session.scored()
+            scored_at, due = loop.time(), None
+            stream_counts["scored"] += 1
+            if session.changed(body):
+                stream_counts["pushed"] += 1
+                await websocket.send_text(flask_wsgi.json.dumps(body))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        stream_counts["open"] -= 1
+
+
+class AdvertiseTelemetry:
+    """Adds the Accept-Post header app.py's after_request puts on /verify responses."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/verify":
+            return await self.app(scope, receive, send)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"accept-post", ACCEPT_POST)]
+            await send(message)
+        await self.app(scope, receive, send_with_header)
+
+
+def stats_snapshot():
+    result = flask_app.stats_snapshot()
+    result["async_pool"] = {
+        "size": pool.get_size(), "idle": pool.get_idle_size(),
+        "min": pool.get_min_size(), "max": pool.get_max_size(), "timeouts": pool_timeouts,
+    }
+    result["stream"] = dict(stream_counts, score_ms=STREAM_SCORE_MS)
+    return result
+
+
+async def stats(request):
+    return json_response(stats_snapshot())
+
+
+async def metrics(request):
+    # app.py's /metrics plus the asyncpg pool, which only this process mode has
+    return Response(flask_app.metrics.render(stats_snapshot()), media_type=flask_app.METRICS_CONTENT_TYPE)
+
+
+async def pool_exhausted(request, exc):
+    return json_response({"error":"database busy, retry shortly"}, 503)
+
+
+async def workers_busy(request, exc):
+    return json_response({"error":"server busy, retry shortly"}, 503)
+
+
+async def bad_telemetry(request, exc):
+    return json_response({"error":"bad telemetry: %s" % exc}, 400)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    # app.prepare() is blocking (psycopg2); with DB_MIGRATE=check an outdated schema stops startup here
+    await asyncio.get_running_loop().run_in_executor(None, flask_app.prepare)
+    pool = await asyncpg.create_pool(asyncpg_dsn(flask_app.DATABASE_URL),
+                                     min_size=ASYNC_POOL_MIN, max_size=ASYNC_POOL_MAX)
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/verify", verify, methods=["POST"]),
+        Route("/verify/batch", verify_batch, methods=["POST"]),
+        Route("/stats", stats),
+        Route("/metrics", metrics),
+        WebSocketRoute("/verify/stream", verify_stream),
+        Mount("/", app=WSGIMiddleware(flask_wsgi)),
+    ],
+    middleware=[Middleware(AdvertiseTelemetry), Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
+                           expose_headers=["X-Next-Cursor", "Accept-Post", "ETag", "X-Change-Version"])],
+    exception_handlers={flask_app.PoolExhausted: pool_exhausted, WorkerBusy: workers_busy,
+                        TelemetryFormatError: bad_telemetry},
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi:app", host=os.getenv("ASGI_HOST", "127.0.0.1"), port=int(os.getenv("ASGI_PORT", "5000")),
+                workers=int(os.getenv("ASGI_WORKERS", "1")), log_level="warning")
@@ -0,0 +1,152 @@
+# baseline.py - per-user behavioral baselines: online mean/variance and a quantile sketch per feature
+#
+# A baseline is one fixed-size record stored in users.baseline (BYTEA, BASELINE_DTYPE.itemsize
+# bytes) holding, for each of scoring.FEATURE_FIELDS:
+#
+#     mean, var   Welford for the first 1/ALPHA samples, then an EWMA with the EMA means' ALPHA,
+#                 so the baseline follows a user's drift as fast as the stored profile does
+#     hist        counts over BINS log-spaced buckets (sqrt(2) apart, [0, 1) up to 32768+),
+#                 halved whenever a feature's total reaches HIST_LIMIT so old sessions fade
+#
+# update() is O(1) in the number of sessions seen. score_batch() turns each feature into a
+# 0..1 deviation (how many standard deviations out, and how far into the tail of the user's
+# own distribution) and scales it by scoring.CAPS, so a naturally noisy user gets wide bands
+# and a very steady one narrow bands. Until a user has MIN_SAMPLES sessions the EMA scorer
+# answers instead.
+import numpy as np
+from scoring import FEATURE_FIELDS, CAPS, ALPHA, EmaScorer, score_batch as ema_score_batch, blend_scores
+
+VERSION = 1
+BINS = 32
+HIST_LIMIT = 4096
+MIN_SAMPLES = 10
+N_FEATURES = len(FEATURE_FIELDS)
+BASELINE_DTYPE = np.dtype([
+    ("version", "<u2"),
+    ("n", "<u4"),
+    ("mean", "<f4", (N_FEATURES,)),
+    ("var", "<f4", (N_FEATURES,)),
+    ("hist", "<u2", (N_FEATURES, BINS)),
+])
+# bucket k holds [EDGES[k], EDGES[k+1]); the last one is open-ended
+EDGES = np.concatenate([[0.0], np.sqrt(2.0) ** np.arange(BINS - 1)])
+
+Z_OK, Z_FULL = 1.0, 4.0  # within Z_OK standard deviations costs nothing, Z_FULL costs the full cap
+TAIL_OK = 0.05           # likewise for the share of the user's sessions further out than this one
+SPREAD_FLOOR = 0.1       # a near-constant feature still gets 10% of its mean (+1 unit) of slack
+
+
+def decode(blobs):
+    """Records for a list of users.baseline values. None, or a value from another version,
+    decodes to an empty baseline."""
+    recs = np.zeros(len(blobs), dtype=BASELINE_DTYPE)
+    for i, blob in enumerate(blobs):
+        if blob is not None and len(blob) == BASELINE_DTYPE.itemsize:
+            rec = np.frombuffer(blob, dtype=BASELINE_DTYPE)[0]
+            if rec["version"] == VERSION:
+                recs[i] = rec
+    return recs
+
+
+def _features(feats):
+    return np.array([[ft[k] for k in FEATURE_FIELDS] for ft in feats], dtype=float).reshape(-1, N_FEATURES)
+
+
+def _bins(x):
+    return np.clip(np.searchsorted(EDGES, x, side="right") - 1, 0, BINS - 1)
+
+
+def update(blob, feat):
+    """The users.baseline value after one more session with these features."""
+    rec = decode([blob])
+    x = _features([feat])[0]
+    n = int(rec["n"][0]) + 1
+    w = max(ALPHA, 1.0 / n)
+    mean = rec["mean"][0].astype(float)
+    delta = x - mean
+    rec["mean"][0] = mean + w * delta
+    rec["var"][0] = (1 - w) * (rec["var"][0] + w * delta * delta)
+    hist = rec["hist"][0]
+    hist[np.arange(N_FEATURES), _bins(x)] += 1
+    full = hist.sum(axis=1) >= HIST_LIMIT
+    hist[full] //= 2
+    rec["version"] = VERSION
+    rec["n"] = min(n, np.iinfo(np.uint32).max)
+    return rec.tobytes()
+
+
+def deviations(feats, recs):
+    """(len(feats), N_FEATURES) deviations in [0, 1] of each session from its user's baseline."""
+    x = _features(feats)
+    mean = recs["mean"].astype(float)
+    spread = np.maximum(np.sqrt(np.maximum(recs["var"].astype(float), 0.0)), SPREAD_FLOOR * np.abs(mean) + 1.0)
+    z = np.abs(x - mean) / spread
+    dz = np.clip((z - Z_OK) / (Z_FULL - Z_OK), 0.0, 1.0)
+
+    # share of the sketch below x, interpolating linearly inside x's bucket; the [0, 1) bucket
+    # (mostly "feature absent") and the open-ended last one count x as their midpoint
+    hist = recs["hist"].astype(float)
+    k = _bins(x)
+    cum = np.cumsum(hist, axis=2)
+    at = np.take_along_axis(hist, k[..., None], axis=2)[..., 0]
+    below = np.take_along_axis(cum, k[..., None], axis=2)[..., 0] - at
+    lo, hi = EDGES[k], EDGES[np.minimum(k + 1, BINS - 1)]
+    within = np.where((k > 0) & (k < BINS - 1), np.clip((x - lo) / np.where(hi > lo, hi - lo, 1.0), 0.0, 1.0), 0.5)
+    total = np.maximum(cum[..., -1], 1.0)
+    p = (below + within * at) / total
+    tail = np.minimum(p, 1.0 - p)
+    dq = np.clip((TAIL_OK - tail) / TAIL_OK, 0.0, 1.0)
+    return (dz + dq) / 2
+
+
+def score_batch(feats, profiles, blobs):
+    """Fraud scores (0-100 ints) like scoring.score_batch, from each user's baseline once it
+    has MIN_SAMPLES sessions and from the EMA profile before that."""
+    scores = ema_score_batch(feats, profiles)
+    if not len(feats):
+        return scores
+    recs = decode(blobs)
+    ready = recs["n"] >= MIN_SAMPLES
+    if not ready.any():
+        return scores
+    capped = deviations(feats, recs) * CAPS
+    score = np.zeros(len(feats))
+    for j in range(N_FEATURES):
+        score = score + capped[:, j]
+    return np.where(ready, blend_scores(score, feats), scores)
+
+
+def summary(blob):
+    """A users.baseline value as JSON numbers (for the admin views); None when empty."""
+    rec = decode([blob])[0]
+    if not rec["n"]:
+        return None
+    return {
+        "n": int(rec["n"]),
+        "features": {
+            f: {"mean": round(float(rec["mean"][j]), 2), "std": round(float(np.sqrt(max(rec["var"][j], 0.0))), 2)}
+            for j, f in enumerate(FEATURE_FIELDS)
+        },
+    }
+
+
+class BaselineScorer:
+    """SCORER=baseline: baseline.score_batch, keeping users.baseline up to date."""
+    name = "baseline"
+
+    def score(self, feats, profiles, users):
+        return score_batch(feats, profiles, [u.get("baseline") if u else None for u in users])
+
+    def update(self, user, feat):
+        return update(user.get("baseline") if user else None, feat)
+
+
+SCORERS = {"ema": EmaScorer(), "baseline": BaselineScorer()}
+
+
+def scorer_from_name(name):
+    # "ema" (perc_dev against the stored means) or "baseline"
+    try:
+        return SCORERS[name]
+    except KeyError:
+        raise ValueError("unknown SCORER %r (use %s)" % (name, " or ".join(SCORERS)))
@@ -0,0 +1,91 @@
+"""bench_batch.py
+Throughput of /verify/batch against one-at-a-time /verify for N = 1, 10, 100, 1000.
+Each size replays the same synthetic payloads (spread over N/4 users, so users repeat within a
+batch) through both endpoints for two fresh sets of users, twice: the first pass creates the
+users, the second is timed. Per-item results of both passes are compared. --scoring-only
+skips the database and times scoring.score_batch against scoring one item at a time.
+
+    python bench_batch.py
+    python bench_batch.py --scoring-only
+"""
+import argparse
+import time
+
+import bench_verify
+
+
+def make_items(n, seed):
+    payloads = bench_verify.session_payloads(n, seed)
+    users = max(1, n // 4)
+    for i, p in enumerate(payloads):
+        p["user_index"] = i % users
+    return payloads
+
+
+def scoring_only(sizes, repeat):
+    import scoring
+    print("%6s %16s %16s %8s" % ("N", "loop items/s", "batch items/s", "speedup"))
+    for n in sizes:
+        items = make_items(n, n)
+        feats = [scoring.parse_payload(p) for p in items]
+        profiles = [scoring.effective_profile(scoring.new_profile(f), f) for f in feats]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            single = [scoring.score_one(f, p) for f, p in zip(feats, profiles)]
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            batch = scoring.score_batch(feats, profiles).tolist()
+        vec = time.perf_counter() - start
+        assert single == batch
+        print("%6d %16.0f %16.0f %7.1fx" % (n, n * repeat / loop, n * repeat / vec, loop / vec))
+
+
+def endpoints(sizes):
+    import app
+    client = app.create_app().test_client()
+    app.prepare()
+    stamp = int(time.time())
+    print("%6s %16s %16s %8s %11s" % ("N", "/verify items/s", "batch items/s", "speedup", "mismatches"))
+    for n in sizes:
+        items = make_items(n, n)
+        single_prefix = "bsingle_%d_%d_" % (stamp, n)
+        batch_prefix = "bbatch_%d_%d_" % (stamp, n)
+
+        def key(r):
+            return (r["status"], r["fraud_score"], r.get("confidence"))
+
+        # pass 1 creates the users (one password hash each on /verify) and is not timed;
+        # pass 2 replays the same items against the now-existing profiles
+        mismatches = 0
+        for _ in range(2):
+            start = time.perf_counter()
+            single = []
+            for p in items:
+                body = dict(p, username=single_prefix + str(p["user_index"]))
+                single.append(client.post("/verify", json=body).get_json())
+            loop = time.perf_counter() - start
+
+            batch_items = [dict(p, username=batch_prefix + str(p["user_index"])) for p in items]
+            start = time.perf_counter()
+            batch = client.post("/verify/batch", json={"items": batch_items}).get_json()["results"]
+            vec = time.perf_counter() - start
+            mismatches += sum(1 for a, b in zip(single, batch) if key(a) != key(b))
+        print("%6d %16.0f %16.0f %7.1fx %11d" % (n, n / loop, n / vec, loop / vec, mismatches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1,10,100,1000")
+    parser.add_argument("--scoring-only", action="store_true")
+    parser.add_argument("--repeat", type=int, default=20, help="scoring-only repetitions")
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(",")]
+    if args.scoring_only:
+        scoring_only(sizes, args.repeat)
+    else:
+        endpoints(sizes)
+
+
+if __name__ == "__main__":
+    main()
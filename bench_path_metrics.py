@@ -0,0 +1,95 @@
+"""bench_path_metrics.py
+Per-call cost of path_metrics at 50, 500 and 5000 points.
+Times the previous list-comprehension implementation (kept below as legacy_path_metrics)
+against path_metrics.path_metrics on the list-of-dicts form script.js sends, the columnar
+{"x", "y", "t"} form (JSON lists) and an already-packed (n, 3) array, and checks all of them
+return the same metrics.
+
+    python bench_path_metrics.py
+    python bench_path_metrics.py --sizes 50,500,5000,50000 --repeat 500
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from path_metrics import path_metrics
+
+
+def legacy_path_metrics(path):
+    # the per-point version that used to live inside verify()
+    if not path or len(path) < 2: return {}
+    xs = np.array([p['x'] for p in path], dtype=float)
+    ys = np.array([p['y'] for p in path], dtype=float)
+    ts_arr = np.array([p['t'] for p in path], dtype=float)
+    dx = np.diff(xs)
+    dy = np.diff(ys)
+    dts = np.diff(ts_arr)/1000.0
+    dts[dts==0] = 0.001
+    dists = np.hypot(dx,dy)
+    speeds = dists / dts
+    total = float(np.sum(dists))
+    avg = float(np.mean(speeds)) if speeds.size else 0.0
+    var = float(np.var(speeds)) if speeds.size else 0.0
+    angles = np.arctan2(dy,dx)
+    ang_diff = np.abs(np.diff(angles))
+    ang_diff = np.minimum(ang_diff, 2*np.pi - ang_diff)
+    changes = float(np.sum(ang_diff > (np.pi/6)))
+    duration = float((ts_arr[-1] - ts_arr[0]) / 1000.0) if ts_arr.size else 1.0
+    dir_changes = changes / max(duration, 1.0)
+    hist, _ = np.histogram(angles, bins=12, range=(-np.pi, np.pi))
+    probs = hist / (hist.sum() if hist.sum() else 1)
+    entropy = float(-np.sum([p*np.log2(p) for p in probs if p>0])) if probs.size else 0.0
+    return {
+        "path_length": round(float(total), 2),
+        "avg_speed": round(float(avg),2),
+        "speed_var": round(float(var),2),
+        "direction_changes_per_sec": round(float(dir_changes),2),
+        "angular_entropy": round(float(entropy),2)
+    }
+
+
+def make_path(n, seed):
+    # random walk sampled like script.js: integer pixels, ~16 ms apart
+    rng = random.Random(seed)
+    x, y, t, path = 400, 300, 1700000000000, []
+    for _ in range(n):
+        x += rng.randint(-12, 12)
+        y += rng.randint(-12, 12)
+        t += rng.randint(8, 24)
+        path.append({"x": x, "y": y, "t": t})
+    return path
+
+
+def per_call_us(fn, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="50,500,5000")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    print("%7s %12s %12s %12s %12s %9s" % ("points", "legacy us", "dicts us", "columnar us", "packed us", "speedup"))
+    for n in [int(s) for s in args.sizes.split(",")]:
+        path = make_path(n, n)
+        columns = {k: [p[k] for p in path] for k in ("x", "y", "t")}
+        packed = np.column_stack([columns["x"], columns["y"], columns["t"]]).astype(float)
+        expected = legacy_path_metrics(path)
+        for form in (path, columns, packed):
+            assert path_metrics(form) == expected, (path_metrics(form), expected)
+        repeat = max(10, args.repeat * 50 // max(n, 50))
+        legacy = per_call_us(legacy_path_metrics, path, repeat)
+        dicts = per_call_us(path_metrics, path, repeat)
+        columnar = per_call_us(path_metrics, columns, repeat)
+        packed_us = per_call_us(path_metrics, packed, repeat)
+        print("%7d %12.1f %12.1f %12.1f %12.1f %8.1fx" % (n, legacy, dicts, columnar, packed_us, legacy / dicts))
+
+
+if __name__ == "__main__":
+    main()
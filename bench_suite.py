@@ -0,0 +1,316 @@
+"""bench_suite.py
+Per-endpoint benchmark of the request path, written as JSON to compare across commits.
+Generates synthetic behavioral sessions (around random typing profiles, or around the profiles
+and history in a users.json export with --seed-users) and drives register, login, verify,
+verify/batch, admin, admin/users/<user> and profiles through the Flask test client against
+DATABASE_URL (or --database), or the embedded store with STORAGE=sqlite:<path>, where there are
+no server round trips to count. For each endpoint it reports throughput, p50/p95/p99 latency, the
+database round trips the request thread made (statements plus commits), and memory allocated
+per request (tracemalloc, measured on every --alloc-every'th request, which is left out of the
+latency figures). The run's users and their history are deleted afterwards (--keep retains
+them) so runs against the same database stay comparable. Use a scratch database: /profiles
+reads every user, so its timings grow with the table, whose size is recorded under meta.database.
+
+    python bench_suite.py --out bench.json
+    python bench_suite.py --out new.json --compare bench.json      # exit 1 on regressions
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+import psycopg2
+from psycopg2 import extensions
+
+# settings that change what the request path does; recorded with every run
+CONFIG_VARS = ("STORAGE", "SCORER", "VERIFY_SINGLE_TRIP", "PROFILE_CACHE_SIZE", "HISTORY_ASYNC", "LOGIN_GUARD",
+               "WORKER_AUTH_PROCESSES", "WORKER_SCORE_PROCESSES", "DB_POOL_MAX", "HISTORY_PARTITION", "METRICS",
+               "METRICS_PROFILE_HZ")
+# metric -> +1 when bigger is worse, -1 when smaller is worse
+DIRECTIONS = {"throughput_rps": -1, "p50_ms": 1, "p95_ms": 1, "p99_ms": 1, "db_round_trips": 1,
+              "alloc_peak_kib": 1}
+
+_round_trips = Counter()  # thread ident -> statements and transaction ends sent to the server
+_cursor_classes = {}
+
+
+def _count():
+    _round_trips[threading.get_ident()] += 1
+
+
+class CountingConnection(extensions.connection):
+    def commit(self):
+        if self.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            _count()
+        return super().commit()
+
+    def rollback(self):
+        if self.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            _count()
+        return super().rollback()
+
+
+def counting_cursor(base):
+    # a subclass of the app's cursor class (RealDictCursor) that counts what it sends
+    if base not in _cursor_classes:
+        class CountingCursor(base):
+            def execute(self, *args, **kwargs):
+                _count()
+                return super().execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                _count()
+                return super().executemany(*args, **kwargs)
+
+            def callproc(self, *args, **kwargs):
+                _count()
+                return super().callproc(*args, **kwargs)
+
+        _cursor_classes[base] = CountingCursor
+    return _cursor_classes[base]
+
+
+def install_counters():
+    """Make every psycopg2 connection opened from now on count round trips. The app's pool is
+    lazy and opens its first connections in app.prepare(), and db_pool looks up psycopg2.connect
+    on each connect, so this has to run before prepare() (or the first request)."""
+    connect = psycopg2.connect
+
+    def counting_connect(*args, **kwargs):
+        kwargs["connection_factory"] = CountingConnection
+        kwargs["cursor_factory"] = counting_cursor(kwargs.get("cursor_factory") or extensions.cursor)
+        return connect(*args, **kwargs)
+
+    psycopg2.connect = counting_connect
+
+
+def personas(seed_users, rng):
+    """Typing profiles to draw sessions around: from a users.json export, or random."""
+    found = []
+    if seed_users:
+        with open(seed_users) as f:
+            for user in json.load(f).values():
+                rows = user.get("history") or [{}]
+                prof = user.get("profile") or {}
+                for h in rows:
+                    found.append({
+                        "flight": h.get("flight") or prof.get("flight_mean") or 180.0,
+                        "dwell": h.get("dwell") or prof.get("dwell_mean") or 95.0,
+                        "mouse_speed": h.get("mouse_speed") or prof.get("mouse_mean") or 8.0,
+                        "touch_speed": h.get("touch_speed") or prof.get("touch_mean") or 0.0,
+                        "scrolls": h.get("scrolls") or prof.get("scroll_mean") or 0,
+                        "scroll_speed": h.get("scroll_speed") or prof.get("scroll_speed") or 0.0,
+                    })
+    if not found:
+        found = [{"flight": rng.uniform(120, 260), "dwell": rng.uniform(70, 140), "mouse_speed": rng.uniform(3, 12),
+                  "touch_speed": 0.0, "scrolls": rng.randint(0, 20), "scroll_speed": rng.uniform(0, 300)}
+                 for _ in range(16)]
+    return found
+
+
+def session(persona, ts, rng):
+    """One /verify payload: ~40 keystrokes and a mouse path drawn around the persona."""
+    path = []
+    x, y = rng.randint(0, 800), rng.randint(0, 600)
+    for j in range(rng.randint(20, 200)):
+        x += rng.randint(-15, 15)
+        y += rng.randint(-15, 15)
+        path.append({"x": x, "y": y, "t": ts - 3000 + j * 50})
+    jitter = lambda v: max(0.0, v * rng.uniform(0.9, 1.1))
+    return {
+        "flight": [max(1.0, rng.gauss(persona["flight"], persona["flight"] * 0.2)) for _ in range(40)],
+        "dwell": [max(1.0, rng.gauss(persona["dwell"], persona["dwell"] * 0.2)) for _ in range(40)],
+        "mouse_speed": round(jitter(persona["mouse_speed"]), 1),
+        "mouse_path": path,
+        "touch_speed": round(jitter(persona["touch_speed"]), 1),
+        "click_positions": [{"x": rng.randint(0, 800), "y": rng.randint(0, 600), "t": ts}],
+        "clicks": rng.randint(0, 5),
+        "scrolls": int(persona["scrolls"]),
+        "scroll_speed": round(jitter(persona["scroll_speed"]), 1),
+        "scroll_speeds": [],
+        "fraud_score": rng.randint(0, 30),
+        "ts": ts,
+    }
+
+
+def workload(args, prefix, rng):
+    """(endpoint, [(method, path, json body or None), ...]) in the order they are run."""
+    people = personas(args.seed_users, rng)
+    users = ["%s%d" % (prefix, i) for i in range(args.users)]
+    persona = {u: people[i % len(people)] for i, u in enumerate(users)}
+    t0 = int(time.time() * 1000)
+    clock = iter(range(t0, t0 + 10 ** 9, 3000))
+
+    plan = [("register", [("POST", "/register", dict(session(persona[u], next(clock), rng), username=u,
+                                                     password="bench-password")) for u in users])]
+    plan.append(("login", [("POST", "/login", {"username": u, "password": "bench-password"})
+                           for _ in range(args.logins) for u in users]))
+    plan.append(("verify", [("POST", "/verify", dict(session(persona[u], next(clock), rng), username=u))
+                            for _ in range(args.sessions) for u in users]))
+    batches = []
+    for _ in range(args.batches):
+        items = [dict(session(persona[u], next(clock), rng), username=u)
+                 for u in (rng.choice(users) for _ in range(args.batch_size))]
+        batches.append(("POST", "/verify/batch", {"items": items}))
+    plan.append(("verify_batch", batches))
+    # the cursor starts the page at this run's users, whatever else the database holds
+    plan.append(("admin", [("GET", "/admin?limit=%d&history=20&cursor=%s" % (args.users, prefix), None)] * args.reads))
+    plan.append(("admin_user", [("GET", "/admin/users/%s?history=50" % users[i % len(users)], None)
+                                for i in range(args.reads)]))
+    plan.append(("profiles", [("GET", "/profiles", None)] * args.reads))
+    return plan
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))] if values else 0.0
+
+
+def measure(client, requests, alloc_every):
+    me = threading.get_ident()
+    latencies, trips, allocs, errors = [], [], [], Counter()
+    for i, (method, path, body) in enumerate(requests):
+        sample = alloc_every > 0 and i % alloc_every == alloc_every - 1
+        before = _round_trips[me]
+        if sample:
+            tracemalloc.start()
+        start = time.perf_counter()
+        res = client.open(path, method=method, json=body)
+        elapsed = time.perf_counter() - start
+        if sample:
+            allocs.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+            tracemalloc.stop()
+        else:
+            latencies.append(elapsed * 1000)
+        trips.append(_round_trips[me] - before)
+        if res.status_code >= 400:
+            errors[str(res.status_code)] += 1
+    return {
+        "requests": len(requests),
+        "errors": dict(errors),
+        "throughput_rps": round(len(latencies) / (sum(latencies) / 1000.0), 1) if latencies else 0.0,
+        "p50_ms": round(pct(latencies, 50), 3),
+        "p95_ms": round(pct(latencies, 95), 3),
+        "p99_ms": round(pct(latencies, 99), 3),
+        "db_round_trips": round(sum(trips) / float(len(trips)), 2) if trips else 0.0,
+        "alloc_peak_kib": round(pct(allocs, 50), 1) if allocs else None,
+    }
+
+
+def database_size(app):
+    with app.store.transaction(readonly=True) as tx:
+        return tx.counts()
+
+
+def cleanup(app, prefix):
+    if app.profile_cache:
+        app.profile_cache.flush()
+    if app.history_writer:
+        app.history_writer.stop()  # drains the queue; the run is over anyway
+    with app.store.transaction() as tx:
+        tx.delete_users(prefix)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, tolerance):
+    """Print new against old per endpoint and metric; returns the regressions found."""
+    regressions = []
+    print("%-14s %-16s %12s %12s %8s" % ("endpoint", "metric", "old", "new", "change"))
+    for endpoint, metrics in new["endpoints"].items():
+        before = old.get("endpoints", {}).get(endpoint)
+        if not before:
+            continue
+        for metric, direction in DIRECTIONS.items():
+            a, b = before.get(metric), metrics.get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else (0.0 if b == a else float("inf"))
+            # round trips are counts: any increase is a regression
+            worse = direction * change > (0 if metric == "db_round_trips" else tolerance)
+            if worse:
+                regressions.append((endpoint, metric, a, b))
+            print("%-14s %-16s %12s %12s %+7.1f%%%s" % (endpoint, metric, a, b, change * 100, "  <-" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--database", help="Postgres URL (default: DATABASE_URL)")
+    parser.add_argument("--seed-users", help="users.json export to draw typing profiles from")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=2, help="logins per user")
+    parser.add_argument("--sessions", type=int, default=20, help="/verify calls per user")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=30, help="requests per admin/profiles endpoint")
+    parser.add_argument("--alloc-every", type=int, default=10, help="trace allocations on every Nth request (0: never)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier --out file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown (default 0.15)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated users and history")
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ["DATABASE_URL"] = args.database
+    install_counters()
+    import app
+
+    rng = random.Random(args.seed)
+    prefix = "bench_%d_" % int(time.time())
+    client = app.create_app().test_client()
+    # the one-time setup (scorer import, schema check) stays out of the first endpoint's numbers
+    app.prepare()
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "started": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "database")},
+            "config": {k: os.environ[k] for k in CONFIG_VARS if k in os.environ},
+            "database": database_size(app),
+            "startup": dict(app.startup),
+        },
+        "endpoints": {},
+    }
+    try:
+        for endpoint, requests in workload(args, prefix, rng):
+            stats = measure(client, requests, args.alloc_every)
+            result["endpoints"][endpoint] = stats
+            print("%-14s %5d req %9.1f req/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %5.2f trips  %8.1f KiB" % (
+                endpoint, stats["requests"], stats["throughput_rps"], stats["p50_ms"], stats["p95_ms"],
+                stats["p99_ms"], stats["db_round_trips"], stats["alloc_peak_kib"] or 0.0))
+    finally:
+        if not args.keep:
+            cleanup(app, prefix)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print("wrote %s" % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, result, args.tolerance)
+        if regressions:
+            print("%d regression(s) beyond %.0f%%" % (len(regressions), args.tolerance * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""bench_telemetry.py
+Body size and server-side parse time of a full script.js /verify payload: JSON vs binary frame,
+raw arrays vs summary mode. The payload has script.js's maximum buffers (500 flight/dwell values,
+500-point mouse/touch paths and clicks, 1000 key timestamps). "parse" is decoding the body plus
+scoring.parse_payload, i.e. everything /verify does before touching the database. Also checks
+the features match (summary mode to within the audit tolerance, see scoring._audit).
+
+    python bench_telemetry.py
+    python bench_telemetry.py --repeat 2000
+"""
+import argparse
+import base64
+import json
+import random
+import time
+
+from path_metrics import summarize_path
+from scoring import parse_payload, summarize_values, _audit
+from telemetry import decode_telemetry, encode_telemetry, unpack_fields
+
+
+def full_payload(seed):
+    rng = random.Random(seed)
+    now = 1700000000000
+
+    def points(n, step_ms):
+        x, y, t, out = 600, 400, now - n * step_ms, []
+        for _ in range(n):
+            x += rng.randint(-20, 20)
+            y += rng.randint(-20, 20)
+            t += step_ms + rng.randint(0, 30)
+            out.append({"x": x, "y": y, "t": t})
+        return out
+
+    keys = sorted(now - rng.randint(0, 120000) for _ in range(1000))
+    return {
+        "username": "bench_user",
+        "flight": [rng.randint(60, 400) for _ in range(500)],
+        "dwell": [rng.randint(40, 160) for _ in range(500)],
+        "chars_timestamps": keys,
+        "mouse_speed": 412, "mouse_var": 0,
+        "mouse_path": points(500, 50),
+        "mouse_metrics": {"path_length": 9120, "avg_speed": 388, "speed_var": 20211,
+                          "direction_changes_per_sec": 3.4, "angular_entropy": 3.21},
+        "touch_speed": 0, "touch_path": points(500, 16),
+        "touch_metrics": {"path_length": 0, "avg_speed": 0, "speed_var": 0,
+                          "direction_changes_per_sec": 0, "angular_entropy": 0},
+        "click_positions": points(500, 900), "clicks": 500,
+        "scrolls": 80, "scroll_speeds": [round(rng.uniform(0, 2500), 3) for _ in range(500)],
+        "scroll_speed": 640, "idle_ms": 1200, "fraud_score": 12,
+        "ts": now,
+    }
+
+
+def summary_payload(payload):
+    # what script.js posts with SEND_SUMMARIES: sketches instead of the raw windows, and only
+    # the clicks / scroll speeds since the previous post (a 3 s interval's worth)
+    summary = dict(payload, summary={
+        "flight": summarize_values(payload["flight"]), "dwell": summarize_values(payload["dwell"]),
+        "mouse_path": summarize_path(payload["mouse_path"]), "touch_path": summarize_path(payload["touch_path"]),
+    }, click_positions=payload["click_positions"][-3:], scroll_speeds=payload["scroll_speeds"][-10:])
+    for key in ("flight", "dwell", "mouse_path", "touch_path", "chars_timestamps"):
+        del summary[key]
+    return summary
+
+
+def per_call_us(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repeat", type=int, default=300)
+    args = parser.parse_args()
+
+    payload = full_payload(1)
+    as_json = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    frame = encode_telemetry(payload)
+    as_packed = json.dumps({"packed": base64.b64encode(frame).decode("ascii")}).encode("utf-8")
+
+    summary = summary_payload(payload)
+    summary_json = json.dumps(summary, separators=(",", ":")).encode("utf-8")
+    summary_frame = encode_telemetry(summary)
+
+    expected = parse_payload(json.loads(as_json))
+    assert parse_payload(decode_telemetry(frame)) == expected
+    assert parse_payload(unpack_fields(json.loads(as_packed))) == expected
+    assert not _audit(expected, summary["summary"])
+
+    forms = [
+        ("json", as_json, lambda: parse_payload(json.loads(as_json))),
+        ("binary", frame, lambda: parse_payload(decode_telemetry(frame))),
+        ("json+packed", as_packed, lambda: parse_payload(unpack_fields(json.loads(as_packed)))),
+        ("summary json", summary_json, lambda: parse_payload(json.loads(summary_json))),
+        ("summary bin", summary_frame, lambda: parse_payload(decode_telemetry(summary_frame))),
+    ]
+    print("%-14s %10s %12s" % ("body", "bytes", "parse us"))
+    for name, body, parse in forms:
+        print("%-14s %10d %12.1f" % (name, len(body), per_call_us(parse, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
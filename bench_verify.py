@@ -0,0 +1,94 @@
+"""bench_verify.py
+Latency comparison of the classic multi-statement /verify against VERIFY_SINGLE_TRIP.
+Replays the same synthetic session against two fresh users (one per mode) through the Flask
+test client, checks that every response carries the same status and fraud_score, and prints
+latency percentiles. Point DATABASE_URL at the database you want to measure (NeonDB shows the
+round-trip savings; a local Postgres mostly shows the CPU side).
+
+    python bench_verify.py --requests 200
+"""
+import argparse
+import random
+import time
+
+import app
+
+
+def session_payloads(n, seed):
+    rng = random.Random(seed)
+    payloads = []
+    t0 = int(time.time() * 1000)
+    for i in range(n):
+        ts = t0 + i * 3000
+        path = []
+        x, y = rng.randint(0, 800), rng.randint(0, 600)
+        for j in range(rng.randint(20, 200)):
+            x += rng.randint(-15, 15)
+            y += rng.randint(-15, 15)
+            path.append({"x": x, "y": y, "t": ts - 3000 + j * 50})
+        # the second-to-last request types like someone else and locks the account,
+        # the last one then hits the lock check
+        scale = 5 if i == n - 2 else 1
+        payloads.append({
+            "flight": [scale * rng.gauss(180, 40) for _ in range(40)],
+            "dwell": [scale * rng.gauss(95, 20) for _ in range(40)],
+            "mouse_speed": round(scale * rng.uniform(3, 12), 1),
+            "mouse_path": path,
+            "touch_speed": 0,
+            "click_positions": [{"x": rng.randint(0, 800), "y": rng.randint(0, 600), "t": ts}],
+            "clicks": rng.randint(0, 5),
+            "scrolls": rng.randint(0, 20),
+            "scroll_speed": round(rng.uniform(0, 300), 1),
+            "scroll_speeds": [],
+            "fraud_score": rng.randint(0, 30),
+            "ts": ts,
+        })
+    return payloads
+
+
+def run(mode_single_trip, username, payloads):
+    app.VERIFY_SINGLE_TRIP = mode_single_trip
+    client = app.create_app().test_client()
+    app.prepare()
+    latencies, bodies = [], []
+    for p in payloads:
+        body = dict(p, username=username)
+        start = time.perf_counter()
+        res = client.post("/verify", json=body)
+        latencies.append((time.perf_counter() - start) * 1000)
+        bodies.append(res.get_json())
+    return latencies, bodies
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    payloads = session_payloads(args.requests, args.seed)
+    stamp = int(time.time())
+    results = {}
+    for mode in (False, True):
+        name = "single-trip" if mode else "classic"
+        results[name] = run(mode, "bench_%s_%d" % (name.replace("-", "_"), stamp), payloads)
+
+    mismatches = 0
+    for a, b in zip(results["classic"][1], results["single-trip"][1]):
+        if (a["status"], a["fraud_score"]) != (b["status"], b["fraud_score"]):
+            mismatches += 1
+
+    print("%-12s %8s %8s %8s %8s" % ("mode", "mean", "p50", "p95", "p99"))
+    for name, (lat, _) in results.items():
+        print("%-12s %7.2fms %7.2fms %7.2fms %7.2fms" % (
+            name, sum(lat) / len(lat), pct(lat, 50), pct(lat, 95), pct(lat, 99)))
+    print("responses compared: %d, status/fraud_score mismatches: %d" % (len(payloads), mismatches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+# bulk_import.py - load users from JSON, NDJSON or CSV into STORAGE, in resumable chunks
+#
+#     python bulk_import.py users.ndjson [--format ndjson] [--chunk 5000] [--processes 8]
+#
+# (and POST /admin/import, see app.py). Each record is one account: a username; a plaintext
+# password (hashed here, on every core), a password_hash carried over from another system, or
+# neither, for an account without a password; and optionally role, status, fraud, last_update,
+# the profile fields (at the top level or under "profile") and, in the JSON formats, a history
+# list. A legacy users.json, the object {username: {...}}, reads as one record per key.
+#
+# Records go in chunks, one write transaction each: one query finds the usernames already taken,
+# the remaining passwords are hashed before the transaction opens, and the rows go in through
+# load_users()/load_history() (COPY on Postgres). Usernames already present are skipped, never
+# overwritten, so a chunk repeated after an interruption only skips; --state records how far the
+# committed chunks reach, and a rerun starts after them.
+import os, csv, sys, json, math
+from collections import deque
+from time import perf_counter
+from werkzeug.security import generate_password_hash
+from history_queue import HISTORY_COLUMNS
+from storage import PROFILE_FIELDS, HISTORY_JSON, storage_from_url
+
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "5000"))
+# passwords per worker task; at ~130 ms a hash this keeps a task well inside WORKER_TIMEOUT
+HASH_BATCH = 4
+FORMATS = ("json", "ndjson", "csv")
+CONTENT_TYPES = {"application/json": "json", "application/x-ndjson": "ndjson", "text/csv": "csv"}
+ROLES = ("customer", "admin")
+# what register, /login and /verify leave in users.status and user_history.status
+STATUSES = ("Registered", "Profiled", "Admin", "Authenticated", "Suspicious", "Fraud Detected", "Locked")
+# the columns' types: INTEGER, BIGINT (ts, last_update) and REAL
+INT_BITS = 32
+REAL_MAX = 3.4e38
+MAX_USERNAME = 255
+
+
+class RecordError(ValueError):
+    """A record that cannot become a users row; reported with its position and skipped."""
+
+
+def format_for(path):
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    return {"jsonl": "ndjson"}.get(ext, ext)
+
+
+def read_records(stream, fmt):
+    """(position, record) pairs from a text stream, positions counting from 1. A body that is not
+    in `fmt` at all raises ValueError here; NDJSON and CSV are then read a line at a time, JSON
+    is parsed whole. An NDJSON line that does not parse yields a RecordError for its record."""
+    if fmt == "json":
+        data = json.load(stream)
+        if isinstance(data, dict):
+            # legacy users.json: {username: {...}}
+            data = [dict(u, username=name) if isinstance(u, dict) else u for name, u in data.items()]
+        if not isinstance(data, list):
+            raise ValueError("a JSON import is an object of users by username or a list of users")
+        return enumerate(data, 1)
+    if fmt == "ndjson":
+        return _ndjson_records(stream)
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        if "username" not in (reader.fieldnames or ()):
+            raise ValueError("a CSV import needs a header row with a username column")
+        return enumerate(reader, 1)
+    raise ValueError("format must be one of: %s" % ", ".join(FORMATS))
+
+
+def _ndjson_records(stream):
+    position = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        position += 1
+        try:
+            yield position, json.loads(line)
+        except ValueError as err:
+            yield position, RecordError("not JSON: %s" % err)
+
+
+def _text(record, key, default=None):
+    value = record.get(key)
+    if value is None or value == "":
+        return default
+    if not isinstance(value, str) or "\x00" in value:
+        raise RecordError("%s must be a string" % key)
+    return value
+
+
+def _number(record, key, cast=float, default=0, bits=INT_BITS):
+    # CSV cells arrive as strings; a blank one takes the column default. Anything the column
+    # would refuse is caught here, since on Postgres one bad value fails the chunk's whole COPY
+    value = record.get(key)
+    if value is None or value == "":
+        return default
+    error = RecordError("%s must be %s" % (key, "an integer" if cast is int else "a number"))
+    if isinstance(value, bool) or cast is int and isinstance(value, float) and not value.is_integer():
+        raise error
+    try:
+        value = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise error from None
+    if cast is int and not -2 ** (bits - 1) <= value < 2 ** (bits - 1):
+        raise error
+    if cast is float and not (math.isfinite(value) and abs(value) <= REAL_MAX):
+        raise error
+    return value
+
+
+def _status(record, default=None):
+    status = _text(record, "status", default)
+    if status is not None and status not in STATUSES:
+        raise RecordError("status must be one of: %s" % ", ".join(STATUSES))
+    return status
+
+
+def _history_row(username, entry):
+    """Parameters for history_queue.INSERT_HISTORY_SQL from one history entry; a missing column
+    other than ts is NULL."""
+    if not isinstance(entry, dict):
+        raise RecordError("history entries must be objects")
+    if entry.get("ts") is None:
+        raise RecordError("history entries need a ts")
+    row = []
+    for c in HISTORY_COLUMNS:
+        if c == "username":
+            row.append(username)
+        elif c == "status":
+            row.append(_status(entry))
+        elif c in HISTORY_JSON:
+            value, shape = entry.get(c), dict if c.endswith("metrics") else list
+            if value is not None and not isinstance(value, shape):
+                raise RecordError("history %s must be %s" % (c, "an object" if shape is dict else "a list"))
+            try:
+                row.append(None if value is None else json.dumps(value, allow_nan=False))
+            except ValueError:
+                raise RecordError("history %s must not hold NaN or Infinity" % c) from None
+        elif c in ("ts", "scrolls", "clicks", "fraud"):
+            row.append(_number(entry, c, int, None, 64 if c == "ts" else INT_BITS))
+        else:
+            row.append(_number(entry, c, float, None))
+    return tuple(row)
+
+
+def normalize(record):
+    """(users row with LOAD_COLUMNS, plaintext password or None, user_history rows) for one
+    record, or RecordError."""
+    if isinstance(record, RecordError):
+        raise record
+    if not isinstance(record, dict):
+        raise RecordError("record must be an object")
+    username = _text(record, "username")
+    if username is None or len(username) > MAX_USERNAME:
+        raise RecordError("username must be 1-%d characters" % MAX_USERNAME)
+    password, password_hash = _text(record, "password"), _text(record, "password_hash")
+    if password is not None and password_hash is not None:
+        raise RecordError("give password or password_hash, not both")
+    if password_hash is not None and password_hash.count("$") < 2:
+        raise RecordError("password_hash must be a werkzeug hash (method$salt$hash)")
+    role = _text(record, "role", "customer")
+    if role not in ROLES:
+        raise RecordError("role must be one of: %s" % ", ".join(ROLES))
+
+    profile = record.get("profile") or record
+    if not isinstance(profile, dict):
+        raise RecordError("profile must be an object")
+    row = {k: _number(profile, k, int if k == "scroll_mean" else float) for k in PROFILE_FIELDS}
+    # with neither, the account has no password (like users /verify creates), as in users.json
+    row.update(username=username, password_hash=password_hash or "", role=role,
+               status=_status(record, "Admin" if role == "admin" else "Registered"),
+               fraud=_number(record, "fraud", int), last_update=_number(record, "last_update", int, bits=64))
+
+    history = record.get("history") or []
+    if not isinstance(history, list):
+        raise RecordError("history must be a list")
+    return row, password, [_history_row(username, h) for h in history]
+
+
+def hash_passwords(passwords):
+    # runs in a worker process
+    return [generate_password_hash(p) for p in passwords]
+
+
+def hash_all(lane, passwords):
+    """hash_passwords() over a WorkerLane's processes, HASH_BATCH at a time and never more tasks
+    in flight than the lane accepts; a disabled lane (or none) hashes on this thread."""
+    if lane is None or not lane.enabled:
+        return hash_passwords(passwords)
+    window = min(lane.processes * 2, lane.processes + lane.max_queue)
+    futures, hashed = deque(), []
+    for i in range(0, len(passwords), HASH_BATCH):
+        if len(futures) >= window:
+            hashed.extend(lane.result(futures.popleft()))
+        futures.append(lane.submit(hash_passwords, passwords[i:i + HASH_BATCH]))
+    while futures:
+        hashed.extend(lane.result(futures.popleft()))
+    return hashed
+
+
+def load_chunk(store, batch, lane=None):
+    """Load one chunk of (position, record) pairs. Returns (users rows inserted, users skipped,
+    errors [{record, username, error}]). A username repeated in the input, like one already
+    stored, keeps its first record."""
+    errors, users, repeated = [], {}, 0
+    for position, record in batch:
+        try:
+            row, password, history = normalize(record)
+        except RecordError as err:
+            username = record.get("username") if isinstance(record, dict) else None
+            errors.append({"record": position, "username": username if isinstance(username, str) else None,
+                           "error": str(err)})
+            continue
+        if row["username"] in users:
+            repeated += 1
+            continue
+        users[row["username"]] = (row, password, history)
+
+    with store.transaction(readonly=True) as tx:
+        taken = tx.existing_usernames(users) if users else set()
+    fresh = [users[name] for name in users if name not in taken]
+    # hashed before the write transaction, which on SQLite holds the write lock until commit
+    plain = [(row, password) for row, password, _ in fresh if password is not None]
+    for (row, _), password_hash in zip(plain, hash_all(lane, [password for _, password in plain])):
+        row["password_hash"] = password_hash
+
+    inserted = []
+    if fresh:
+        with store.transaction() as tx:
+            names = tx.load_users([row for row, _, _ in fresh])
+            inserted = [row for row, _, _ in fresh if row["username"] in names]
+            history = [h for row, _, rows in fresh if row["username"] in names for h in rows]
+            if history:
+                tx.load_history(history)
+    # skipped: stored before the check, taken by a concurrent insert since, or repeated
+    return inserted, len(users) - len(inserted) + repeated, errors
+
+
+def import_users(store, records, lane=None, chunk=IMPORT_CHUNK, skip=0):
+    """Load (position, record) pairs, `chunk` per transaction, after the first `skip` positions.
+    Yields after each committed chunk: (progress, users rows inserted, that chunk's errors), where
+    progress holds running totals and `records`, the position to pass as `skip` to resume."""
+    progress = {"records": skip, "imported": 0, "skipped": 0, "errors": 0}
+    batch = []
+    for position, record in records:
+        if position <= skip:
+            continue
+        batch.append((position, record))
+        if len(batch) < chunk:
+            continue
+        yield _advance(progress, store, batch, lane)
+        batch = []
+    if batch:
+        yield _advance(progress, store, batch, lane)
+
+
+def _advance(progress, store, batch, lane):
+    inserted, skipped, errors = load_chunk(store, batch, lane)
+    progress.update(records=batch[-1][0], imported=progress["imported"] + len(inserted),
+                    skipped=progress["skipped"] + skipped, errors=progress["errors"] + len(errors))
+    return dict(progress), inserted, errors
+
+
+def _save_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    import argparse
+    from dotenv import load_dotenv
+    from workers import WorkerLane
+
+    parser = argparse.ArgumentParser(description="bulk-load users from JSON, NDJSON or CSV into STORAGE")
+    parser.add_argument("path", help="file to load")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    parser.add_argument("--chunk", type=int, default=IMPORT_CHUNK, help="records per transaction")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="password-hashing processes (0 hashes inline)")
+    parser.add_argument("--state", help="checkpoint file (default: PATH.import-state)")
+    parser.add_argument("--errors", help="rejected records, one JSON line each (default: PATH.errors.ndjson)")
+    args = parser.parse_args(argv)
+    fmt = args.format or format_for(args.path)
+    if fmt not in FORMATS:
+        parser.error("cannot tell the format of %s; pass --format" % args.path)
+    if args.chunk < 1:
+        parser.error("--chunk must be positive")
+    state_path = args.state or args.path + ".import-state"
+    errors_path = args.errors or args.path + ".errors.ndjson"
+
+    load_dotenv()
+    # forked before any connection is opened (see WorkerLane.start)
+    lane = WorkerLane("import", processes=max(args.processes, 0), timeout=600.0).start()
+    url = os.getenv("STORAGE", "postgres")
+    connect = None
+    if url == "postgres":
+        import psycopg2
+        from psycopg2.extras import RealDictCursor
+        dsn = os.environ["DATABASE_URL"]
+        connect = lambda: psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    store = storage_from_url(url, connect)
+    for shard in store.shards.values() if store.name == "sharded" else [store]:
+        if shard.name == "sqlite":
+            shard.init()
+
+    state = {"path": os.path.abspath(args.path), "records": 0, "imported": 0, "skipped": 0, "errors": 0}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            saved = json.load(f)
+        if saved.get("path") != state["path"]:
+            sys.exit("%s belongs to an import of %s; remove it or pass another --state" % (state_path, saved.get("path")))
+        state = saved
+        print("resuming after record %d" % state["records"], file=sys.stderr)
+    elif os.path.exists(errors_path):
+        os.remove(errors_path)  # left by an earlier, finished import
+
+    started = perf_counter()
+    totals = state
+    try:
+        with open(args.path, newline="" if fmt == "csv" else None, encoding="utf-8") as f:
+            try:
+                records = read_records(f, fmt)
+            except ValueError as err:
+                sys.exit("%s: %s" % (args.path, err))
+            for progress, _, errors in import_users(store, records, lane, args.chunk, skip=state["records"]):
+                if errors:
+                    with open(errors_path, "a") as errors_file:
+                        errors_file.writelines(json.dumps(error) + "\n" for error in errors)
+                totals = dict(state, records=progress["records"],
+                              **{k: state[k] + progress[k] for k in ("imported", "skipped", "errors")})
+                _save_state(state_path, totals)
+                rate = (progress["records"] - state["records"]) / (perf_counter() - started)
+                print("%d records: %d imported, %d skipped, %d errors (%.0f records/s)"
+                      % (totals["records"], totals["imported"], totals["skipped"], totals["errors"], rate),
+                      file=sys.stderr)
+    finally:
+        lane.shutdown(wait=True)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    print("imported %d users in %.1fs (%d already present, skipped)"
+          % (totals["imported"], perf_counter() - started, totals["skipped"]))
+    if totals["errors"]:
+        print("%d records rejected, listed in %s" % (totals["errors"], errors_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# db_pool.py - bounded psycopg2 connection pool with checkout health checks
+import os, threading
+from time import monotonic
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection frees up within the checkout timeout."""
+
+
+class PooledConnection:
+    """Proxy around a psycopg2 connection; close() hands it back to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.putconn(self._raw)
+
+    def discard(self):
+        if not self._released:
+            self._released = True
+            self._pool.putconn(self._raw, discard=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and not self._raw.closed:
+            self._raw.commit()
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, check_idle=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []  # (raw connection, last released at) - LIFO keeps hot connections hot
+        self._in_use = 0
+        self._closed = False
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "health_failures": 0,
+            "peak_in_use": 0,
+        }
+        # No connections are opened here: fill() tops the pool up once the app is first prepared,
+        # so building the pool (and importing whatever builds it) never waits on the server.
+
+    def fill(self):
+        """Open connections until minconn are idle; returns how many were opened."""
+        opened = 0
+        while True:
+            with self._cond:
+                if self._closed or len(self._idle) >= self.minconn or self._in_use + len(self._idle) >= self.maxconn:
+                    return opened
+            raw = self._connect()
+            with self._cond:
+                self._idle.append((raw, monotonic()))
+            opened += 1
+
+    @classmethod
+    def from_env(cls, dsn, **connect_kwargs):
+        return cls(
+            dsn,
+            minconn=int(os.getenv("DB_POOL_MIN", "1")),
+            maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+            check_idle=float(os.getenv("DB_POOL_CHECK_IDLE", "30")),
+            **connect_kwargs
+        )
+
+    def _connect(self):
+        raw = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        self._counters["created"] += 1
+        return raw
+
+    def _close_raw(self, raw):
+        self._counters["discarded"] += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _healthy(self, raw, idle_for):
+        # Cheap local checks first; only ping the server when the connection sat idle long enough
+        # for a NAT/pooler/server-side timeout to have dropped it.
+        if raw.closed:
+            return False
+        status = raw.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                raw.rollback()
+            except Exception:
+                return False
+        if idle_for < self.check_idle:
+            return True
+        self._counters["health_checks"] += 1
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            raw.rollback()
+            return True
+        except Exception:
+            self._counters["health_failures"] += 1
+            return False
+
+    def getconn(self):
+        deadline = monotonic() + self.timeout
+        waited = False
+        started = monotonic()
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolExhausted("connection pool is closed")
+                if self._idle or self._in_use + len(self._idle) < self.maxconn:
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolExhausted("no database connection available within %.1fs (max=%d)" % (self.timeout, self.maxconn))
+                waited = True
+                self._cond.wait(remaining)
+
+            if waited:
+                self._counters["waits"] += 1
+                self._counters["wait_seconds"] += monotonic() - started
+            self._counters["checkouts"] += 1
+            self._in_use += 1
+            self._counters["peak_in_use"] = max(self._counters["peak_in_use"], self._in_use)
+            candidate = self._idle.pop() if self._idle else None
+
+        # Health checks and connects happen outside the lock so a slow server never blocks checkouts
+        # that could be served from other idle connections.
+        try:
+            while candidate is not None:
+                raw, released_at = candidate
+                if self._healthy(raw, monotonic() - released_at):
+                    return PooledConnection(self, raw)
+                with self._cond:
+                    self._close_raw(raw)
+                    candidate = self._idle.pop() if self._idle else None
+            return PooledConnection(self, self._connect())
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, raw, discard=False):
+        if not discard and not raw.closed:
+            try:
+                if raw.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    raw.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or raw.closed or self._closed or len(self._idle) >= self.maxconn:
+                self._close_raw(raw)
+            else:
+                self._idle.append((raw, monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "saturation": round(self._in_use / float(self.maxconn), 3),
+            })
+        stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+        return stats
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for raw, _ in idle:
+            try:
+                raw.close()
+            except Exception:
+                pass
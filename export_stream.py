@@ -0,0 +1,50 @@
+# export_stream.py - stream query results as NDJSON or CSV through a server-side cursor
+import csv, io, json, uuid
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+
+def stream_query(conn, sql, params, fmt="ndjson", itersize=2000):
+    """Yield the result of `sql` in chunks of at most `itersize` rows.
+
+    Rows come from a named (server-side) cursor, so only one chunk is held in memory no matter
+    how large the result is. The connection is closed (returned to the pool) when the
+    generator finishes or the client disconnects.
+    """
+    cursor = conn.cursor(name="export_%s" % uuid.uuid4().hex)
+    cursor.itersize = itersize
+    try:
+        cursor.execute(sql, params)
+        header_written = False
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            buf = io.StringIO()
+            if fmt == "csv":
+                writer = csv.writer(buf)
+                if not header_written:
+                    writer.writerow(list(rows[0].keys()))
+                    header_written = True
+                for row in rows:
+                    writer.writerow([_csv_value(v) for v in row.values()])
+            else:
+                for row in rows:
+                    buf.write(json.dumps(row, separators=(",", ":"), default=str))
+                    buf.write("\n")
+            yield buf.getvalue()
+    finally:
+        try:
+            cursor.close()
+        finally:
+            conn.rollback()
+            conn.close()
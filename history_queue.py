@@ -0,0 +1,262 @@
+# history_queue.py - background, batched user_history ingestion with an optional crash spool
+import os, json, queue, threading, atexit, logging
+from time import monotonic, sleep
+import psycopg2
+from psycopg2.extras import execute_values
+
+log = logging.getLogger(__name__)
+
+HISTORY_COLUMNS = ("username", "ts", "flight", "dwell", "mouse_speed", "mouse_metrics",
+                   "touch_speed", "touch_metrics", "click_positions", "scrolls", "scroll_speed",
+                   "scroll_speeds", "clicks", "fraud", "status")
+
+INSERT_HISTORY_SQL = '''
+    INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
+                            touch_speed, touch_metrics, click_positions, scrolls, scroll_speed,
+                            scroll_speeds, clicks, fraud, status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+BULK_INSERT_HISTORY_SQL = '''
+    INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
+                            touch_speed, touch_metrics, click_positions, scrolls, scroll_speed,
+                            scroll_speeds, clicks, fraud, status)
+    VALUES %s
+'''
+
+
+class HistorySpool:
+    """Append-only NDJSON log of queued rows.
+
+    Lines are {"seq": n, "row": [...]} for every queued row and {"ack": n} once every row up to
+    n is committed. On startup rows with seq above the last ack are replayed. The file is
+    truncated whenever everything written so far has been acknowledged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def _open(self):
+        if self._fh is None:
+            self._fh = open(self.path, "a", encoding="utf-8")
+        return self._fh
+
+    def append(self, seq, row):
+        line = json.dumps({"seq": seq, "row": list(row)}, separators=(",", ":"))
+        with self._lock:
+            fh = self._open()
+            fh.write(line + "\n")
+            fh.flush()
+
+    def ack(self, seq, truncate=False):
+        with self._lock:
+            fh = self._open()
+            if truncate:
+                fh.truncate(0)
+                fh.seek(0)
+            else:
+                fh.write(json.dumps({"ack": seq}) + "\n")
+            fh.flush()
+
+    def pending(self):
+        """Rows queued before a crash that were never acknowledged, in seq order."""
+        if not os.path.exists(self.path):
+            return []
+        rows, acked = {}, 0
+        with open(self.path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash mid-write
+                if "ack" in entry:
+                    acked = max(acked, entry["ack"])
+                else:
+                    rows[entry["seq"]] = tuple(entry["row"])
+        return [rows[seq] for seq in sorted(rows) if seq > acked]
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+class HistoryWriter:
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, max_queue=10000, put_timeout=0.5,
+                 spool_path=None):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.spool = HistorySpool(spool_path) if spool_path else None
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._seq_lock = threading.Lock()
+        self._seq = 0
+        self._acked = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "enqueued": 0,
+            "overflow": 0,
+            "batches": 0,
+            "rows_written": 0,
+            "rows_failed": 0,
+            "retries": 0,
+            "replayed": 0,
+        }
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("HISTORY_FLUSH_SECONDS", "1")),
+            max_queue=int(os.getenv("HISTORY_QUEUE_MAX", "10000")),
+            put_timeout=float(os.getenv("HISTORY_PUT_TIMEOUT", "0.5")),
+            spool_path=os.getenv("HISTORY_SPOOL") or None,
+        )
+
+    def submit(self, row):
+        """Queue one history row. Blocks up to put_timeout when the queue is full and returns
+        False if it is still full, so the caller can write the row itself."""
+        if self._stop.is_set():
+            return False
+        deadline = monotonic() + self.put_timeout
+        while True:
+            # seq numbers must follow queue order (acks are cumulative), so assign and enqueue
+            # under one lock - but never sleep on a full queue while holding it
+            with self._seq_lock:
+                try:
+                    self._queue.put_nowait((self._seq + 1, row))
+                except queue.Full:
+                    pass
+                else:
+                    self._seq += 1
+                    self._counters["enqueued"] += 1
+                    if self.spool:
+                        self.spool.append(self._seq, row)
+                    return True
+            if monotonic() >= deadline:
+                self._counters["overflow"] += 1
+                return False
+            sleep(0.01)
+
+    def _take_batch(self):
+        batch = []
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0 and batch:
+                break
+            try:
+                batch.append(self._queue.get(timeout=max(remaining, 0.05)))
+            except queue.Empty:
+                if batch or self._stop.is_set():
+                    break
+                deadline = monotonic() + self.flush_interval
+        return batch
+
+    def _write(self, rows):
+        conn = self.pool.getconn()
+        try:
+            cursor = conn.cursor()
+            try:
+                execute_values(cursor, BULK_INSERT_HISTORY_SQL, rows, page_size=len(rows))
+                conn.commit()
+                return len(rows), 0
+            except (psycopg2.IntegrityError, psycopg2.DataError):
+                # one bad row must not sink the batch: retry row by row behind savepoints
+                conn.rollback()
+                written = failed = 0
+                for row in rows:
+                    cursor.execute("SAVEPOINT history_row")
+                    try:
+                        cursor.execute(INSERT_HISTORY_SQL, row)
+                        written += 1
+                    except (psycopg2.IntegrityError, psycopg2.DataError) as err:
+                        cursor.execute("ROLLBACK TO SAVEPOINT history_row")
+                        log.warning("dropping history row for %r: %s", row[0], err)
+                        failed += 1
+                conn.commit()
+                return written, failed
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _flush(self, batch):
+        rows = [row for _, row in batch]
+        delay = 0.5
+        attempts = 0
+        while True:
+            try:
+                written, failed = self._write(rows)
+                break
+            except Exception:
+                # database unreachable: keep the batch and back off; the queue fills up meanwhile
+                # and submit() pushes back on the request threads
+                attempts += 1
+                if self._stop.is_set() and attempts >= 3:
+                    log.error("giving up on %d history rows at shutdown%s", len(rows),
+                              " (kept in spool)" if self.spool else "")
+                    return
+                log.exception("history flush failed, retrying in %.1fs", delay)
+                self._counters["retries"] += 1
+                sleep(delay)
+                delay = min(delay * 2, 30.0)
+        self._counters["batches"] += 1
+        self._counters["rows_written"] += written
+        self._counters["rows_failed"] += failed
+        with self._seq_lock:
+            self._acked = batch[-1][0]
+            if self.spool:
+                self.spool.ack(self._acked, truncate=self._acked == self._seq)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stop.is_set():
+                return
+
+    def replay(self):
+        """Write rows a previous process spooled but never committed."""
+        if not self.spool:
+            return 0
+        pending = self.spool.pending()
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            written, failed = self._write(chunk)
+            self._counters["rows_failed"] += failed
+            self._counters["replayed"] += written
+        self.spool.ack(0, truncate=True)
+        if pending:
+            log.info("replayed %d spooled history rows", len(pending))
+        return len(pending)
+
+    def start(self):
+        if self._thread is None:
+            self.replay()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Stop accepting rows and drain what is queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.spool:
+            self.spool.close()
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats.update({"queue_depth": self._queue.qsize(), "queue_max": self._queue.maxsize,
+                      "last_acked_seq": self._acked})
+        return stats
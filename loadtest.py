@@ -0,0 +1,165 @@
+"""loadtest.py
+Open-loop /verify load: N concurrent sessions, each posting every --interval seconds.
+Every session is one keep-alive HTTP/1.1 connection posting what script.js posts (summary mode
+by default, --raw for the full raw arrays) as its own user. Reports requests/s, latency
+percentiles and errors. Start the server under test first, e.g.
+
+    flask --app app run --port 5001 --with-threads            # sync (threaded WSGI)
+    uvicorn asgi:app --port 5002                              # async (asyncio + asyncpg)
+
+    python loadtest.py --url http://127.0.0.1:5001 --sessions 1000 --duration 60
+    python loadtest.py --url http://127.0.0.1:5002 --sessions 1000 --duration 60
+
+Users are created by a warm-up round that is not measured. The client is a single asyncio
+process using only the standard library; check that it is not the bottleneck (its CPU use stays
+well under one core) before reading much into the numbers.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlsplit
+
+from bench_telemetry import full_payload, summary_payload
+
+
+class Session:
+    def __init__(self, host, port, path, body):
+        self.host, self.port, self.path, self.body = host, port, path, body
+        self.reader = self.writer = None
+
+    async def post(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            return await self._exchange()
+        try:
+            return await self._exchange()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            # the server dropped an idle keep-alive connection; retry once on a new one,
+            # like a browser does
+            self.close()
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            return await self._exchange()
+
+    async def _exchange(self):
+        head = ("POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n" % (self.path, self.host, self.port, len(self.body)))
+        self.writer.write(head.encode("latin-1") + self.body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("server closed the connection")
+        status = int(status_line.split()[1])
+        length, close = 0, status_line.startswith(b"HTTP/1.0")
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection":
+                close = value.strip().lower() == "close"
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def run_session(session, interval, start, stop, latencies, errors):
+    # first post at a random offset inside the interval so sessions do not arrive in lockstep
+    due = start + random.random() * interval
+    while True:
+        now = time.perf_counter()
+        if due > now:
+            await asyncio.sleep(due - now)
+        if due >= stop:
+            break
+        sent = time.perf_counter()
+        try:
+            status = await session.post()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            session.close()
+            errors["connection"] = errors.get("connection", 0) + 1
+        else:
+            if status == 200:
+                latencies.append(time.perf_counter() - sent)
+            else:
+                errors[status] = errors.get(status, 0) + 1
+        due += interval if interval else 0
+        if not interval:
+            due = time.perf_counter()
+    session.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def main_async(args):
+    url = urlsplit(args.url)
+    stamp = int(time.time())
+    sessions = []
+    for i in range(args.sessions):
+        payload = full_payload(i % 50)
+        payload["username"] = "%s_%d_%d" % (args.prefix, stamp, i)
+        payload = payload if args.raw else summary_payload(payload)
+        sessions.append(Session(url.hostname, url.port or 80, "/verify",
+                                json.dumps(payload, separators=(",", ":")).encode("utf-8")))
+
+    # warm-up: create every user (the first /verify of a user hashes a password), unmeasured
+    sem = asyncio.Semaphore(args.warmup_concurrency)
+
+    async def warm(session):
+        async with sem:
+            try:
+                await session.post()
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                session.close()
+    await asyncio.gather(*(warm(s) for s in sessions))
+
+    latencies, errors = [], {}
+    start = time.perf_counter() + 0.5
+    stop = start + args.duration
+    await asyncio.gather(*(run_session(s, args.interval, start, stop, latencies, errors) for s in sessions))
+    elapsed = max(time.perf_counter(), stop) - start
+
+    latencies.sort()
+    result = {
+        "url": args.url, "sessions": args.sessions, "interval_s": args.interval,
+        "duration_s": round(elapsed, 1), "payload": "raw" if args.raw else "summary",
+        "ok": len(latencies), "errors": {str(k): v for k, v in errors.items()},
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+    }
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=3.0,
+                        help="seconds between posts per session (script.js: 3); 0 = back to back")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--raw", action="store_true", help="post raw arrays instead of summaries")
+    parser.add_argument("--prefix", default="load")
+    parser.add_argument("--warmup-concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# metrics.py - per-stage request timings, scoring outcomes and Prometheus text exposition
+import os, re, sys, threading
+from bisect import bisect_left
+from collections import Counter
+from time import perf_counter
+
+# Histogram upper bounds in seconds: a local Postgres round trip lands in the first few
+# buckets, a NeonDB one around 5-50 ms, and path_metrics on a long path in the tens of ms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Bucket counts (non-cumulative; summed when rendered), sum and count of observations."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class StageTimer:
+    """Laps through one request: mark(stage) records the time since the previous mark (or since
+    the timer was made) under that stage, done() the whole request. A stage marked twice adds up."""
+
+    __slots__ = ("metrics", "endpoint", "started", "last", "laps")
+
+    def __init__(self, metrics, endpoint):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.started = self.last = perf_counter()
+        self.laps = {}
+
+    def mark(self, stage):
+        now = perf_counter()
+        self.laps[stage] = self.laps.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def done(self):
+        self.metrics.record(self.endpoint, self.laps, perf_counter() - self.started)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def mark(self, stage):
+        pass
+
+    def done(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """Stage and request histograms per endpoint plus /verify outcome counts, all in-process.
+
+    Recording takes one lock per request (in done()), not one per stage. With `enabled=False`
+    timer() hands out a no-op and nothing is recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}    # (endpoint, stage) -> Histogram
+        self._requests = {}  # endpoint -> Histogram
+        self._outcomes = Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(enabled=os.getenv("METRICS", "1") == "1")
+
+    def timer(self, endpoint):
+        return StageTimer(self, endpoint) if self.enabled else NULL_TIMER
+
+    def record(self, endpoint, laps, seconds):
+        with self._lock:
+            for stage, lap in laps.items():
+                hist = self._stages.get((endpoint, stage))
+                if hist is None:
+                    hist = self._stages[(endpoint, stage)] = Histogram()
+                hist.observe(lap)
+            hist = self._requests.get(endpoint)
+            if hist is None:
+                hist = self._requests[endpoint] = Histogram()
+            hist.observe(seconds)
+
+    def outcome(self, status):
+        if self.enabled:
+            with self._lock:
+                self._outcomes[status] += 1
+
+    def render(self, gauges=None):
+        """Prometheus text format; `gauges` is a nested dict of numbers (e.g. the /stats body),
+        flattened into authguard_<path> samples."""
+        with self._lock:
+            stages = {k: (list(h.counts), h.total, h.count) for k, h in self._stages.items()}
+            requests = {k: (list(h.counts), h.total, h.count) for k, h in self._requests.items()}
+            outcomes = dict(self._outcomes)
+
+        out = []
+        out.append("# HELP authguard_request_seconds Time from the start of a handler to its response.")
+        out.append("# TYPE authguard_request_seconds histogram")
+        for endpoint, hist in sorted(requests.items()):
+            _histogram(out, "authguard_request_seconds", 'endpoint="%s"' % endpoint, hist)
+        out.append("# HELP authguard_stage_seconds Time spent in each stage of a handler.")
+        out.append("# TYPE authguard_stage_seconds histogram")
+        for (endpoint, stage), hist in sorted(stages.items()):
+            _histogram(out, "authguard_stage_seconds", 'endpoint="%s",stage="%s"' % (endpoint, stage), hist)
+        out.append("# HELP authguard_verify_outcomes_total /verify and /verify/batch sessions by status, "
+                   "including those refused unscored because the user was already locked.")
+        out.append("# TYPE authguard_verify_outcomes_total counter")
+        for status, count in sorted(outcomes.items()):
+            out.append('authguard_verify_outcomes_total{status="%s"} %d' % (status, count))
+        for name, value in _flatten("authguard", gauges or {}):
+            out.append("# TYPE %s gauge" % name)
+            out.append("%s %s" % (name, _number(value)))
+        return "\n".join(out) + "\n"
+
+
+def _histogram(out, name, labels, hist):
+    counts, total, count = hist
+    cumulative = 0
+    for bound, n in zip(BUCKETS, counts):
+        cumulative += n
+        out.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _number(bound), cumulative))
+    out.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, count))
+    out.append("%s_sum{%s} %s" % (name, labels, _number(total)))
+    out.append("%s_count{%s} %d" % (name, labels, count))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def _flatten(prefix, value):
+    # numeric leaves only; strings (storage/scorer names) and unset values are skipped
+    if isinstance(value, dict):
+        for key, child in sorted(value.items()):
+            yield from _flatten("%s_%s" % (prefix, re.sub(r"[^a-zA-Z0-9_]", "_", str(key))), child)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+
+
+class SamplingProfiler:
+    """Samples the Python stack of every thread that is handling a request, `hz` times a second,
+    and counts the stacks in collapsed form ("dir/file:function;..." leaf last), ready for
+    flamegraph.pl or speedscope. Threads opt in with enter()/leave() around a request.
+
+    Sampling costs a few microseconds per busy thread per tick on the sampler's own thread; the
+    request threads only pay for a set add and discard.
+    """
+
+    def __init__(self, hz=0, max_stacks=20000):
+        self.hz = hz
+        self.max_stacks = max_stacks
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._samples = 0
+        self._dropped = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(hz=float(os.getenv("METRICS_PROFILE_HZ", "0")))
+
+    @property
+    def enabled(self):
+        return self.hz > 0
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def enter(self):
+        self._active.add(threading.get_ident())
+
+    def leave(self):
+        self._active.discard(threading.get_ident())
+
+    def _run(self):
+        interval = 1.0 / self.hz
+        while not self._stop.wait(interval):
+            frames = sys._current_frames()
+            stacks = []
+            for ident in list(self._active):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks.append(_collapse(frame))
+            with self._lock:
+                for stack in stacks:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                    else:
+                        self._dropped += 1
+                self._samples += len(stacks)
+
+    def collapsed(self):
+        with self._lock:
+            return "".join("%s %d\n" % item for item in self._stacks.most_common())
+
+    def stats(self):
+        with self._lock:
+            return {"hz": self.hz, "samples": self._samples, "stacks": len(self._stacks), "dropped": self._dropped}
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        # parent directory included: flask/app.py and this repo's app.py are different frames
+        path = code.co_filename
+        names.append("%s/%s:%s" % (os.path.basename(os.path.dirname(path)), os.path.basename(path), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
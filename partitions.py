@@ -0,0 +1,339 @@
+# partitions.py - ts-range partitioning and retention for user_history
+#
+# user_history is PARTITION BY RANGE (ts) with one partition per UTC day or week, named
+# user_history_pYYYYMMDD after the period's first day, plus user_history_default for rows whose
+# client-supplied ts falls outside every partition. maintain() creates the partitions for the
+# current period and HISTORY_PARTITION_PREMAKE periods ahead, and drops whole partitions older
+# than HISTORY_RETENTION_DAYS, so inserts, per-user reads and retention never touch more than a
+# bounded number of rows however old the table gets. Expired rows in the default partition are
+# deleted the ordinary way.
+#
+# Dropping an attached partition takes an ACCESS EXCLUSIVE lock on user_history until commit,
+# and DETACH PARTITION ... CONCURRENTLY is refused while a default partition exists. So drops run
+# last, each behind a savepoint with a lock_timeout of HISTORY_DROP_LOCK_TIMEOUT_MS: a drop stuck
+# behind a long read is put off to the next run instead of queueing every insert behind it.
+#
+# An unpartitioned user_history from before this module is converted with
+#
+#     python partitions.py migrate [--keep-legacy]
+#
+# which renames it to user_history_legacy, creates the partitioned table in its place (new
+# /verify rows go there from that moment) and copies the old rows over one partition at a time.
+import os, re, sys, threading, logging
+from datetime import datetime, timezone
+from time import time
+from psycopg2.errors import LockNotAvailable
+from rollups import SKIP_ROLLUPS_SQL, install as install_rollups
+from storage import POSTGRES_HISTORY_VERSION_SQL
+
+log = logging.getLogger(__name__)
+
+DAY_MS = 24 * 60 * 60 * 1000
+PERIOD_DAYS = {"day": 1, "week": 7}
+# 1970-01-01 was a Thursday; weeks start on Monday
+WEEK_OFFSET_MS = 4 * DAY_MS
+# pg_advisory_xact_lock key serializing DDL on user_history across app processes
+LOCK_KEY = 0x61677068
+
+HISTORY_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS user_history (
+        id BIGSERIAL,
+        username VARCHAR(255) REFERENCES users(username),
+        ts BIGINT NOT NULL,
+        flight REAL,
+        dwell REAL,
+        mouse_speed REAL,
+        mouse_metrics JSONB,
+        touch_speed REAL,
+        touch_metrics JSONB,
+        click_positions JSONB,
+        scrolls INTEGER,
+        scroll_speed REAL,
+        scroll_speeds JSONB,
+        clicks INTEGER,
+        fraud INTEGER,
+        status VARCHAR(50),
+        PRIMARY KEY (id, ts)
+    ) PARTITION BY RANGE (ts)
+'''
+COPY_COLUMNS = ("id, username, ts, flight, dwell, mouse_speed, mouse_metrics, touch_speed, touch_metrics, "
+                "click_positions, scrolls, scroll_speed, scroll_speeds, clicks, fraud, status")
+_BOUND = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+
+class HistoryPartitions:
+    def __init__(self, pool, period="week", premake=2, retention_days=0, interval=3600.0,
+                 drop_lock_timeout_ms=2000):
+        if period not in PERIOD_DAYS:
+            raise ValueError("HISTORY_PARTITION must be one of: %s" % ", ".join(PERIOD_DAYS))
+        self.pool = pool
+        self.period = period
+        self.period_ms = PERIOD_DAYS[period] * DAY_MS
+        self.premake = premake
+        self.retention_days = retention_days
+        self.interval = interval
+        self.drop_lock_timeout_ms = drop_lock_timeout_ms
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._partitions = 0
+        # callables run as hook(cursor, now_ms) at the end of every maintain(), e.g. rollup pruning
+        self.hooks = []
+        self._counters = {
+            "runs": 0,
+            "created": 0,
+            "dropped": 0,
+            "drops_deferred": 0,
+            "expired_from_default": 0,
+            "moved_from_default": 0,
+            "errors": 0,
+            "last_run": 0,
+        }
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            period=os.getenv("HISTORY_PARTITION", "week"),
+            premake=int(os.getenv("HISTORY_PARTITION_PREMAKE", "2")),
+            retention_days=int(os.getenv("HISTORY_RETENTION_DAYS", "0")),
+            interval=float(os.getenv("HISTORY_MAINTENANCE_SECONDS", "3600")),
+            drop_lock_timeout_ms=int(os.getenv("HISTORY_DROP_LOCK_TIMEOUT_MS", "2000")),
+        )
+
+    def period_start(self, ts_ms):
+        offset = WEEK_OFFSET_MS if self.period == "week" else 0
+        return (ts_ms - offset) // self.period_ms * self.period_ms + offset
+
+    @staticmethod
+    def partition_name(start_ms):
+        return "user_history_p" + datetime.fromtimestamp(start_ms / 1000, timezone.utc).strftime("%Y%m%d")
+
+    @staticmethod
+    def is_partitioned(cursor):
+        """True/False for a partitioned/plain user_history, None when the table does not exist."""
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('user_history')")
+        row = cursor.fetchone()
+        return None if row is None else _first(row) == "p"
+
+    @staticmethod
+    def partitions(cursor):
+        """[(name, start_ms, end_ms)] for the range partitions, oldest first."""
+        cursor.execute('''
+            SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'user_history'::regclass
+        ''')
+        result = []
+        for row in cursor.fetchall():
+            name, bound = (row["name"], row["bound"]) if isinstance(row, dict) else row
+            match = _BOUND.search(bound)
+            if match:
+                result.append((name, int(match.group(1)), int(match.group(2))))
+        return sorted(result, key=lambda p: p[1])
+
+    def create(self, cursor):
+        """Create the partitioned user_history (if missing) and its default partition."""
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_KEY,))
+        cursor.execute(HISTORY_TABLE_SQL)
+        cursor.execute("CREATE TABLE IF NOT EXISTS user_history_default PARTITION OF user_history DEFAULT")
+
+    def ensure(self, cursor, start_ms):
+        """Create the partition for the period starting at start_ms unless it exists. Rows
+        already sitting in the default partition for that range are moved into it."""
+        name, end_ms = self.partition_name(start_ms), start_ms + self.period_ms
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+        if _first(cursor.fetchone()):
+            return False
+        cursor.execute("SELECT count(*) AS n FROM user_history_default WHERE ts >= %s AND ts < %s",
+                       (start_ms, end_ms))
+        stray = _first(cursor.fetchone())
+        if stray:
+            # attaching a range the default partition has rows for would fail; move them first
+            cursor.execute("CREATE TABLE %s (LIKE user_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % name)
+            cursor.execute('''
+                WITH moved AS (DELETE FROM user_history_default WHERE ts >= %%s AND ts < %%s RETURNING *)
+                INSERT INTO %s SELECT * FROM moved
+            ''' % name, (start_ms, end_ms))
+            cursor.execute("ALTER TABLE user_history ATTACH PARTITION %s FOR VALUES FROM (%d) TO (%d)"
+                           % (name, start_ms, end_ms))
+            with self._lock:
+                self._counters["moved_from_default"] += stray
+        else:
+            cursor.execute("CREATE TABLE %s PARTITION OF user_history FOR VALUES FROM (%d) TO (%d)"
+                           % (name, start_ms, end_ms))
+        with self._lock:
+            self._counters["created"] += 1
+        return True
+
+    def maintain(self, cursor, now_ms=None):
+        """Create upcoming partitions and drop expired ones. Returns (created, dropped) names."""
+        now_ms = int(time() * 1000) if now_ms is None else now_ms
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_KEY,))
+        current = self.period_start(now_ms)
+        created = [self.partition_name(current + i * self.period_ms)
+                   for i in range(self.premake + 1) if self.ensure(cursor, current + i * self.period_ms)]
+        for hook in self.hooks:
+            hook(cursor, now_ms)
+        dropped, deferred, expired = [], 0, 0
+        if self.retention_days > 0:
+            cutoff = now_ms - self.retention_days * DAY_MS
+            cursor.execute("DELETE FROM user_history_default WHERE ts < %s", (cutoff,))
+            expired = cursor.rowcount
+            # last, so the ACCESS EXCLUSIVE lock a drop takes is held only until the caller commits
+            cursor.execute("SET LOCAL lock_timeout = %s", (self.drop_lock_timeout_ms,))
+            for name, start_ms, end_ms in self.partitions(cursor):
+                if end_ms > cutoff:
+                    continue
+                cursor.execute("SAVEPOINT drop_partition")
+                try:
+                    cursor.execute("DROP TABLE %s" % name)
+                except LockNotAvailable:
+                    cursor.execute("ROLLBACK TO SAVEPOINT drop_partition")
+                    log.warning("%s is in use; dropping it is left to the next run", name)
+                    deferred += 1
+                else:
+                    cursor.execute("RELEASE SAVEPOINT drop_partition")
+                    dropped.append(name)
+            cursor.execute("SET LOCAL lock_timeout = DEFAULT")
+        partitions = len(self.partitions(cursor))
+        with self._lock:
+            self._partitions = partitions
+            self._counters["runs"] += 1
+            self._counters["dropped"] += len(dropped)
+            self._counters["drops_deferred"] += deferred
+            self._counters["expired_from_default"] += expired
+            self._counters["last_run"] = now_ms
+        if created or dropped:
+            log.info("user_history partitions created %s, dropped %s", created, dropped)
+        return created, dropped
+
+    def start(self, delay=None):
+        """Run maintain() every interval seconds; the first pass waits delay (default interval)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(self.interval if delay is None else delay,),
+                                            name="history-partitions", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, delay):
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                conn = self.pool.getconn()
+                try:
+                    self.maintain(conn.cursor())
+                    conn.commit()
+                finally:
+                    conn.close()
+            except Exception:
+                log.exception("user_history partition maintenance failed")
+                with self._lock:
+                    self._counters["errors"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({"period": self.period, "retention_days": self.retention_days,
+                          "partitions": self._partitions})
+        return stats
+
+    @staticmethod
+    def _copy(cursor, where, params, skip_rollups):
+        if skip_rollups:
+            cursor.execute(SKIP_ROLLUPS_SQL)
+        cursor.execute("INSERT INTO user_history (%s) SELECT %s FROM user_history_legacy WHERE %s"
+                       % (COPY_COLUMNS, COPY_COLUMNS, where), params)
+        log.info("copied %s rows with %s", cursor.rowcount, where % params)
+        return cursor.rowcount
+
+    def migrate(self, conn, keep_legacy=False):
+        """Convert a plain user_history into the partitioned layout, copying its rows."""
+        cursor = conn.cursor()
+        if self.is_partitioned(cursor) is not False:
+            log.info("user_history is already partitioned (or missing); nothing to migrate")
+            return 0
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_KEY,))
+        # names the partitioned table's sequence, primary key and index will want
+        cursor.execute("ALTER TABLE user_history RENAME TO user_history_legacy")
+        cursor.execute("ALTER SEQUENCE IF EXISTS user_history_id_seq RENAME TO user_history_legacy_id_seq")
+        cursor.execute("ALTER INDEX IF EXISTS user_history_pkey RENAME TO user_history_legacy_pkey")
+        cursor.execute("ALTER INDEX IF EXISTS user_history_username_ts_idx RENAME TO user_history_legacy_username_ts_idx")
+        self.create(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_history_username_ts_idx ON user_history (username, ts DESC)")
+        # rows already rolled up are copied with the rollup trigger skipped; if the rollups are
+        # only being created now, the copy itself fills them
+        skip_rollups = not install_rollups(cursor)
+        cursor.execute(POSTGRES_HISTORY_VERSION_SQL)
+        cursor.execute("SELECT min(ts) AS lo, max(ts) AS hi, max(id) AS top FROM user_history_legacy")
+        row = cursor.fetchone()
+        lo, hi, top = (row["lo"], row["hi"], row["top"]) if isinstance(row, dict) else row
+        if top is not None:
+            # ids keep increasing from where the old table's sequence stopped
+            cursor.execute("SELECT setval(pg_get_serial_sequence('user_history', 'id'), %s)", (top,))
+        now_ms = int(time() * 1000)
+        self.maintain(cursor, now_ms)
+        conn.commit()
+
+        copied = 0
+        if lo is not None:
+            # one partition's worth of rows per transaction, oldest first; with a retention
+            # policy, rows maintain() would drop straight away are not copied at all
+            first = self.period_start(lo)
+            if self.retention_days > 0:
+                first = max(first, self.period_start(now_ms - self.retention_days * DAY_MS))
+            last = self.period_start(min(hi, now_ms))
+            # only periods that hold rows: a stray client ts years back should not turn into
+            # a partition for every period in between
+            offset = WEEK_OFFSET_MS if self.period == "week" else 0
+            cursor.execute('''
+                SELECT DISTINCT floor((ts - %s) / %s::numeric)::bigint * %s + %s AS start FROM user_history_legacy
+                WHERE ts >= %s AND ts < %s ORDER BY 1
+            ''', (offset, self.period_ms, self.period_ms, offset, first, last + self.period_ms))
+            for start in [_first(r) for r in cursor.fetchall()]:
+                self.ensure(cursor, start)
+                copied += self._copy(cursor, "ts >= %s AND ts < %s", (start, start + self.period_ms), skip_rollups)
+                conn.commit()
+            # rows stamped after the current period go to the premade partitions or the default one
+            copied += self._copy(cursor, "ts >= %s", (max(first, last + self.period_ms),), skip_rollups)
+            conn.commit()
+        if not keep_legacy:
+            cursor.execute("DROP TABLE user_history_legacy")
+            conn.commit()
+        return copied
+
+
+def _first(row):
+    # RealDictCursor rows are dicts, plain cursor rows are tuples
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    import psycopg2
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="user_history partition maintenance")
+    parser.add_argument("command", choices=("migrate", "maintain", "list"))
+    parser.add_argument("--keep-legacy", action="store_true", help="keep user_history_legacy after migrate")
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    partitions = HistoryPartitions.from_env(None)
+    if args.command == "migrate":
+        print("copied %d rows" % partitions.migrate(conn, keep_legacy=args.keep_legacy))
+    elif args.command == "maintain":
+        created, dropped = partitions.maintain(conn.cursor())
+        conn.commit()
+        print("created %s, dropped %s" % (created, dropped))
+    else:
+        for name, start_ms, end_ms in partitions.partitions(conn.cursor()):
+            print("%s  %d .. %d" % (name, start_ms, end_ms))
+    conn.close()
+    sys.exit(0)
@@ -0,0 +1,144 @@
+# path_metrics.py - vectorized mouse/touch path metrics
+#
+# Accepts a path as the list of {"x", "y", "t"} dicts script.js sends, as columns
+# ({"x": [...], "y": [...], "t": [...]}), or as a packed (n, 3) array / list of [x, y, t]
+# triples. Parsing and every metric run as NumPy array operations; malformed input raises
+# PathFormatError instead of silently producing an empty result.
+from operator import itemgetter
+import numpy as np
+
+ANGLE_BINS = 12
+TURN_THRESHOLD = np.pi / 6
+
+# np.histogram(angles, ANGLE_BINS, (-pi, pi))'s bin edges and scaling, see _angle_histogram
+_EDGES = np.linspace(-np.pi, np.pi, ANGLE_BINS + 1)
+_SPAN = np.pi - -np.pi
+
+_getters = (itemgetter("x"), itemgetter("y"), itemgetter("t"))
+
+
+class PathFormatError(ValueError):
+    """The path is not in one of the accepted shapes or holds non-numeric values."""
+
+
+def as_columns(path):
+    """Return (xs, ys, ts) float64 arrays for any accepted path form."""
+    try:
+        if isinstance(path, dict):
+            xs = np.asarray(path["x"], dtype=float)
+            ys = np.asarray(path["y"], dtype=float)
+            ts = np.asarray(path["t"], dtype=float)
+            if not (xs.ndim == ys.ndim == ts.ndim == 1) or not (len(xs) == len(ys) == len(ts)):
+                raise PathFormatError("columnar path needs equal-length 1-D x, y and t")
+        elif not isinstance(path, np.ndarray) and len(path) and isinstance(path[0], dict):
+            # one C-level pass per column: itemgetter pulls the value, fromiter converts it
+            # straight into the array buffer without an intermediate list
+            n = len(path)
+            xs, ys, ts = (np.fromiter(map(get, path), dtype=float, count=n) for get in _getters)
+        else:
+            packed = np.asarray(path, dtype=float)
+            if packed.size == 0:
+                packed = packed.reshape(0, 3)
+            if packed.ndim != 2 or packed.shape[1] != 3:
+                raise PathFormatError("packed path must have shape (n, 3), got %r" % (packed.shape,))
+            xs, ys, ts = packed[:, 0], packed[:, 1], packed[:, 2]
+    except PathFormatError:
+        raise
+    except KeyError as err:
+        raise PathFormatError("path point is missing %s" % err)
+    except (TypeError, ValueError, AttributeError) as err:
+        raise PathFormatError("path values must be numbers: %s" % err)
+    if not (np.isfinite(xs).all() and np.isfinite(ys).all() and np.isfinite(ts).all()):
+        raise PathFormatError("path contains NaN or infinite values")
+    return xs, ys, ts
+
+
+def summarize_path(path):
+    """Fixed-size sketch of a path: point count, length, duration, Welford speed stats
+    ({"n", "mean", "m2"}), direction changes and the angle histogram. script.js builds the
+    same sketch in summary mode; path_metrics() is computed from it either way."""
+    xs, ys, ts_arr = as_columns(path)
+    n = len(xs) - 1
+    if n < 1:
+        return {"points": len(xs), "path_length": 0.0, "duration_ms": 0.0,
+                "speed": {"n": 0, "mean": 0.0, "m2": 0.0}, "turns": 0, "angle_hist": [0] * ANGLE_BINS}
+    dx = np.diff(xs)
+    dy = np.diff(ys)
+    dts = np.diff(ts_arr)/1000.0
+    dts[dts==0] = 0.001
+    dists = np.hypot(dx,dy)
+    speeds = dists / dts
+    # mean and sum of squared deviations as np.mean/np.var compute them
+    mean = speeds.sum() / n
+    dev = speeds - mean
+    angles = np.arctan2(dy,dx)
+    ang_diff = np.abs(np.diff(angles))
+    ang_diff = np.minimum(ang_diff, 2*np.pi - ang_diff)
+    return {
+        "points": n + 1,
+        "path_length": float(dists.sum()),
+        "duration_ms": float(ts_arr[-1] - ts_arr[0]),
+        "speed": {"n": n, "mean": float(mean), "m2": float((dev * dev).sum())},
+        "turns": int(np.count_nonzero(ang_diff > TURN_THRESHOLD)),
+        "angle_hist": _angle_histogram(angles).tolist(),
+    }
+
+
+def metrics_from_summary(summary):
+    """path_metrics() from a summarize_path()-shaped sketch, in O(1); {} for fewer than two
+    points. Raises PathFormatError for a malformed sketch."""
+    if summary is None:
+        return {}
+    try:
+        points = int(summary["points"])
+        if points < 2:
+            return {}
+        total = float(summary["path_length"])
+        duration_ms = float(summary["duration_ms"])
+        speed = summary["speed"]
+        n, mean, m2 = int(speed["n"]), float(speed["mean"]), float(speed["m2"])
+        turns = int(summary["turns"])
+        hist = np.asarray(summary["angle_hist"], dtype=float)
+    except (KeyError, TypeError, ValueError) as err:
+        raise PathFormatError("bad path summary: %s" % err)
+    if n != points - 1 or hist.shape != (ANGLE_BINS,):
+        raise PathFormatError("path summary needs speed.n = points - 1 and %d angle bins" % ANGLE_BINS)
+    if not (np.isfinite([total, duration_ms, mean, m2]).all() and np.isfinite(hist).all()):
+        raise PathFormatError("path summary contains NaN or infinite values")
+    if m2 < 0 or turns < 0 or hist.min() < 0:
+        raise PathFormatError("path summary has negative counts")
+    return {
+        "path_length": round(total, 2),
+        "avg_speed": round(mean, 2),
+        "speed_var": round(m2 / n, 2),
+        "direction_changes_per_sec": round(turns / max(duration_ms / 1000.0, 1.0), 2),
+        "angular_entropy": round(histogram_entropy(hist), 2)
+    }
+
+
+def path_metrics(path):
+    """path_length, avg_speed, speed_var, direction_changes_per_sec and angular_entropy of a
+    path; {} for fewer than two points."""
+    if path is None:
+        return {}
+    return metrics_from_summary(summarize_path(path))
+
+
+def _angle_histogram(angles):
+    """np.histogram(angles, ANGLE_BINS, (-pi, pi))[0] without its generic set-up: the same
+    edges, scaling and +-1 ULP edge corrections, so the counts are identical. arctan2 output
+    always lies inside the range."""
+    idx = ((angles - _EDGES[0]) / _SPAN * ANGLE_BINS).astype(np.intp)
+    idx[idx == ANGLE_BINS] -= 1
+    idx[angles < _EDGES[idx]] -= 1
+    idx[(angles >= _EDGES[idx + 1]) & (idx != ANGLE_BINS - 1)] += 1
+    return np.bincount(idx, minlength=ANGLE_BINS)
+
+
+def histogram_entropy(hist):
+    """Shannon entropy (bits) of a histogram of counts."""
+    hist = np.asarray(hist, dtype=float)
+    total = hist.sum()
+    probs = hist / (total if total else 1)
+    probs = probs[probs > 0]
+    return float(-np.sum(probs * np.log2(probs))) if probs.size else 0.0
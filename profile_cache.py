@@ -0,0 +1,192 @@
+# profile_cache.py - in-process LRU of behavioral profiles with write-behind EMA flushes
+import os, threading, atexit, logging
+from collections import OrderedDict
+from psycopg2.extras import execute_values
+from scoring import PROFILE_FIELDS, REAL_FIELDS, as_stored_real
+
+log = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """Size-bounded LRU of users rows keyed by username.
+
+    Entries hold the stored column values (not the per-request fallbacks verify() applies), so
+    scoring from the cache matches scoring from a fresh SELECT. EMA updates only mark an entry
+    dirty; dirty entries are written in one batched UPDATE every `flush_interval` seconds, when
+    they are evicted, or on shutdown. locked_until is never cached: lock checks and lock writes
+    keep going straight to Postgres.
+    """
+
+    def __init__(self, pool, max_size=10000, flush_interval=5.0):
+        self.pool = pool
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = set()
+        self._evicted = {}  # dirty entries pushed out of the LRU, waiting for the next flush
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "flushes": 0,
+            "rows_flushed": 0,
+            "flush_errors": 0,
+        }
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            max_size=int(os.getenv("PROFILE_CACHE_SIZE", "10000")),
+            flush_interval=float(os.getenv("PROFILE_CACHE_FLUSH_SECONDS", "5")),
+        )
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None and username in self._evicted:
+                # not flushed yet - the DB copy is older than this one
+                entry = self._evicted.pop(username)
+                self._dirty.add(username)
+                self._insert(username, entry)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(username)
+            self._counters["hits"] += 1
+            return dict(entry)
+
+    def put(self, username, row):
+        """Cache a row as read from (or just inserted into) users."""
+        entry = {k: row.get(k) for k in PROFILE_FIELDS + ("fraud", "status", "last_update")}
+        for k in REAL_FIELDS:
+            entry[k] = as_stored_real(entry[k])
+        # psycopg2 reads BYTEA as a memoryview over the result buffer
+        entry["baseline"] = None if row.get("baseline") is None else bytes(row["baseline"])
+        with self._lock:
+            self._dirty.discard(username)
+            self._evicted.pop(username, None)
+            self._insert(username, entry)
+
+    def update(self, username, profile, fraud, status, last_update, baseline=None):
+        """Record an EMA update (and a new users.baseline, unless None); it reaches Postgres on
+        the next flush."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                entry = {"baseline": None}
+            entry.update({k: profile[k] for k in PROFILE_FIELDS})
+            for k in REAL_FIELDS:
+                entry[k] = as_stored_real(entry[k])
+            if baseline is not None:
+                entry["baseline"] = baseline
+            entry.update({"fraud": fraud, "status": status, "last_update": last_update})
+            self._dirty.add(username)
+            self._insert(username, entry)
+
+    def mark_locked(self, username, fraud, last_update):
+        """Mirror a lock that verify() already wrote through to Postgres."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                entry.update({"fraud": fraud, "status": "Locked", "last_update": last_update})
+
+    def _insert(self, username, entry):
+        self._entries[username] = entry
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            old_name, old_entry = self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+            if old_name in self._dirty:
+                self._dirty.discard(old_name)
+                self._evicted[old_name] = old_entry
+                self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = dict(self._evicted)
+                self._evicted.clear()
+                for name in self._dirty:
+                    batch[name] = dict(self._entries[name])
+                self._dirty.clear()
+            if not batch:
+                return 0
+
+            rows = [
+                (name,) + tuple(e[k] for k in PROFILE_FIELDS) + (e["fraud"], e["status"], e["last_update"], e["baseline"])
+                for name, e in batch.items()
+            ]
+            conn = None
+            try:
+                conn = self.pool.getconn()
+                cursor = conn.cursor()
+                # a lock written by another process since we cached the row keeps its status
+                execute_values(cursor, '''
+                    UPDATE users AS u SET
+                        flight_mean = v.flight_mean, dwell_mean = v.dwell_mean, mouse_mean = v.mouse_mean,
+                        scroll_mean = v.scroll_mean, scroll_speed = v.scroll_speed, touch_mean = v.touch_mean,
+                        fraud = CASE WHEN u.locked_until > clock.now_ms THEN u.fraud ELSE v.fraud END,
+                        status = CASE WHEN u.locked_until > clock.now_ms THEN u.status ELSE v.status END,
+                        last_update = v.last_update, baseline = coalesce(v.baseline, u.baseline)
+                    FROM (VALUES %s) AS v(username, flight_mean, dwell_mean, mouse_mean, scroll_mean,
+                                          scroll_speed, touch_mean, fraud, status, last_update, baseline)
+                    CROSS JOIN (SELECT (extract(epoch FROM clock_timestamp()) * 1000)::bigint) AS clock(now_ms)
+                    WHERE u.username = v.username
+                ''', rows, template="(%s, %s::real, %s::real, %s::real, %s::integer, %s::real, %s::real, %s::integer, %s, %s::bigint, %s::bytea)",
+                    page_size=len(rows))
+                conn.commit()
+                cursor.close()
+            except Exception:
+                log.exception("profile cache flush failed; %d rows kept for retry", len(rows))
+                with self._lock:
+                    self._counters["flush_errors"] += 1
+                    for name, entry in batch.items():
+                        if name in self._entries:
+                            self._dirty.add(name)
+                        else:
+                            self._evicted.setdefault(name, entry)
+                return 0
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            with self._lock:
+                self._counters["flushes"] += 1
+                self._counters["rows_flushed"] += len(rows)
+            return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="profile-cache-flush", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({"size": len(self._entries), "max_size": self.max_size,
+                          "dirty": len(self._dirty) + len(self._evicted)})
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / float(lookups), 3) if lookups else 0.0
+        return stats
@@ -0,0 +1,214 @@
+# ratelimit.py - login throttling and rejected-login caches, checked before any DB or hash work
+import os, json, sqlite3, threading
+from collections import OrderedDict
+from time import time
+
+
+class MemoryStore:
+    """Per-process store: token buckets and expiring entries in one bounded LRU dict."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+
+    def _put(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def take(self, key, rate, burst, now):
+        """Take one token from the bucket `key` (refilling at `rate` per second up to `burst`).
+        Returns 0 on success, else the seconds until a token is available."""
+        with self._lock:
+            entry = self._entries.get(key)
+            tokens, updated = entry[0] if entry and entry[1] > now else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            # a bucket that has refilled completely is the same as no bucket
+            self._put(key, (tokens, now), now + (burst - tokens) / rate)
+            return wait
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def put(self, key, value, expires_at):
+        with self._lock:
+            self._put(key, value, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SqliteStore:
+    """MemoryStore's interface on a SQLite file, so several app processes on one host share
+    buckets and caches. A local stand-in for a networked store such as Redis."""
+
+    PRUNE_EVERY = 1000  # writes between sweeps of expired rows
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS login_guard "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM login_guard WHERE key = ? AND expires_at > ?",
+                               (key, now)).fetchone()
+            tokens, updated = json.loads(row[0]) if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO login_guard VALUES (?, ?, ?)",
+                         (key, json.dumps([tokens, now]), now + (burst - tokens) / rate))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._wrote(now)
+        return wait
+
+    def get(self, key, now):
+        row = self._connect().execute("SELECT value FROM login_guard WHERE key = ? AND expires_at > ?",
+                                      (key, now)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value, expires_at):
+        self._connect().execute("INSERT OR REPLACE INTO login_guard VALUES (?, ?, ?)",
+                                (key, json.dumps(value), expires_at))
+        self._wrote(time())
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM login_guard WHERE key = ?", (key,))
+
+    def _wrote(self, now):
+        # unsynchronized on purpose: an occasional extra or skipped sweep is harmless
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._connect().execute("DELETE FROM login_guard WHERE expires_at <= ?", (now,))
+
+
+def store_from_url(url, max_keys=100000):
+    # "memory" or "sqlite:<path>"
+    if url == "memory":
+        return MemoryStore(max_keys)
+    if url.startswith("sqlite:"):
+        return SqliteStore(url[len("sqlite:"):])
+    raise ValueError("unknown LOGIN_GUARD_STORE %r (use memory or sqlite:<path>)" % url)
+
+
+class LoginGuard:
+    """Decides whether a /login attempt can be answered without touching Postgres or scrypt.
+
+    check() takes a token from the client IP's bucket and from the username's bucket (either is
+    off when its per-minute rate is 0), then consults two caches filled by earlier logins: usernames that do not
+    exist (kept for `negative_ttl` seconds, dropped as soon as the user is created) and users
+    whose locked_until is in the future (kept exactly until then; locks are never lifted early).
+    """
+
+    def __init__(self, store, ip_per_minute=60.0, ip_burst=20, user_per_minute=10.0, user_burst=5,
+                 negative_ttl=30.0):
+        if ip_per_minute < 0 or user_per_minute < 0:
+            raise ValueError("LOGIN_IP_PER_MINUTE and LOGIN_USER_PER_MINUTE must be 0 (off) or more")
+        self.store = store
+        self.ip_rate = ip_per_minute / 60.0
+        self.ip_burst = ip_burst
+        self.user_rate = user_per_minute / 60.0
+        self.user_burst = user_burst
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._counters = {
+            "checked": 0,
+            "limited_ip": 0,
+            "limited_user": 0,
+            "cached_missing": 0,
+            "cached_locked": 0,
+            "passed": 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        url = os.getenv("LOGIN_GUARD_STORE", "memory")
+        # a user created through one process would stay "missing" in the others' caches
+        if url == "memory" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            raise ValueError("LOGIN_GUARD_STORE=memory is per process; with WEB_CONCURRENCY > 1 "
+                             "use LOGIN_GUARD_STORE=sqlite:<path>")
+        return cls(
+            store_from_url(url, max_keys=int(os.getenv("LOGIN_GUARD_MAX_KEYS", "100000"))),
+            ip_per_minute=float(os.getenv("LOGIN_IP_PER_MINUTE", "60")),
+            ip_burst=int(os.getenv("LOGIN_IP_BURST", "20")),
+            user_per_minute=float(os.getenv("LOGIN_USER_PER_MINUTE", "10")),
+            user_burst=int(os.getenv("LOGIN_USER_BURST", "5")),
+            negative_ttl=float(os.getenv("LOGIN_NEGATIVE_TTL", "30")),
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def check(self, username, ip, cached=True):
+        """None if the attempt should go to the database, else (reason, detail): ("limited",
+        seconds to wait), ("missing", None) or ("locked", locked_until in ms). With
+        cached=False only the rate limits apply (admin logins create missing users)."""
+        now = time()
+        self._count("checked")
+        wait = self.ip_rate and self.store.take("ip:%s" % ip, self.ip_rate, self.ip_burst, now)
+        if wait:
+            self._count("limited_ip")
+            return "limited", wait
+        wait = self.user_rate and self.store.take("user:%s" % username, self.user_rate, self.user_burst, now)
+        if wait:
+            self._count("limited_user")
+            return "limited", wait
+        if cached:
+            if self.store.get("missing:%s" % username, now):
+                self._count("cached_missing")
+                return "missing", None
+            locked_until = self.store.get("locked:%s" % username, now)
+            if locked_until:
+                self._count("cached_locked")
+                return "locked", locked_until
+        self._count("passed")
+        return None
+
+    def user_missing(self, username):
+        if self.negative_ttl > 0:
+            self.store.put("missing:%s" % username, True, time() + self.negative_ttl)
+
+    def user_locked(self, username, locked_until):
+        self.store.put("locked:%s" % username, locked_until, locked_until / 1000.0)
+
+    def user_created(self, username):
+        self.store.delete("missing:%s" % username)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["rejected_early"] = stats["checked"] - stats["passed"]
+        return stats
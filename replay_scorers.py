@@ -0,0 +1,133 @@
+"""replay_scorers.py
+Replay stored user_history through two scorers and compare their verdicts.
+Every row is rescored in ts order with scoring.score_rounds, exactly as /verify would have
+scored it, against profiles (and baselines) rebuilt from scratch by that scorer's own earlier
+verdicts, so locks and skipped updates play out per scorer. History does not keep the client's
+own fraud_score, so both scorers see 0 there; the stored status is shown for reference only.
+
+    python replay_scorers.py                          # ema against baseline, every user
+    python replay_scorers.py --username alice --since 1700000000000 --json
+"""
+import argparse
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import RealDictCursor
+
+from baseline import SCORERS, scorer_from_name
+from scoring import score_rounds
+
+STATUSES = ("Authenticated", "Suspicious", "Fraud Detected", "Locked")
+
+
+def feat_from_history(row):
+    """The features score_rounds needs, from one user_history row."""
+    return {
+        "flight": row["flight"] or 0.0,
+        "dwell": row["dwell"] or 0.0,
+        "mouse_speed": row["mouse_speed"] or 0.0,
+        "touch_speed": row["touch_speed"] or 0.0,
+        "scrolls": row["scrolls"] or 0,
+        "scroll_speed": row["scroll_speed"] or 0.0,
+        "clicks": row["clicks"] or 0,
+        "incoming_score": 0,
+        "mouse_metrics": row["mouse_metrics"] or {},
+        "touch_metrics": row["touch_metrics"] or {},
+        "click_positions": [],
+        "scroll_speeds": [],
+    }
+
+
+def history_rows(conn, username, since, until, itersize=2000):
+    where, params = [], []
+    for clause, value in (("username = %s", username), ("ts >= %s", since), ("ts < %s", until)):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    cursor = conn.cursor(name="replay_scorers", cursor_factory=RealDictCursor)
+    cursor.itersize = itersize
+    cursor.execute('''
+        SELECT username, ts, flight, dwell, mouse_speed, mouse_metrics, touch_speed, touch_metrics,
+               scrolls, scroll_speed, clicks, status
+        FROM user_history WHERE username IS NOT NULL %s ORDER BY ts, id
+    ''' % "".join(" AND " + w for w in where), params)
+    for row in cursor:
+        yield row
+    cursor.close()
+
+
+def verdict(result):
+    return result["status"], result["fraud_score"]
+
+
+def replay(rows, scorers):
+    """(stored statuses, {scorer name: [(status, score), ...]}) for rows in ts order."""
+    states = {s.name: {} for s in scorers}
+    stored, verdicts = [], {s.name: [] for s in scorers}
+    for row in rows:
+        feat = feat_from_history(row)
+        stored.append(row["status"])
+        for s in scorers:
+            results = score_rounds([row["username"]], [row["ts"]], [feat], states[s.name], row["ts"], s)[0]
+            verdicts[s.name].append(verdict(results[0]))
+    return stored, verdicts
+
+
+def report(stored, verdicts, old, new):
+    n = len(stored)
+    out = {"rows": n, "scorers": {}}
+    for name, v in verdicts.items():
+        scores = np.array([score for _, score in v] or [0])
+        out["scorers"][name] = {
+            "statuses": dict(Counter(status for status, _ in v)),
+            "mean_score": round(float(scores.mean()), 2),
+            "p95_score": int(np.percentile(scores, 95)),
+            "matches_stored": round(sum(a == b for (a, _), b in zip(v, stored)) / n, 4) if n else 0.0,
+        }
+    pairs = Counter((a, b) for (a, _), (b, _) in zip(verdicts[old], verdicts[new]))
+    out["agreement"] = round(sum(c for (a, b), c in pairs.items() if a == b) / n, 4) if n else 0.0
+    out["transitions"] = {"%s -> %s" % k: c for k, c in sorted(pairs.items()) if k[0] != k[1]}
+    return out
+
+
+def print_report(out, old, new):
+    print("%d history rows replayed" % out["rows"])
+    print("%-16s %12s %12s" % ("", old, new))
+    for status in STATUSES:
+        print("%-16s %12d %12d" % (status, out["scorers"][old]["statuses"].get(status, 0),
+                                   out["scorers"][new]["statuses"].get(status, 0)))
+    for key in ("mean_score", "p95_score", "matches_stored"):
+        print("%-16s %12s %12s" % (key, out["scorers"][old][key], out["scorers"][new][key]))
+    print("status agreement %.2f%%" % (out["agreement"] * 100))
+    for transition, count in out["transitions"].items():
+        print("  %-40s %d" % (transition, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--old", default="ema", choices=sorted(SCORERS))
+    parser.add_argument("--new", default="baseline", choices=sorted(SCORERS))
+    parser.add_argument("--username")
+    parser.add_argument("--since", type=int, help="minimum ts (ms)")
+    parser.add_argument("--until", type=int, help="maximum ts (ms, exclusive)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    if args.old == args.new:
+        parser.error("--old and --new must differ")
+
+    load_dotenv()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        stored, verdicts = replay(history_rows(conn, args.username, args.since, args.until),
+                                  [scorer_from_name(args.old), scorer_from_name(args.new)])
+    finally:
+        conn.close()
+    out = report(stored, verdicts, args.old, args.new)
+    if args.json:
+        print(json.dumps(out, indent=2))
+    else:
+        print_report(out, args.old, args.new)
@@ -0,0 +1,76 @@
+# response_cache.py - rendered /profiles and /admin responses, reused until the users data changes
+import os, threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU of rendered GET responses keyed by path and query string, all rendered under one
+    change token (storage.py, change_state()).
+
+    A get() with a different token empties the cache first, so the first read after a register,
+    an admin upsert at /login or a /verify write renders afresh, in every process, with nothing
+    sent between them. put() only keeps a body rendered under the current token; bodies larger
+    than `max_bytes` are not kept at all.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._token = None
+        self._entries = OrderedDict()  # key -> (body, status, headers)
+        self._bytes = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+            "evictions": 0,
+            "too_large": 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "0")),
+            max_bytes=int(float(os.getenv("RESPONSE_CACHE_MB", "64")) * (1 << 20)),
+        )
+
+    def get(self, key, token):
+        with self._lock:
+            if token != self._token:
+                if self._entries:
+                    self._counters["invalidations"] += 1
+                self._entries.clear()
+                self._bytes = 0
+                self._token = token
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry
+
+    def put(self, key, token, body, status, headers):
+        if len(body) > self.max_bytes:
+            with self._lock:
+                self._counters["too_large"] += 1
+            return
+        with self._lock:
+            if token != self._token:
+                # rendered before a newer write was seen; its body may already be stale
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, status, headers)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, size=len(self._entries), bytes=self._bytes,
+                        max_entries=self.max_entries, max_bytes=self.max_bytes)
@@ -0,0 +1,195 @@
+# rollups.py - per-user minute/hour aggregates and click heatmap grids for /analytics
+#
+# An AFTER INSERT statement trigger on user_history folds every inserted batch into
+#
+#     user_rollups      (username, bucket_ms, bucket): row count, Locked count and
+#                       sum/min/max of fraud and each behavioral feature, per minute and per hour
+#     user_click_grid   (username, bucket, cell_x, cell_y): clicks per CELL_PX square per hour
+#     user_click_state  (username): newest click t counted so far
+#
+# inside the inserting transaction, so whichever path writes history (verify(), /verify/batch,
+# authguard_verify(), the background history writer, asgi.py) the rollups match it exactly.
+# Raw-mode clients resend their last 500 clicks with every post, so only clicks newer than
+# user_click_state.last_click_t are counted. Dashboards read a few hundred buckets instead of
+# every history row.
+import os
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+RESOLUTIONS = {"minute": MINUTE_MS, "hour": HOUR_MS}
+FEATURES = ("fraud", "flight", "dwell", "mouse_speed", "touch_speed", "scroll_speed")
+CELL_PX = 20
+MAX_CELL = 199  # clicks beyond 4000 px land in the last row/column
+
+ROLLUP_TABLES_SQL = '''
+CREATE TABLE IF NOT EXISTS user_rollups (
+    username VARCHAR(255) NOT NULL,
+    bucket_ms INTEGER NOT NULL,
+    bucket BIGINT NOT NULL,
+    n INTEGER NOT NULL,
+    locked INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (username, bucket_ms, bucket)
+);
+CREATE TABLE IF NOT EXISTS user_click_grid (
+    username VARCHAR(255) NOT NULL,
+    bucket BIGINT NOT NULL,
+    cell_x SMALLINT NOT NULL,
+    cell_y SMALLINT NOT NULL,
+    clicks INTEGER NOT NULL,
+    PRIMARY KEY (username, bucket, cell_x, cell_y)
+);
+CREATE TABLE IF NOT EXISTS user_click_state (
+    username VARCHAR(255) PRIMARY KEY,
+    last_click_t BIGINT NOT NULL
+);
+''' % ",\n    ".join("%s_%s DOUBLE PRECISION NOT NULL" % (f, agg) for f in FEATURES for agg in ("sum", "min", "max"))
+
+# {src} is the rows to fold in: the trigger's transition table, or user_history for a rebuild.
+# Every upsert below goes in key order, so two statements touching the same users lock their
+# rollup rows in the same order instead of deadlocking.
+_ROLLUP_UPSERT = '''
+INSERT INTO user_rollups AS r (username, bucket_ms, bucket, n, locked, %(columns)s)
+SELECT h.username, b.ms, h.ts / b.ms * b.ms, count(*), count(*) FILTER (WHERE h.status = 'Locked'),
+       %(aggregates)s
+FROM {src} h CROSS JOIN (VALUES (%(minute)d), (%(hour)d)) AS b(ms)
+WHERE h.username IS NOT NULL
+GROUP BY 1, 2, 3
+ORDER BY 1, 2, 3
+ON CONFLICT (username, bucket_ms, bucket) DO UPDATE SET
+    n = r.n + excluded.n, locked = r.locked + excluded.locked, %(merge)s
+''' % {
+    "columns": ", ".join("%s_%s" % (f, agg) for f in FEATURES for agg in ("sum", "min", "max")),
+    "aggregates": ",\n       ".join("%s(coalesce(h.%s, 0)::float8)" % (agg, f) for f in FEATURES for agg in ("sum", "min", "max")),
+    "minute": MINUTE_MS, "hour": HOUR_MS,
+    "merge": ",\n    ".join("{0}_sum = r.{0}_sum + excluded.{0}_sum, {0}_min = least(r.{0}_min, excluded.{0}_min), "
+                            "{0}_max = greatest(r.{0}_max, excluded.{0}_max)".format(f) for f in FEATURES),
+}
+
+# click_positions is stored verbatim from the client: anything that is not {x, y, t} with
+# sane numbers is skipped rather than allowed to fail the insert
+_CLICK_UPSERT = '''
+WITH clicks AS (
+    SELECT DISTINCT h.username, (c->>'x')::float8 AS x, (c->>'y')::float8 AS y, (c->>'t')::numeric::bigint AS t
+    FROM {src} h
+    CROSS JOIN LATERAL jsonb_array_elements(
+        CASE WHEN jsonb_typeof(h.click_positions) = 'array' THEN h.click_positions ELSE '[]'::jsonb END) AS c
+    WHERE h.username IS NOT NULL AND jsonb_typeof(c) = 'object'
+      AND jsonb_typeof(c->'x') = 'number' AND jsonb_typeof(c->'y') = 'number' AND jsonb_typeof(c->'t') = 'number'
+      AND abs((c->>'x')::numeric) < 1e9 AND abs((c->>'y')::numeric) < 1e9 AND abs((c->>'t')::numeric) < 1e15
+), fresh AS (
+    SELECT c.* FROM clicks c LEFT JOIN user_click_state s ON s.username = c.username
+    WHERE s.last_click_t IS NULL OR c.t > s.last_click_t
+), cells AS (
+    INSERT INTO user_click_grid AS g (username, bucket, cell_x, cell_y, clicks)
+    SELECT username, t / %(hour)d * %(hour)d,
+           least(greatest(floor(x / %(cell)d), 0), %(max)d), least(greatest(floor(y / %(cell)d), 0), %(max)d),
+           count(*)
+    FROM fresh GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4
+    ON CONFLICT (username, bucket, cell_x, cell_y) DO UPDATE SET clicks = g.clicks + excluded.clicks
+)
+INSERT INTO user_click_state AS s (username, last_click_t)
+SELECT username, max(t) FROM fresh GROUP BY 1 ORDER BY 1
+ON CONFLICT (username) DO UPDATE SET last_click_t = greatest(s.last_click_t, excluded.last_click_t)
+''' % {"hour": HOUR_MS, "cell": CELL_PX, "max": MAX_CELL}
+
+ROLLUP_TRIGGER_SQL = '''
+CREATE OR REPLACE FUNCTION authguard_rollup_history() RETURNS trigger AS $$
+BEGIN
+    -- partitions.py migrate copies rows the rollups already hold
+    IF current_setting('authguard.skip_rollups', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    %s;
+    %s;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    -- created once: replacing a trigger locks user_history against the running app
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'user_history_rollup'
+                   AND tgrelid = 'user_history'::regclass) THEN
+        CREATE TRIGGER user_history_rollup AFTER INSERT ON user_history
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION authguard_rollup_history();
+    END IF;
+END $$;
+''' % (_ROLLUP_UPSERT.format(src="new_rows").strip(), _CLICK_UPSERT.format(src="new_rows").strip())
+
+# SET LOCAL inside a transaction that copies history rows which are already rolled up
+SKIP_ROLLUPS_SQL = "SET LOCAL authguard.skip_rollups = 'on'"
+
+
+def install(cursor):
+    """Create the rollup tables and the user_history trigger. The first time, the rollups are
+    backfilled from the history already stored (in the same transaction, so no row is counted
+    twice or missed). Returns True when that backfill ran. Callers hold partitions.LOCK_KEY, so
+    processes starting together do not both backfill."""
+    cursor.execute("SELECT to_regclass('user_rollups') IS NULL AS missing")
+    row = cursor.fetchone()
+    missing = row["missing"] if isinstance(row, dict) else row[0]
+    cursor.execute(ROLLUP_TABLES_SQL)
+    cursor.execute(ROLLUP_TRIGGER_SQL)
+    if missing:
+        rebuild(cursor)
+    return missing
+
+
+def rebuild(cursor, username=None):
+    """Recompute the rollups (for one user, or everyone) from user_history."""
+    where, params = ("WHERE username = %s", (username,)) if username else ("", ())
+    for table in ("user_rollups", "user_click_grid", "user_click_state"):
+        cursor.execute("DELETE FROM %s %s" % (table, where), params)
+    src = "(SELECT * FROM user_history %s ORDER BY ts)" % where
+    cursor.execute(_ROLLUP_UPSERT.format(src=src), params)
+    cursor.execute(_CLICK_UPSERT.format(src=src), params)
+
+
+def prune(cursor, minute_days, now_ms):
+    """Drop minute buckets older than minute_days; hour buckets and click grids are kept."""
+    if minute_days > 0:
+        cursor.execute("DELETE FROM user_rollups WHERE bucket_ms = %s AND bucket < %s",
+                       (MINUTE_MS, now_ms - minute_days * 24 * HOUR_MS))
+
+
+def fetch_analytics(cursor, username, bucket_ms, since, until):
+    """Chart series and click heatmap for one user over [since, until) ms."""
+    cursor.execute('''
+        SELECT * FROM user_rollups
+        WHERE username = %s AND bucket_ms = %s AND bucket >= %s AND bucket < %s
+        ORDER BY bucket
+    ''', (username, bucket_ms, since - since % bucket_ms, until))
+    series = []
+    for row in cursor.fetchall():
+        point = {"bucket": row["bucket"], "n": row["n"], "locked": row["locked"]}
+        for f in FEATURES:
+            point[f] = {"mean": round(row[f + "_sum"] / row["n"], 2),
+                        "min": row[f + "_min"], "max": row[f + "_max"]}
+        series.append(point)
+    cursor.execute('''
+        SELECT cell_x, cell_y, sum(clicks)::integer AS clicks FROM user_click_grid
+        WHERE username = %s AND bucket >= %s AND bucket < %s
+        GROUP BY cell_x, cell_y ORDER BY cell_y, cell_x
+    ''', (username, since - since % HOUR_MS, until))
+    cells = [[row["cell_x"], row["cell_y"], row["clicks"]] for row in cursor.fetchall()]
+    return {"series": series, "heatmap": {"cell_px": CELL_PX, "cells": cells}}
+
+
+if __name__ == "__main__":
+    import argparse
+    import psycopg2
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="rebuild /analytics rollups from user_history")
+    parser.add_argument("command", choices=("rebuild",))
+    parser.add_argument("--username", help="only this user (default: everyone)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    with conn, conn.cursor() as cursor:
+        cursor.execute(ROLLUP_TABLES_SQL)
+        rebuild(cursor, args.username)
+    conn.close()
+    print("rebuilt rollups for %s" % (args.username or "all users"))
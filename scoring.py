@@ -0,0 +1,314 @@
+# scoring.py - behavioral fraud scoring shared by /verify and /verify/batch
+#
+# score_batch() scores N payloads with NumPy arrays. It performs the same IEEE double operations
+# in the same order as the original per-request code (perc_dev, capped weights summed left to
+# right, entropy penalties, 70/30 blend with the client score, half-even rounding), so a batch
+# of one and a batch of a thousand give every item the same score.
+import json, math
+import numpy as np
+from path_metrics import PathFormatError, path_metrics, metrics_from_summary
+
+PROFILE_FIELDS = ("flight_mean", "dwell_mean", "mouse_mean", "scroll_mean", "scroll_speed", "touch_mean")
+REAL_FIELDS = ("flight_mean", "dwell_mean", "mouse_mean", "scroll_speed", "touch_mean")
+# payload feature compared against each profile field, in scoring order
+FEATURE_FIELDS = ("flight", "dwell", "mouse_speed", "scrolls", "scroll_speed", "touch_speed")
+WEIGHTS = np.array([0.25, 0.2, 0.15, 0.1, 0.1, 0.08])
+CAPS = np.array([40.0, 30.0, 20.0, 10.0, 10.0, 8.0])
+
+# raw arrays a "summary" payload replaces (see parse_payload)
+RAW_FIELDS = ("flight", "dwell", "mouse_path", "touch_path")
+
+LOCK_THRESHOLD = 60
+LOCK_MS = 60 * 1000
+ALPHA = 0.02
+
+
+def as_stored_real(value):
+    # users.*_mean are REAL columns: keep the value a later SELECT would return (float4, shortest repr)
+    if value is None:
+        return None
+    return float(str(np.float32(value)))
+
+
+def safe_mean(arr):
+    # arr may be a list from JSON or a NumPy array from a telemetry frame
+    try:
+        return float(np.mean(arr)) if arr is not None and len(arr) else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _values(d, key):
+    # `value or []` without truth-testing NumPy arrays
+    value = d.get(key)
+    return value if isinstance(value, np.ndarray) else (value or [])
+
+
+def raw_path_points(d):
+    """Number of raw mouse/touch path points in a payload, in any form as_columns accepts."""
+    n = 0
+    for key in ("mouse_path", "touch_path"):
+        value = d.get(key)
+        if isinstance(value, dict):
+            value = value.get("x")
+        try:
+            n += len(value)
+        except TypeError:
+            pass
+    return n
+
+
+def summarize_values(values):
+    """Welford-style {"n", "mean", "m2"} of a list of numbers (what script.js sends for flight
+    and dwell in summary mode)."""
+    arr = np.asarray(values, dtype=float)
+    if not arr.size:
+        return {"n": 0, "mean": 0.0, "m2": 0.0}
+    mean = arr.mean()
+    return {"n": int(arr.size), "mean": float(mean), "m2": float(((arr - mean) ** 2).sum())}
+
+
+def summary_mean(stats):
+    # mean of a summarize_values() dict; 0.0 when empty or malformed, like safe_mean
+    try:
+        mean = float(stats["mean"]) if stats and int(stats["n"]) > 0 else 0.0
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+    return mean if math.isfinite(mean) else 0.0
+
+
+def _path_metrics(d, key, errors, summary=False):
+    try:
+        return metrics_from_summary(d.get(key)) if summary else path_metrics(_values(d, key))
+    except PathFormatError as err:
+        # scored as if no path was sent; the caller reports the error back to the client
+        errors.append("%s: %s" % (key, err))
+        return {}
+
+
+def _close(a, b):
+    # client and server sums differ in the last bits, which can flip a 2-decimal rounding
+    return abs(a - b) <= 0.011 + 1e-6 * abs(a)
+
+
+def _audit(feat, summary):
+    """Names of the features a payload's summary misreports compared to its raw arrays."""
+    claimed = {
+        "flight": summary_mean(summary.get("flight")),
+        "dwell": summary_mean(summary.get("dwell")),
+        "mouse_metrics": _path_metrics(summary, "mouse_path", [], summary=True),
+        "touch_metrics": _path_metrics(summary, "touch_path", [], summary=True),
+    }
+    bad = [k for k in ("flight", "dwell") if not _close(feat[k], claimed[k])]
+    for k in ("mouse_metrics", "touch_metrics"):
+        raw, sketch = feat[k], claimed[k]
+        if raw.keys() != sketch.keys() or not all(_close(raw[m], sketch[m]) for m in raw):
+            bad.append(k)
+    return bad
+
+
+def parse_payload(d):
+    """Turn a /verify payload into the features scoring and history need. Malformed paths are
+    listed in feat["path_errors"].
+
+    A payload may replace the raw flight/dwell/mouse_path/touch_path arrays with a fixed-size
+    "summary": {"flight": summarize_values(), "dwell": ..., "mouse_path":
+    path_metrics.summarize_path(), "touch_path": ...}, scored in O(1). When both are sent the
+    raw arrays are scored and feat["audit"] lists the features the summary got wrong.
+    """
+    errors = []
+    summary = d.get("summary")
+    if not isinstance(summary, dict):
+        summary = None
+    raw = summary is None or any(k in d for k in RAW_FIELDS)
+    source = d if raw else summary
+    feat = {
+        "flight": safe_mean(_values(d, "flight")) if raw else summary_mean(summary.get("flight")),
+        "dwell": safe_mean(_values(d, "dwell")) if raw else summary_mean(summary.get("dwell")),
+        "mouse_speed": float(d.get("mouse_speed", 0.0) or 0.0),
+        "touch_speed": float(d.get("touch_speed", 0.0) or 0.0),
+        "scrolls": int(d.get("scrolls", 0) or 0),
+        "scroll_speed": float(d.get("scroll_speed", 0.0) or 0.0),
+        "clicks": int(d.get("clicks", 0) or 0),
+        "incoming_score": int(d.get("fraud_score", 0) or 0),
+        "mouse_metrics": _path_metrics(source, "mouse_path", errors, summary=not raw),
+        "touch_metrics": _path_metrics(source, "touch_path", errors, summary=not raw),
+        "click_positions": d.get("click_positions", []) or [],
+        "scroll_speeds": d.get("scroll_speeds", []),
+        "path_errors": errors,
+        "mode": "raw" if raw else "summary",
+        "audit": None,
+    }
+    if raw and summary is not None:
+        feat["audit"] = _audit(feat, summary)
+    return feat
+
+
+def parse_payloads(items):
+    # module-level so a list of payloads can be sent to a worker process in one task
+    return [parse_payload(d) for d in items]
+
+
+def new_profile(feat):
+    """Profile stored for a user first seen by /verify."""
+    return {
+        "flight_mean": round(feat["flight"], 2),
+        "dwell_mean": round(feat["dwell"], 2),
+        "mouse_mean": round(feat["mouse_speed"], 2),
+        "scroll_mean": feat["scrolls"],
+        "scroll_speed": round(feat["scroll_speed"], 2),
+        "touch_mean": round(feat["touch_speed"], 2)
+    }
+
+
+def effective_profile(user, feat):
+    """Stored profile with the per-request fallbacks for unset (zero) means."""
+    return {
+        "flight_mean": float(user["flight_mean"] or feat["flight"] or 1.0),
+        "dwell_mean": float(user["dwell_mean"] or feat["dwell"] or 1.0),
+        "mouse_mean": float(user["mouse_mean"] or feat["mouse_speed"] or 1.0),
+        "scroll_mean": int(user["scroll_mean"] or feat["scrolls"] or 0),
+        "scroll_speed": float(user["scroll_speed"] or feat["scroll_speed"] or 0.0),
+        "touch_mean": float(user["touch_mean"] or feat["touch_speed"] or 0.0)
+    }
+
+
+def _low_entropy(metrics):
+    return bool(metrics) and metrics.get("angular_entropy", 0) < 1.0
+
+
+def score_batch(feats, profiles):
+    """Fraud scores (0-100 ints) for parallel lists of features and effective profiles."""
+    n = len(feats)
+    if not n:
+        return np.zeros(0, dtype=int)
+    a = np.array([[ft[k] for k in FEATURE_FIELDS] for ft in feats], dtype=float)
+    b = np.array([[p[k] for k in PROFILE_FIELDS] for p in profiles], dtype=float)
+
+    # perc_dev: 0 when both are zero, 100 when only the profile is, else |a-b|/b in percent
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dev = np.abs((a - b) / b) * 100
+    dev = np.where(b == 0, np.where(a == 0, 0.0, 100.0), dev)
+    capped = np.minimum(dev * WEIGHTS, CAPS)
+
+    # summed column by column (not np.sum, which reorders additions) to keep the rounding
+    # identical to the one-at-a-time code
+    score = np.zeros(n)
+    for j in range(len(FEATURE_FIELDS)):
+        score = score + capped[:, j]
+    return blend_scores(score, feats)
+
+
+def blend_scores(score, feats):
+    """Feature deviation totals -> final scores: entropy penalties, 70/30 blend with the
+    client's own score, capped at 100 and rounded half-even."""
+    score = score + np.array([5.0 if _low_entropy(ft["mouse_metrics"]) else 0.0 for ft in feats])
+    score = score + np.array([3.0 if _low_entropy(ft["touch_metrics"]) else 0.0 for ft in feats])
+
+    incoming = np.array([ft["incoming_score"] for ft in feats], dtype=float)
+    score = score * 0.7 + incoming * 0.3
+    return np.rint(np.minimum(score, 100)).astype(int)
+
+
+def score_one(feat, profile):
+    return int(score_batch([feat], [profile])[0])
+
+
+class EmaScorer:
+    """SCORER=ema: perc_dev against the stored EMA means. A scorer's score() takes parallel
+    lists of features, effective profiles and users rows (None for new users); update() returns
+    the new users.baseline value after a scored session, or None to leave it as it is."""
+    name = "ema"
+
+    def score(self, feats, profiles, users):
+        return score_batch(feats, profiles)
+
+    def update(self, user, feat):
+        return None
+
+
+def status_for(score):
+    return "Authenticated" if score < 40 else ("Suspicious" if score < 70 else "Fraud Detected")
+
+
+def ema_update(profile, feat):
+    """Profile nudged towards this request's features (exponential moving average)."""
+    alpha = ALPHA
+    return {
+        "flight_mean": round((1-alpha)*profile["flight_mean"] + alpha * feat["flight"], 2),
+        "dwell_mean": round((1-alpha)*profile["dwell_mean"] + alpha * feat["dwell"], 2),
+        "mouse_mean": round((1-alpha)*profile["mouse_mean"] + alpha * feat["mouse_speed"], 2),
+        "scroll_mean": int(round((1-alpha)*profile["scroll_mean"] + alpha * feat["scrolls"])),
+        "scroll_speed": round((1-alpha)*profile["scroll_speed"] + alpha * feat["scroll_speed"], 2),
+        "touch_mean": round((1-alpha)*profile["touch_mean"] + alpha * feat["touch_speed"], 2)
+    }
+
+
+def score_rounds(usernames, stamps, feats, state, now_ms, scorer=EmaScorer()):
+    """The /verify/batch core, without I/O. `state` maps username -> users row (dict) for every
+    existing user and is updated in place.
+
+    Items for the same user must see each other's updates, exactly as sequential /verify calls
+    would: the k-th item of every user goes into round k, and each round is scored as one
+    vectorized batch. Returns (results, scored, created, touched, history): the /verify body per
+    item, the indices that were scored (not already locked), rows for new users, usernames whose
+    row changed, and history_row() tuples in order. `scorer` (EmaScorer, or
+    baseline.BaselineScorer) scores each round and keeps users.baseline current.
+    """
+    rounds, seen = [], {}
+    for i, name in enumerate(usernames):
+        k = seen.get(name, 0)
+        seen[name] = k + 1
+        if k == len(rounds):
+            rounds.append([])
+        rounds[k].append(i)
+
+    results = [None] * len(usernames)
+    scored, created, touched, history = [], {}, set(), []
+    for indices in rounds:
+        active, profiles = [], []
+        for i in indices:
+            name, feat = usernames[i], feats[i]
+            user = state.get(name)
+            if user and user.get("locked_until") and user["locked_until"] > now_ms:
+                results[i] = {"status":"Locked","fraud_score": user["fraud"], "locked_until": user["locked_until"]}
+                continue
+            if not user:
+                profile = new_profile(feat)
+                user = state[name] = dict(profile, username=name, fraud=0, status='Profiled',
+                                          last_update=stamps[i], locked_until=0)
+                created[name] = user
+            else:
+                profile = effective_profile(user, feat)
+            active.append(i)
+            profiles.append(profile)
+
+        scores = scorer.score([feats[i] for i in active], profiles, [state[usernames[i]] for i in active])
+        for i, profile, score in zip(active, profiles, scores.tolist()):
+            name, user = usernames[i], state[usernames[i]]
+            if score > LOCK_THRESHOLD:
+                user.update(locked_until=now_ms + LOCK_MS, status='Locked', fraud=score, last_update=stamps[i])
+                results[i] = {"status":"Locked","fraud_score":score,"locked_until": now_ms + LOCK_MS}
+            else:
+                status = status_for(score)
+                updated = ema_update(profile, feats[i])
+                user.update((k, as_stored_real(v) if k in REAL_FIELDS else v) for k, v in updated.items())
+                user.update(fraud=score, status=status, last_update=stamps[i])
+                baseline = scorer.update(user, feats[i])
+                if baseline is not None:
+                    user["baseline"] = baseline
+                results[i] = {"status": status, "fraud_score": score, "confidence": max(0, 100-score)}
+            scored.append(i)
+            touched.add(name)
+            history.append(history_row(name, stamps[i], feats[i], score, user["status"]))
+    return results, scored, created, touched, history
+
+
+def history_row(username, ts, feat, score, status):
+    """Parameters for history_queue.INSERT_HISTORY_SQL."""
+    return (
+        username, ts, round(feat["flight"],2), round(feat["dwell"],2), round(feat["mouse_speed"],2),
+        json.dumps(feat["mouse_metrics"]), round(feat["touch_speed"],2), json.dumps(feat["touch_metrics"]),
+        json.dumps(feat["click_positions"]), feat["scrolls"], round(feat["scroll_speed"],2),
+        json.dumps(feat["scroll_speeds"]), feat["clicks"], score, status
+    )
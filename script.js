@@ -2,6 +2,7 @@
 // - Separate live charts: typing (WPM/CPM), mouse (avg speed), scroll (px/s)
 // - Heatmap (clicks) fixed and efficient
 // - Initial baseline capture trigger & continuous verification via /verify
+//   (or the /verify/stream WebSocket when asgi.py serves it)
 // - Per-sample throttling and bounded buffers
 // Note: Requires Chart.js (loaded in pages)
 
@@ -11,6 +12,12 @@
   const CHART_UPDATE_MS = 400; // chart update cadence
   const POST_INTERVAL_MS = 3000; // server verification cadence
   const BASELINE_SECONDS = 10; // baseline capture duration when user triggers
+  const VERIFY_URL = 'http://127.0.0.1:5000/verify';
+  const TELEMETRY_BINARY = true; // send compact binary frames once the server accepts them
+  const TELEMETRY_TYPE = 'application/vnd.authguard.telemetry';
+  const SEND_SUMMARIES = true; // post fixed-size sketches instead of raw flight/dwell/path arrays
+  const STREAM_URL = 'ws://127.0.0.1:5000/verify/stream'; // asgi.py only; app.py keeps the POST loop
+  const STREAM_INTERVAL_MS = 250; // frame cadence while the stream is open (frames carry new events only)
 
   // BUFFERS & STATE
   let flights = [], dwells = [];
@@ -27,6 +34,13 @@
   let idleMs = 0;
   let fraudScore = 0;
 
+  // summary mode: clicks/scrolls already posted, and whether the server asked for raw data
+  let clicksPosted = 0, scrollsPosted = 0, sendRawNext = false;
+
+  // samples ever recorded (the buffers drop their oldest past 2000) and how many were streamed
+  let flightTotal = 0, dwellTotal = 0, mouseTotal = 0, touchTotal = 0;
+  const streamed = { flight:0, dwell:0, mouse:0, touch:0 };
+
   // DOM helpers
   const $ = id => document.getElementById(id);
 
@@ -121,13 +135,13 @@
   const typingEl = $('typing');
   typingEl?.addEventListener('keydown', e => {
     const now = Date.now();
-    if(lastKeyTime) { flights.push(now - lastKeyTime); if(flights.length>2000) flights.shift(); push($('chart')?.getContext?null:null); } // no-op to keep logic
+    if(lastKeyTime) { flights.push(now - lastKeyTime); flightTotal++; if(flights.length>2000) flights.shift(); push($('chart')?.getContext?null:null); } // no-op to keep logic
     lastKeyTime = now;
     lastKeyDown[e.code||e.key] = now;
   });
   typingEl?.addEventListener('keyup', e=>{
     const now = Date.now();
-    const down = lastKeyDown[e.code||e.key]; if(down){ dwells.push(now-down); if(dwells.length>2000) dwells.shift(); }
+    const down = lastKeyDown[e.code||e.key]; if(down){ dwells.push(now-down); dwellTotal++; if(dwells.length>2000) dwells.shift(); }
     delete lastKeyDown[e.code||e.key];
     // record char event for WPM/CPM
     charTimestamps.push(now); if(charTimestamps.length>2000) charTimestamps.shift();
@@ -155,7 +169,7 @@
     if(now - lastMouseSample > SAMPLE_THROTTLE_MS){
       const sp = Math.abs(e.movementX||0)+Math.abs(e.movementY||0);
       mouseSamples.push(sp); if(mouseSamples.length>2000) mouseSamples.shift();
-      mousePath.push({x:e.clientX,y:e.clientY,t:now}); if(mousePath.length>2000) mousePath.shift();
+      mousePath.push({x:e.clientX,y:e.clientY,t:now}); mouseTotal++; if(mousePath.length>2000) mousePath.shift();
       lastMouseSample = now; lastMouseMove = now;
     }
   }, { passive:true });
@@ -167,7 +181,7 @@
   window.addEventListener('touchmove', e=>{
     const now = Date.now();
     if(e.touches && e.touches[0]) {
-      const t = e.touches[0]; touchPath.push({x:t.clientX,y:t.clientY,t:now}); if(touchPath.length>2000) touchPath.shift();
+      const t = e.touches[0]; touchPath.push({x:t.clientX,y:t.clientY,t:now}); touchTotal++; if(touchPath.length>2000) touchPath.shift();
       touchMoves++; // simplistic
       // compute small sample
       const last = touchPath[touchPath.length-2];
@@ -278,9 +292,7 @@
     };
 
     try {
-      const res = await fetch('http://127.0.0.1:5000/verify', {
-        method: 'POST', headers: {'Content-Type':'application/json'}, body: JSON.stringify(payload)
-      });
+      const res = await postVerify(payload);
       const data = await res.json();
       // display analysis result
       $('analysisArea') && ($('analysisArea').innerHTML = `<b>Baseline analysis:</b> ${data.status} - fraud_score ${data.fraud_score}%`);
@@ -292,8 +304,59 @@
     }
   }
 
+  function showVerdict(data){
+    $('statFraud') && ($('statFraud').innerText = data.fraud_score + '%');
+    $('statStatus') && ($('statStatus').innerText = data.status);
+    // optionally update analysis area
+    $('analysisArea') && ($('analysisArea').innerHTML = `<b>Live:</b> ${data.status} · fraud ${data.fraud_score}% · confidence ${data.confidence||0}%`);
+  }
+
+  // STREAMING: one WebSocket instead of a POST every few seconds. Each frame carries only the
+  // events recorded since the previous one; the server keeps the 500-sample windows itself and
+  // pushes the verdict whenever it changes. Without it (app.py, old browsers) the POST loop runs.
+  let stream = null, streamFailures = 0;
+
+  function openStream(){
+    if(!window.WebSocket) return;
+    const ws = new WebSocket(STREAM_URL);
+    ws.onopen = () => {
+      stream = ws; streamFailures = 0;
+      Object.assign(streamed, { flight:0, dwell:0, mouse:0, touch:0 }); // the first frame fills the windows
+    };
+    ws.onmessage = e => {
+      const data = JSON.parse(e.data);
+      if(data.error) console.warn('stream', data.error); else showVerdict(data);
+    };
+    ws.onclose = () => {
+      if(stream === ws) stream = null; else streamFailures++;
+      setTimeout(openStream, Math.min(30000, 1000 * 2**streamFailures));
+    };
+  }
+  openStream();
+
+  setInterval(()=>{
+    if(!stream || stream.readyState !== WebSocket.OPEN) return;
+    const frame = {
+      flight: newest(flights, flightTotal - streamed.flight), dwell: newest(dwells, dwellTotal - streamed.dwell),
+      mouse_path: newest(mousePath, mouseTotal - streamed.mouse), touch_path: newest(touchPath, touchTotal - streamed.touch),
+      click_positions: newest(clickPositions, mouseClicks - clicksPosted),
+      scroll_speeds: newest(scrollSpeeds, scrollCount - scrollsPosted)
+    };
+    if(!Object.values(frame).some(events => events.length)) return;
+    Object.assign(frame, {
+      username: sessionStorage.getItem('authguard_user') || 'default_user',
+      mouse_speed: mean(mouseSamples), touch_speed: mean(touchSamples),
+      clicks: mouseClicks, scrolls: scrollCount, scroll_speed: mean(scrollSpeeds),
+      fraud_score: fraudScore, ts: Date.now()
+    });
+    stream.send(JSON.stringify(frame));
+    Object.assign(streamed, { flight:flightTotal, dwell:dwellTotal, mouse:mouseTotal, touch:touchTotal });
+    clicksPosted = mouseClicks; scrollsPosted = scrollCount;
+  }, STREAM_INTERVAL_MS);
+
   // periodic verification send (continuous)
   setInterval(async ()=>{
+    if(stream) return; // the stream is carrying the session
     // only if we have some data
     if(!flights.length && !charTimestamps.length) return;
     if(!mouseSamples.length && !touchSamples.length && !scrollSpeeds.length) return;
@@ -309,28 +372,141 @@
 
     const payload = {
       username: sessionStorage.getItem('authguard_user') || 'default_user',
-      flight: flights.slice(-500), dwell: dwells.slice(-500),
-      chars_timestamps: charTimestamps.slice(-1000),
-      mouse_speed: mAvg, mouse_var: 0,
-      mouse_path: mousePath.slice(-500), mouse_metrics,
-      touch_speed: tAvg, touch_path: touchPath.slice(-500), touch_metrics,
-      click_positions: clickPositions.slice(-500), clicks: mouseClicks,
-      scrolls: scrollCount, scroll_speeds: scrollSpeeds.slice(-500), scroll_speed: scAvg,
+      mouse_speed: mAvg, mouse_var: 0, mouse_metrics,
+      touch_speed: tAvg, touch_metrics,
+      clicks: mouseClicks, scrolls: scrollCount, scroll_speed: scAvg,
       idle_ms: idleMs, fraud_score: fraudScore,
       ts: Date.now()
     };
+    const raw = !SEND_SUMMARIES || sendRawNext;
+    if(raw){
+      Object.assign(payload, {
+        flight: flights.slice(-500), dwell: dwells.slice(-500),
+        chars_timestamps: charTimestamps.slice(-1000),
+        mouse_path: mousePath.slice(-500), touch_path: touchPath.slice(-500)
+      });
+    }
+    if(SEND_SUMMARIES){
+      // same windows as the raw arrays, reduced to a few numbers each
+      payload.summary = {
+        flight: summarizeValues(flights.slice(-500)), dwell: summarizeValues(dwells.slice(-500)),
+        mouse_path: summarizePath(mousePath.slice(-500)), touch_path: summarizePath(touchPath.slice(-500))
+      };
+      // only the clicks and scroll speeds recorded since the last post
+      payload.click_positions = newest(clickPositions, mouseClicks - clicksPosted);
+      payload.scroll_speeds = newest(scrollSpeeds, scrollCount - scrollsPosted);
+    } else {
+      payload.click_positions = clickPositions.slice(-500);
+      payload.scroll_speeds = scrollSpeeds.slice(-500);
+    }
     try {
-      const r = await fetch('http://127.0.0.1:5000/verify', { method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(payload) });
+      const r = await postVerify(payload);
       if(r.ok){
         const data = await r.json();
-        $('statFraud') && ($('statFraud').innerText = data.fraud_score + '%');
-        $('statStatus') && ($('statStatus').innerText = data.status);
-        // optionally update analysis area
-        $('analysisArea') && ($('analysisArea').innerHTML = `<b>Live:</b> ${data.status} · fraud ${data.fraud_score}% · confidence ${data.confidence||0}%`);
+        clicksPosted = mouseClicks; scrollsPosted = scrollCount;
+        sendRawNext = !!data.send_raw; // audit sample: include raw arrays next time
+        showVerdict(data);
       }
     } catch (err) { console.warn('verify error', err); }
   }, POST_INTERVAL_MS);
 
+  // SUMMARIES (mirror scoring.summarize_values and path_metrics.summarize_path)
+  function summarizeValues(values){
+    const n = values.length; if(!n) return { n:0, mean:0, m2:0 };
+    const mean = values.reduce((a,b)=>a+b,0)/n;
+    return { n, mean, m2: values.reduce((a,v)=>a+(v-mean)**2,0) };
+  }
+
+  // numpy's histogram edges for 12 bins over [-pi, pi], used for the same +-1 ULP corrections
+  const ANGLE_EDGES = Array.from({length:13}, (_, i) => i===12 ? Math.PI : i*(2*Math.PI/12) - Math.PI);
+
+  function angleBin(a){
+    let idx = Math.floor((a+Math.PI)/(2*Math.PI)*12); if(idx>=12) idx=11;
+    if(a < ANGLE_EDGES[idx]) idx--;
+    else if(a >= ANGLE_EDGES[idx+1] && idx !== 11) idx++;
+    return idx;
+  }
+
+  function summarizePath(path){
+    const hist = new Array(12).fill(0), speeds = [];
+    let length = 0, turns = 0, prev = null;
+    for(let i=1;i<path.length;i++){
+      const a=path[i-1], b=path[i], dx=b.x-a.x, dy=b.y-a.y, dt=(b.t-a.t)/1000 || 0.001;
+      const dist = Math.hypot(dx,dy), ang = Math.atan2(dy,dx);
+      length += dist; speeds.push(dist/dt); hist[angleBin(ang)]++;
+      if(prev !== null){ const da=Math.abs(ang-prev); if(Math.min(da, 2*Math.PI-da) > Math.PI/6) turns++; }
+      prev = ang;
+    }
+    return { points: path.length, path_length: length, duration_ms: path.length ? path[path.length-1].t - path[0].t : 0,
+             speed: summarizeValues(speeds), turns, angle_hist: hist };
+  }
+
+  const newest = (buf, count) => buf.slice(buf.length - Math.max(0, Math.min(count, buf.length, 500)));
+  const mean = values => Math.round(values.reduce((a,b)=>a+b,0)/Math.max(1,values.length) || 0);
+
+  // TELEMETRY ENCODING (mirrors telemetry.py)
+  // Frame: "AGT1" | uint32 header length | JSON header | array blocks, little-endian.
+  // Number arrays and {x,y,t} point lists become blocks (point lists one per column):
+  // integers as an int64 base plus int8/16/32 deltas, anything else as raw float64.
+  let telemetryAccepted = false; // set once /verify lists TELEMETRY_TYPE in Accept-Post
+
+  const isNumbers = a => Array.isArray(a) && a.every(v => typeof v === 'number' && isFinite(v));
+  const isPoints = a => Array.isArray(a) && a.length > 0 && a.every(p => p && typeof p === 'object' &&
+    Object.keys(p).length === 3 && isNumbers([p.x, p.y, p.t]));
+  const DELTA_WIDTHS = [['d1', 1, 127], ['d2', 2, 32767], ['d4', 4, 2147483647]];
+
+  function encodeBlock(values){
+    if(values.length && values.every(Number.isSafeInteger)){
+      let lo = 0, hi = 0;
+      for(let i=1;i<values.length;i++){ const d = values[i]-values[i-1]; if(d<lo) lo=d; if(d>hi) hi=d; }
+      const width = DELTA_WIDTHS.find(w => lo >= -w[2]-1 && hi <= w[2]);
+      if(width){
+        const view = new DataView(new ArrayBuffer(8 + (values.length-1)*width[1]));
+        view.setBigInt64(0, BigInt(values[0]), true);
+        for(let i=1;i<values.length;i++){
+          const d = values[i]-values[i-1], at = 8 + (i-1)*width[1];
+          if(width[1]===1) view.setInt8(at, d); else if(width[1]===2) view.setInt16(at, d, true); else view.setInt32(at, d, true);
+        }
+        return [width[0], view.buffer];
+      }
+    }
+    const view = new DataView(new ArrayBuffer(values.length*8));
+    values.forEach((v,i) => view.setFloat64(i*8, v, true));
+    return ['f64', view.buffer];
+  }
+
+  function encodeTelemetry(payload){
+    const header = {}, arrays = [], blocks = [];
+    for(const [name, value] of Object.entries(payload)){
+      let columns;
+      if(isPoints(value)) columns = ['x','y','t'].map(k => [name+'.'+k, value.map(p => p[k])]);
+      else if(isNumbers(value)) columns = [[name, value]];
+      else { header[name] = value; continue; }
+      for(const [column, values] of columns){
+        const [enc, buf] = encodeBlock(values);
+        arrays.push([column, enc, values.length]); blocks.push(buf);
+      }
+    }
+    header.arrays = arrays;
+    const head = new TextEncoder().encode(JSON.stringify(header));
+    const prefix = new DataView(new ArrayBuffer(8));
+    [65,71,84,49].forEach((c,i) => prefix.setUint8(i, c)); // "AGT1"
+    prefix.setUint32(4, head.length, true);
+    return new Blob([prefix.buffer, head, ...blocks]);
+  }
+
+  // POST to /verify as a binary frame when the server has advertised support, JSON otherwise
+  async function postVerify(payload){
+    let init = { method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(payload) };
+    if(TELEMETRY_BINARY && telemetryAccepted){
+      try { init = { method:'POST', headers:{'Content-Type':TELEMETRY_TYPE}, body:encodeTelemetry(payload) }; }
+      catch (err) { console.warn('telemetry encode failed, sending JSON', err); }
+    }
+    const res = await fetch(VERIFY_URL, init);
+    telemetryAccepted = (res.headers.get('Accept-Post') || '').includes(TELEMETRY_TYPE);
+    return res;
+  }
+
   // helper computePathMetrics inlined above (reused)
   function computePathMetrics(path){
     if(!path||path.length<2) return { path_length:0, avg_speed:0, speed_var:0, direction_changes_per_sec:0, angular_entropy:0 };
@@ -0,0 +1,362 @@
+# sharding.py - users spread over several stores by a consistent hash of the username
+#
+# With STORAGE=sharded, SHARDS names the stores and where they live, each a Postgres DSN or an
+# embedded sqlite:<path>:
+#
+#     STORAGE=sharded
+#     SHARDS=a=postgresql://db-a/authguard,b=postgresql://db-b/authguard,c=sqlite:/var/lib/c.db
+#
+# Every user lives on exactly one shard, chosen by its place on a hash ring of SHARD_VNODES
+# (default 160) points per shard name. A request about one user (register, login, verify) runs
+# in that shard's transaction alone; /verify/batch splits its rows by shard; /admin, /profiles
+# and the similarity index read every shard and merge. Adding a shard moves only the users
+# whose ring position it takes over, about 1/N of them. Shards are identified by name, not by
+# position or DSN, so a shard can change places in the list or move to another host without
+# moving anyone. Postgres DSNs must be written as URLs (the key=value form holds "=").
+#
+# SHARD_NODES optionally gives each shard an owning app node, e.g.
+# SHARD_NODES=a=http://10.0.0.1:5000,b=http://10.0.0.2:5000 with NODE_URL set to this node's own
+# entry. /register, /login and /verify for a user whose shard another node owns are answered
+# with a 307 to that node, so each user's traffic, and with it LOGIN_GUARD's throttling and the
+# similarity index's live updates, stays on one process. Shards with no owner are served
+# wherever the request lands.
+#
+#     python sharding.py owner alice bob    (shard and node of each username)
+#     python sharding.py rebalance          (move users to their owning shard after SHARDS changed)
+import os, sys, json, heapq, threading
+from hashlib import blake2b
+from bisect import bisect_right
+from time import time
+from storage import HISTORY_JSON, PostgresStore, storage_from_url
+from history_queue import HISTORY_COLUMNS
+
+# history rows moved per user by rebalance(); far more than a user accumulates between prunes
+MOVE_HISTORY_LIMIT = 10 ** 9
+
+
+def _hash(key):
+    return int.from_bytes(blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def parse_shards(spec):
+    """[(name, url)] from "name=url,name=url"; a bare url is named after its position (s0, s1, ...)."""
+    shards = []
+    for i, item in enumerate(x.strip() for x in spec.split(",")):
+        if not item:
+            continue
+        name, sep, url = item.partition("=")
+        if not sep or "://" in name or name.startswith("sqlite:"):
+            name, url = "s%d" % i, item
+        shards.append((name.strip(), url.strip()))
+    names = [name for name, _ in shards]
+    if not shards:
+        raise ValueError("STORAGE=sharded needs SHARDS (name=url,name=url,...)")
+    if len(set(names)) != len(names):
+        raise ValueError("SHARDS names must be unique")
+    return shards
+
+
+class HashRing:
+    """Consistent hash ring: `vnodes` points per name, a key belongs to the first point at or
+    after its own hash (wrapping around). A name added or removed only moves the keys on the
+    arcs its points cover."""
+
+    def __init__(self, names, vnodes=160):
+        if vnodes < 1:
+            raise ValueError("SHARD_VNODES must be at least 1")
+        points = sorted((_hash("%s#%d" % (name, i)), name) for name in names for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key):
+        return self._names[bisect_right(self._hashes, _hash(key)) % len(self._names)]
+
+
+class ShardedTransaction:
+    """The storage.py transaction interface over a ShardedStore. Each shard's own transaction is
+    opened the first time a call needs it, so a single-user request touches one shard.
+    commit() commits the shards one after another: a batch spanning shards is atomic per shard,
+    not as a whole."""
+
+    def __init__(self, store, readonly):
+        self.store = store
+        self.readonly = readonly
+        self._open = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+        return False
+
+    def _tx(self, name):
+        tx = self._open.get(name)
+        if tx is None:
+            tx = self._open[name] = self.store.shards[name].transaction(self.readonly)
+        return tx
+
+    def _user(self, username):
+        return self._tx(self.store.ring.owner(username))
+
+    def _split(self, items, username):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.store.ring.owner(username(item)), []).append(item)
+        return groups
+
+    def _each(self):
+        return [(name, self._tx(name)) for name in self.store.shards]
+
+    def commit(self):
+        for tx in self._open.values():
+            tx.commit()
+
+    def close(self):
+        for tx in self._open.values():
+            tx.close()
+        self._open.clear()
+
+    def ping(self):
+        for _, tx in self._each():
+            tx.ping()
+
+    def schema_version(self):
+        return min(tx.schema_version() for _, tx in self._each())
+
+    def set_schema_version(self, version):
+        for _, tx in self._each():
+            tx.set_schema_version(version)
+
+    def change_state(self):
+        # one version per shard, in SHARDS order, joined with "." (ShardedStore.parse_version)
+        states = [tx.change_state() for _, tx in self._each()]
+        tokens = [token for token, _ in states]
+        token = None if None in tokens else ".".join(tokens)
+        return token, ".".join(str(since) for _, since in states)
+
+    def lock_state(self, username):
+        return self._user(username).lock_state(username)
+
+    def user_exists(self, username):
+        return self._user(username).user_exists(username)
+
+    def get_user(self, username):
+        return self._user(username).get_user(username)
+
+    def get_users(self, usernames):
+        return [row for name, group in self._split(usernames, lambda u: u).items()
+                for row in self._tx(name).get_users(group)]
+
+    def existing_usernames(self, usernames):
+        return {u for name, group in self._split(usernames, lambda u: u).items()
+                for u in self._tx(name).existing_usernames(group)}
+
+    def insert_users(self, rows):
+        for name, group in self._split(rows, lambda row: row["username"]).items():
+            self._tx(name).insert_users(group)
+
+    def load_users(self, rows):
+        return {u for name, group in self._split(rows, lambda row: row["username"]).items()
+                for u in self._tx(name).load_users(group)}
+
+    def set_role(self, username, role):
+        self._user(username).set_role(username, role)
+
+    def lock_user(self, username, locked_until, fraud, last_update):
+        self._user(username).lock_user(username, locked_until, fraud, last_update)
+
+    def update_profile(self, username, profile, fraud, status, last_update, baseline=None):
+        self._user(username).update_profile(username, profile, fraud, status, last_update, baseline)
+
+    def update_users(self, rows):
+        for name, group in self._split(rows, lambda row: row["username"]).items():
+            self._tx(name).update_users(group)
+
+    def append_history(self, rows):
+        for name, group in self._split(rows, lambda row: row[0]).items():
+            self._tx(name).append_history(group)
+
+    def load_history(self, rows):
+        for name, group in self._split(rows, lambda row: row[0]).items():
+            self._tx(name).load_history(group)
+
+    def admin_users(self, after=None, username=None, limit=1, history_limit=50, since=None, before=None,
+                    changed_since=None):
+        query = dict(history_limit=history_limit, since=since, before=before)
+        if username is not None:
+            name = self.store.ring.owner(username)
+            return self._tx(name).admin_users(username=username, changed_since=self._since(name, changed_since),
+                                              **query)
+        # every shard's first `limit` after the cursor, merged: the page is the first `limit` of those
+        pages = [tx.admin_users(after=after, limit=limit, changed_since=self._since(name, changed_since), **query)
+                 for name, tx in self._each()]
+        return list(heapq.merge(*pages, key=lambda user: user["username"]))[:limit]
+
+    def profiles(self, changed_since=None):
+        return [row for name, tx in self._each() for row in tx.profiles(self._since(name, changed_since))]
+
+    def counts(self):
+        totals = {}
+        for _, tx in self._each():
+            for key, value in tx.counts().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def delete_users(self, prefix):
+        for _, tx in self._each():
+            tx.delete_users(prefix)
+
+    def remove_users(self, usernames):
+        for name, group in self._split(usernames, lambda u: u).items():
+            self._tx(name).remove_users(group)
+
+    def _since(self, name, changed_since):
+        return None if changed_since is None else changed_since[list(self.store.shards).index(name)]
+
+
+class ShardedStore:
+    """Named stores behind one HashRing. `nodes` maps shard names to their owning app node's
+    base URL, `node_url` is this node's."""
+    name = "sharded"
+
+    def __init__(self, shards, vnodes=160, nodes=None, node_url=None):
+        self.shards = dict(shards)
+        self.ring = HashRing(self.shards, vnodes)
+        self.vnodes = vnodes
+        self.nodes = dict(nodes or {})
+        self.node_url = node_url
+        unknown = set(self.nodes) - set(self.shards)
+        if unknown:
+            raise ValueError("SHARD_NODES names shards not in SHARDS: %s" % ", ".join(sorted(unknown)))
+        if self.nodes and not node_url:
+            raise ValueError("SHARD_NODES needs NODE_URL, this node's own base URL")
+        self._lock = threading.Lock()
+        self._redirects = 0
+
+    @classmethod
+    def from_env(cls, connect=None):
+        """`connect(name, dsn)` returns a connection factory for a Postgres shard; by default a
+        fresh psycopg2 connection per transaction."""
+        if connect is None:
+            import psycopg2
+            from psycopg2.extras import RealDictCursor
+            connect = lambda name, dsn: lambda: psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        shards = []
+        for name, url in parse_shards(os.getenv("SHARDS", "")):
+            if url.startswith("sqlite:"):
+                shards.append((name, storage_from_url(url)))
+            else:
+                shards.append((name, PostgresStore(connect(name, url))))
+        nodes = os.getenv("SHARD_NODES", "")
+        nodes = {name: url.rstrip("/") for name, url in parse_shards(nodes)} if nodes else {}
+        return cls(shards, vnodes=int(os.getenv("SHARD_VNODES", "160")), nodes=nodes,
+                   node_url=(os.getenv("NODE_URL") or "").rstrip("/") or None)
+
+    def transaction(self, readonly=False):
+        return ShardedTransaction(self, readonly)
+
+    def parse_version(self, value):
+        # an X-Change-Version from ShardedTransaction.change_state(); one from before a shard
+        # was added or removed does not parse, and the read falls back to a full one
+        versions = [int(v) for v in value.split(".")]
+        if len(versions) != len(self.shards):
+            raise ValueError("expected %d shard versions" % len(self.shards))
+        return versions
+
+    def shard_for(self, username):
+        return self.ring.owner(username)
+
+    def node_for(self, username):
+        """The owning node's base URL when it is another node, else None."""
+        node = self.nodes.get(self.ring.owner(username))
+        if node is None or node == self.node_url:
+            return None
+        with self._lock:
+            self._redirects += 1
+        return node
+
+    def stats(self):
+        with self._lock:
+            redirects = self._redirects
+        return {"shards": {name: shard.name for name, shard in self.shards.items()}, "vnodes": self.vnodes,
+                "nodes": len(self.nodes), "redirects": redirects}
+
+
+def rebalance(store, chunk=500, dry_run=False, log=print):
+    """Move every user stored on a shard the ring no longer gives it to (after SHARDS gained or
+    lost a shard) to its owner: users row and all history, copied and committed there first,
+    then removed from the old shard. A user the owner already has (one who came back between
+    the SHARDS change and this run) keeps that row, and gains the old history. Safe to re-run
+    after an interruption. Returns {(from, to): users moved}."""
+    moved = {}
+    for source_name, source in store.shards.items():
+        after = ""
+        while True:
+            with source.transaction(readonly=True) as tx:
+                page = [u["username"] for u in tx.admin_users(after=after, limit=chunk, history_limit=0)]
+            if not page:
+                break
+            after = page[-1]
+            misplaced = {}
+            for username in page:
+                owner = store.ring.owner(username)
+                if owner != source_name:
+                    misplaced.setdefault(owner, []).append(username)
+            for owner, usernames in misplaced.items():
+                if not dry_run:
+                    _move(source, store.shards[owner], usernames)
+                moved[(source_name, owner)] = moved.get((source_name, owner), 0) + len(usernames)
+                log("%s -> %s: %d users" % (source_name, owner, moved[(source_name, owner)]))
+    return moved
+
+
+def _move(source, target, usernames):
+    with source.transaction(readonly=True) as tx:
+        rows = [dict(row) for row in tx.get_users(usernames)]
+        history = [h for username in usernames
+                   for user in tx.admin_users(username=username, history_limit=MOVE_HISTORY_LIMIT)
+                   for h in reversed(user["history"])]
+    with target.transaction() as tx:
+        present = {row["username"] for row in tx.get_users(usernames)}
+        rows = [row for row in rows if row["username"] not in present]
+        if rows:
+            tx.insert_users(rows)
+            # the columns insert_users leaves at their defaults
+            tx.update_users([dict(row, locked_until=row["locked_until"] or 0) for row in rows])
+        if history:
+            tx.append_history([tuple(
+                h[c] if c not in HISTORY_JSON or h[c] is None else json.dumps(h[c]) for c in HISTORY_COLUMNS)
+                for h in history])
+    with source.transaction() as tx:
+        tx.remove_users(usernames)
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="inspect and rebalance STORAGE=sharded")
+    sub = parser.add_subparsers(dest="command", required=True)
+    owner = sub.add_parser("owner", help="print the shard (and owning node) of each username")
+    owner.add_argument("usernames", nargs="+")
+    move = sub.add_parser("rebalance", help="move users to the shard the ring gives them")
+    move.add_argument("--dry-run", action="store_true", help="count the users that would move")
+    move.add_argument("--chunk", type=int, default=500, help="users read and moved per transaction")
+    args = parser.parse_args()
+
+    load_dotenv()
+    store = ShardedStore.from_env()
+    if args.command == "owner":
+        for username in args.usernames:
+            shard = store.shard_for(username)
+            print("%s\t%s\t%s" % (username, shard, store.nodes.get(shard, "-")))
+        sys.exit(0)
+    for shard in store.shards.values():
+        if shard.name == "sqlite":
+            shard.init()
+    started = time()
+    moved = rebalance(store, chunk=args.chunk, dry_run=args.dry_run)
+    print("%s %d users in %.1fs" % ("would move" if args.dry_run else "moved", sum(moved.values()), time() - started))
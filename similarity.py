@@ -0,0 +1,348 @@
+# similarity.py - in-memory nearest-neighbour index over users' behavioral profiles
+#
+# One script driving many accounts leaves them with near-identical profiles. Every profiled user
+# is a point in PROFILE_FIELDS space: log1p of each mean (they mix milliseconds, px/s and
+# counts), standardized by the population mean and standard deviation so each field weighs the
+# same. Similarity is 1 / (1 + euclidean distance) there: 1.0 for identical profiles, 0.5 for
+# profiles one standard deviation apart on one field.
+#
+#     nearest(username, k)   exact. Rows are stored in k-d tree order in blocks of BLOCK, each
+#                            with a bounding box; blocks are scanned nearest box first and the
+#                            scan stops once no box can beat the k-th best distance, usually
+#                            after a few blocks however many profiles there are
+#     clusters(similarity)   approximate, LSH style: points are hashed into grid cells as wide as
+#                            the distance threshold, on `grids` randomly shifted grids. Only
+#                            points sharing a cell are compared, exactly, and linked into
+#                            clusters. Pairs well inside the threshold share a cell on at least
+#                            one grid almost surely; pairs near it can be missed
+#
+# verify() and friends call update() with each new profile: the row is overwritten in place (new
+# users are appended) and its block's box widened, so results stay exact while the layout slowly
+# loosens. The whole index is rebuilt from the store every `interval` seconds, which also picks
+# up writes this process does not see (VERIFY_SINGLE_TRIP, other workers).
+import logging, math, os, threading
+from time import perf_counter, time
+
+import numpy as np
+
+log = logging.getLogger("authguard.similarity")
+
+PROFILE_FIELDS = ("flight_mean", "dwell_mean", "mouse_mean", "scroll_mean", "scroll_speed", "touch_mean")
+DIMS = len(PROFILE_FIELDS)
+BLOCK = 2048
+# attributes build() swaps in from the freshly laid out index
+_STATE = ("_names", "_rows", "_points", "_vectors", "_lo", "_hi", "_center", "_scale", "_fitted")
+# odd 64-bit multipliers folding a grid cell's integer coordinates into one hash
+_CELL_HASH = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                       0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53], dtype=np.uint64)
+
+
+def profile_point(profile):
+    """log1p of each profile field (negative and missing values as 0), or None when every field
+    is 0: users who were never profiled all sit at the origin and would form one big cluster."""
+    point = [math.log1p(max(float(profile.get(k) or 0.0), 0.0)) for k in PROFILE_FIELDS]
+    return point if any(point) else None
+
+
+def similarity_of(distance):
+    return 1.0 / (1.0 + distance)
+
+
+def kd_order(vectors, leaf=BLOCK):
+    """Row order that splits the points at the median of their widest field, recursively, until
+    each part is one leaf-aligned block."""
+    order = np.arange(len(vectors))
+    parts = [(0, len(vectors))]
+    while parts:
+        lo, hi = parts.pop()
+        if hi - lo <= leaf:
+            continue
+        rows = order[lo:hi]
+        points = vectors[rows]
+        dim = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        mid = -(-(hi - lo) // 2 // leaf) * leaf
+        order[lo:hi] = rows[np.argpartition(points[:, dim], mid - 1)]
+        parts += [(lo, lo + mid), (lo + mid, hi)]
+    return order
+
+
+class SimilarityIndex:
+    def __init__(self, interval=900.0, grids=2, max_cell=2000, capacity=BLOCK):
+        if grids < 1:
+            raise ValueError("SIMILARITY_GRIDS must be at least 1")
+        self.interval = interval
+        self.grids = grids
+        self.max_cell = max_cell
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._replay = None  # updates made while a rebuild reads the store
+        self._empty(capacity)
+        self.ready = False
+        self._counters = {"builds": 0, "build_ms": 0, "updates": 0, "refits": 0, "queries": 0,
+                          "blocks_scanned": 0, "errors": 0, "last_build": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            interval=float(os.getenv("SIMILARITY_REBUILD_SECONDS", "900")),
+            grids=int(os.getenv("SIMILARITY_GRIDS", "2")),
+            max_cell=int(os.getenv("SIMILARITY_MAX_CELL", "2000")),
+        )
+
+    def _empty(self, capacity):
+        capacity = -(-capacity // BLOCK) * BLOCK
+        self._names = []  # row -> username
+        self._rows = {}   # username -> row
+        self._points = np.zeros((capacity, DIMS), dtype=np.float32)   # log1p profile
+        self._vectors = np.zeros((capacity, DIMS), dtype=np.float32)  # standardized
+        # bounding box of each block's vectors; inverted (lo > hi) while a block is empty
+        self._lo = np.full((capacity // BLOCK, DIMS), np.inf, dtype=np.float32)
+        self._hi = np.full((capacity // BLOCK, DIMS), -np.inf, dtype=np.float32)
+        self._center = np.zeros(DIMS, dtype=np.float32)
+        self._scale = np.ones(DIMS, dtype=np.float32)
+        self._fitted = 0
+
+    def _refit(self):
+        # standardize with the current population; runs on build and whenever it has doubled.
+        # Every vector and box changes, so they go into new arrays that replace the old ones
+        # whole: a scan still holding the old ones sees one consistent standardization
+        n = len(self._names)
+        points = self._points[:n]
+        if n:
+            scale = points.std(axis=0)
+            self._center = points.mean(axis=0)
+            self._scale = np.where(scale > 1e-6, scale, 1.0).astype(np.float32)
+        vectors = np.zeros_like(self._vectors)
+        np.divide(points - self._center, self._scale, out=vectors[:n])
+        lo, hi = np.full_like(self._lo, np.inf), np.full_like(self._hi, -np.inf)
+        if n:
+            starts = np.arange(0, n, BLOCK)
+            lo[:len(starts)] = np.minimum.reduceat(vectors[:n], starts)
+            hi[:len(starts)] = np.maximum.reduceat(vectors[:n], starts)
+        self._vectors, self._lo, self._hi = vectors, lo, hi
+        self._fitted = n
+
+    def _grow(self):
+        capacity = 2 * len(self._points)
+        for name, fill in (("_points", 0), ("_vectors", 0), ("_lo", np.inf), ("_hi", -np.inf)):
+            old = getattr(self, name)
+            rows = capacity if name in ("_points", "_vectors") else capacity // BLOCK
+            new = np.full((rows, DIMS), fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _put(self, username, point):
+        row = self._rows.get(username)
+        if row is None:
+            row = self._rows[username] = len(self._names)
+            if row == len(self._points):
+                self._grow()
+            self._names.append(username)
+        self._points[row] = point
+        vector = (self._points[row] - self._center) / self._scale
+        self._vectors[row] = vector
+        block = row // BLOCK
+        np.minimum(self._lo[block], vector, out=self._lo[block])
+        np.maximum(self._hi[block], vector, out=self._hi[block])
+
+    def update(self, username, profile):
+        """Record a user's new profile (a dict with PROFILE_FIELDS)."""
+        point = profile_point(profile)
+        if point is None:
+            return
+        with self._lock:
+            self._put(username, point)
+            if self._replay is not None:
+                self._replay[username] = point
+            self._counters["updates"] += 1
+            if len(self._names) >= 2 * max(self._fitted, 50):
+                self._refit()
+                self._counters["refits"] += 1
+
+    def build(self, rows):
+        """Replace the index with `rows` (dicts with username and PROFILE_FIELDS, e.g. the store's
+        profiles()). Updates made while the rows were being read are applied on top."""
+        started = perf_counter()
+        rows = list(rows)
+        # profile_point() for every row at once (None becomes NaN, then 0)
+        values = np.array([[row[k] for k in PROFILE_FIELDS] for row in rows], dtype=np.float64).reshape(-1, DIMS)
+        points = np.log1p(np.clip(np.nan_to_num(values), 0.0, None)).astype(np.float32)
+        profiled = np.flatnonzero(points.any(axis=1))
+        names = [rows[i]["username"] for i in profiled]
+        points = points[profiled]
+        # laid out in a separate index so updates only wait for the swap
+        fresh = SimilarityIndex(capacity=max(BLOCK, 2 * len(names)))
+        fresh._names = names
+        fresh._points[:len(names)] = points
+        fresh._refit()
+        order = kd_order(fresh._vectors[:len(names)])
+        fresh._names = [names[i] for i in order]
+        fresh._rows = {name: i for i, name in enumerate(fresh._names)}
+        fresh._points[:len(names)] = points[order]
+        fresh._refit()
+        with self._lock:
+            replay, self._replay = self._replay or {}, None
+            for name in _STATE:
+                setattr(self, name, getattr(fresh, name))
+            for username, point in replay.items():
+                self._put(username, point)
+            self.ready = True
+            self._counters["builds"] += 1
+            self._counters["build_ms"] = round((perf_counter() - started) * 1000, 1)
+            self._counters["last_build"] = int(time() * 1000)
+
+    def rebuild(self, load):
+        # load() reads every profile from the store; it runs outside the lock
+        with self._lock:
+            self._replay = {}
+        try:
+            rows = load()
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        self.build(rows)
+
+    def start(self, load, delay=0):
+        """Rebuild from load() after delay seconds, then every interval seconds (once when
+        interval is 0)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(load, delay), name="similarity-index", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, load, delay):
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                self.rebuild(load)
+            except Exception:
+                log.exception("similarity index rebuild failed")
+                with self._lock:
+                    self._counters["errors"] += 1
+            if delay <= 0:
+                return
+
+    def _snapshot(self):
+        # rows and boxes are only ever overwritten in place or appended, and growing and
+        # refitting swap in new arrays, so a scan can run outside the lock on these references:
+        # a row written mid-scan is seen either before or after the write
+        with self._lock:
+            self._counters["queries"] += 1
+            n = len(self._names)
+            return self._names, self._rows, self._vectors[:n], self._lo, self._hi
+
+    def nearest(self, username, k=10):
+        """The k users closest to `username` as (username, similarity), most similar first, or
+        None when the user is not indexed."""
+        names, rows, vectors, lo, hi = self._snapshot()
+        row = rows.get(username)
+        if row is None or row >= len(vectors):
+            return None
+        query = vectors[row].copy()
+        outside = np.maximum(lo - query, 0) + np.maximum(query - hi, 0)
+        bounds = np.einsum("ij,ij->i", outside, outside)  # inf for empty blocks
+        best, best_rows = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        scanned = 0
+        for block in np.argsort(bounds):
+            if bounds[block] == np.inf or (len(best) >= k and bounds[block] > best.max()):
+                break
+            start = int(block) * BLOCK
+            diff = vectors[start:start + BLOCK] - query
+            distances = np.einsum("ij,ij->i", diff, diff)
+            if start <= row < start + BLOCK:
+                distances[row - start] = np.inf
+            best = np.concatenate([best, distances])
+            best_rows = np.concatenate([best_rows, np.arange(start, start + len(distances))])
+            if len(best) > k:
+                keep = np.argpartition(best, k - 1)[:k]
+                best, best_rows = best[keep], best_rows[keep]
+            scanned += 1
+        with self._lock:
+            self._counters["blocks_scanned"] += scanned
+        best_rows = best_rows[(best_rows != row) & np.isfinite(best)]
+        # float32 squared distances are too coarse to tell twins apart from near-twins
+        exact = np.sqrt(((vectors[best_rows].astype(np.float64) - query) ** 2).sum(axis=1))
+        ranked = np.argsort(exact, kind="stable")[:k]
+        return [(names[best_rows[i]], similarity_of(float(exact[i]))) for i in ranked]
+
+    def clusters(self, similarity=0.9, min_size=2, limit=100, seed=0):
+        """Groups of users linked by chains of pairs at least `similarity` alike, largest first,
+        as (usernames, size) with at most 100 names per cluster; plus the number of grid cells
+        skipped for holding more than max_cell points (a higher `similarity` splits them)."""
+        if not 0 < similarity < 1:
+            raise ValueError("similarity must be between 0 and 1")
+        radius = 1.0 / similarity - 1.0
+        names, _, vectors, _, _ = self._snapshot()
+        n = len(vectors)
+        parent = np.arange(n)
+        skipped = 0
+        rng = np.random.default_rng(seed)
+        for _ in range(self.grids):
+            offset = rng.uniform(0, radius, DIMS).astype(np.float32)
+            cells = np.floor((vectors + offset) / radius).astype(np.int64).view(np.uint64)
+            keys = (cells * _CELL_HASH).sum(axis=1, dtype=np.uint64)
+            order = np.argsort(keys)
+            keys = keys[order]
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            sizes = np.diff(np.r_[starts, n])
+            # cells of equal size are compared together, a few million pairs at a time
+            for size in np.unique(sizes[sizes > 1]):
+                group = starts[sizes == size]
+                if size > self.max_cell:
+                    skipped += len(group)
+                    continue
+                upper = np.triu_indices(size, 1)
+                step = max(1, 4000000 // (size * size))
+                for i in range(0, len(group), step):
+                    members = order[group[i:i + step, None] + np.arange(size)]
+                    block = vectors[members].astype(np.float64)
+                    norms = (block * block).sum(axis=2)
+                    gaps = norms[:, :, None] + norms[:, None, :] - 2.0 * (block @ block.transpose(0, 2, 1))
+                    cell, pair = np.nonzero(gaps[:, upper[0], upper[1]] <= radius * radius)
+                    if len(cell):
+                        _link(parent, members[cell, upper[0][pair]], members[cell, upper[1][pair]])
+
+        roots = _roots(parent)
+        _, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+        big = np.flatnonzero(counts >= max(min_size, 2))
+        big = big[np.argsort(-counts[big], kind="stable")][:limit]
+        clustered = np.flatnonzero(np.isin(inverse, big))
+        clustered = clustered[np.argsort(inverse[clustered], kind="stable")]
+        labels = inverse[clustered]
+        found = []
+        for label in big:
+            start = np.searchsorted(labels, label)
+            members = clustered[start:start + counts[label]]
+            found.append((sorted(names[i] for i in members[:100]), int(counts[label])))
+        return found, skipped
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({"size": len(self._names), "ready": self.ready, "grids": self.grids})
+        return stats
+
+
+def _roots(parent):
+    # pointer jumping until every entry points at its root
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent[:] = grand
+
+
+def _link(parent, a, b):
+    # union every (a[i], b[i]) pair: hook the larger root under the smaller until the pairs agree
+    while True:
+        ra, rb = _roots(parent)[a], parent[b]
+        unequal = ra != rb
+        if not unequal.any():
+            return
+        np.minimum.at(parent, np.maximum(ra, rb)[unequal], np.minimum(ra, rb)[unequal])
@@ -0,0 +1,674 @@
+# storage.py - users, profiles, history and locks behind one interface: Postgres or embedded SQLite
+#
+# Request handlers open a transaction with store.transaction() and call the methods below on it;
+# everything they read or write goes through those methods. PostgresStore runs the statements
+# app.py always has, on a pooled connection. SqliteStore keeps the same tables in one local file
+# (WAL mode, one connection per thread), for single-node and edge deployments where /verify
+# should not leave the machine. REAL columns are stored rounded to float4, as Postgres stores
+# them, so both backends score every request identically.
+#
+#     STORAGE=postgres                      (default; DATABASE_URL)
+#     STORAGE=sqlite:/var/lib/authguard.db
+#     STORAGE=sharded                       (SHARDS; see sharding.py)
+#
+#     python storage.py import users.json   (bulk-load a legacy users.json; see bulk_import.py)
+import os, io, csv, json, sqlite3, threading
+from psycopg2 import errors as pg_errors
+from psycopg2.extras import execute_values
+from history_queue import HISTORY_COLUMNS, INSERT_HISTORY_SQL, BULK_INSERT_HISTORY_SQL
+
+# the users columns an INSERT sets, scoring.PROFILE_FIELDS in the middle; spelled out rather than
+# imported so that importing this module does not run scoring.py and load NumPy
+USER_COLUMNS = ("username", "password_hash", "role", "flight_mean", "dwell_mean", "mouse_mean",
+                "scroll_mean", "scroll_speed", "touch_mean", "status", "last_update")
+PROFILE_FIELDS = USER_COLUMNS[3:9]
+# what a bulk load (load_users, bulk_import.py) sets: everything an account carries over
+LOAD_COLUMNS = USER_COLUMNS + ("fraud",)
+REAL_FIELDS = tuple(k for k in PROFILE_FIELDS if k != "scroll_mean")
+# user_history columns that are REAL in Postgres, and JSONB ones (TEXT in SQLite)
+HISTORY_REAL = ("flight", "dwell", "mouse_speed", "touch_speed", "scroll_speed")
+HISTORY_JSON = ("mouse_metrics", "touch_metrics", "click_positions", "scroll_speeds")
+
+
+# users.version for conditional GETs (PostgresTransaction.change_state): every insert or update
+# of a users row stamps it with the writing transaction's txid. Run by app.init_db().
+POSTGRES_VERSION_SQL = '''
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION authguard_users_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    -- created once: replacing a trigger locks users against the running app
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'users_version'
+                   AND tgrelid = 'users'::regclass) THEN
+        CREATE TRIGGER users_version BEFORE INSERT OR UPDATE ON users
+            FOR EACH ROW EXECUTE FUNCTION authguard_users_version();
+    END IF;
+END $$;
+'''
+
+# History written in a transaction that did not also write its users row (HISTORY_ASYNC, the
+# writer's inline fallback) stamps the user here instead, so change_state() and ?changed_since=
+# see it too. Only such rows touch this table: /verify's own history is covered by the users
+# row it already stamped. Needs user_history; run by app.init_db() and partitions.py migrate.
+POSTGRES_HISTORY_VERSION_SQL = '''
+CREATE TABLE IF NOT EXISTS user_history_changes (
+    username VARCHAR(255) PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION authguard_history_version() RETURNS trigger AS $$
+BEGIN
+    -- upserted in username order, so concurrent writers lock the rows in the same order
+    INSERT INTO user_history_changes AS c (username, version)
+    SELECT DISTINCT h.username, txid_current() FROM new_rows h
+    WHERE h.username IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM users u WHERE u.username = h.username AND u.version = txid_current())
+    ORDER BY 1
+    ON CONFLICT (username) DO UPDATE SET version = excluded.version;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'user_history_version'
+                   AND tgrelid = 'user_history'::regclass) THEN
+        CREATE TRIGGER user_history_version AFTER INSERT ON user_history
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION authguard_history_version();
+    END IF;
+END $$;
+'''
+
+
+# tables with rows per user, children before users
+USER_TABLES = ("user_history", "user_rollups", "user_click_grid", "user_click_state", "user_history_changes",
+               "users")
+
+
+class StoreBusy(Exception):
+    """Raised when the embedded database stays locked by other writers past its timeout."""
+
+
+def _user_values(row, columns=USER_COLUMNS):
+    # missing profile fields take the column defaults (admin accounts are created without one)
+    return tuple(row.get(k, 0) for k in columns)
+
+
+def _copy_buffer(rows):
+    # COPY ... WITH (FORMAT csv) input; None goes out as an unquoted empty field, which is NULL
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    return buf
+
+
+class PostgresTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()  # also used directly by the single-trip stored function
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.commit()
+        self.close()
+        return False
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+    def ping(self):
+        self.cursor.execute("SELECT 1")
+        self.cursor.fetchone()
+
+    def schema_version(self):
+        """The version app.migrate() last recorded; 0 for a database it has not set up."""
+        try:
+            self.cursor.execute("SELECT max(version) AS version FROM authguard_schema")
+        except pg_errors.UndefinedTable:
+            self.conn.rollback()
+            return 0
+        return self.cursor.fetchone()["version"] or 0
+
+    def set_schema_version(self, version):
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS authguard_schema (version INTEGER NOT NULL)")
+        self.cursor.execute("DELETE FROM authguard_schema")
+        self.cursor.execute("INSERT INTO authguard_schema (version) VALUES (%s)", (version,))
+
+    def change_state(self):
+        """(token, since) for conditional GETs over users. Every write stamps users.version (or,
+        for history alone, user_history_changes.version) with its txid, so the newest stamp and
+        the users count, taken together, move with every commit that changes what /admin and
+        /profiles show. The exception is a commit whose txid is below the newest stamp; while
+        one of those may still be in flight in this database the token is None and the read is
+        not cached.
+        `since` is the oldest txid this snapshot could still see commit later: a
+        ?changed_since=<since> read catches every row written after this one."""
+        # one snapshot for all of it; the scan of users is the cost of a token
+        self.cursor.execute('''
+            SELECT txid_snapshot_xmin(s) AS xmin, v.stamp, v.users,
+                   NOT EXISTS (
+                       SELECT 1 FROM txid_snapshot_xip(s) x WHERE x < v.stamp AND x % 4294967296 NOT IN (
+                           -- writers seen in other databases cannot touch users here
+                           SELECT backend_xid::text::bigint FROM pg_stat_activity
+                           WHERE backend_xid IS NOT NULL AND datname IS DISTINCT FROM current_database()
+                       )) AS settled
+            FROM txid_current_snapshot() s, (
+                SELECT greatest(u.stamp, (SELECT max(version) FROM user_history_changes)) AS stamp, u.users
+                FROM (SELECT max(version) AS stamp, count(*) AS users FROM users) u
+            ) v
+        ''')
+        row = self.cursor.fetchone()
+        token = "%d-%d" % (row["stamp"] or 0, row["users"]) if row["settled"] else None
+        return token, row["xmin"]
+
+    def lock_state(self, username):
+        self.cursor.execute("SELECT locked_until, fraud FROM users WHERE username = %s", (username,))
+        return self.cursor.fetchone()
+
+    def user_exists(self, username):
+        self.cursor.execute("SELECT username FROM users WHERE username = %s", (username,))
+        return self.cursor.fetchone() is not None
+
+    def get_user(self, username):
+        self.cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
+        return self.cursor.fetchone()
+
+    def get_users(self, usernames):
+        self.cursor.execute("SELECT * FROM users WHERE username = ANY(%s)", (list(usernames),))
+        return self.cursor.fetchall()
+
+    def existing_usernames(self, usernames):
+        self.cursor.execute("SELECT username FROM users WHERE username = ANY(%s)", (list(usernames),))
+        return {row["username"] for row in self.cursor.fetchall()}
+
+    def load_users(self, rows):
+        """Bulk-insert dicts with LOAD_COLUMNS: COPY into a session-local staging table, then one
+        INSERT of the rows whose username is still free. Returns the usernames inserted; the
+        rest were taken by a concurrent insert since the caller checked."""
+        columns = ", ".join(LOAD_COLUMNS)
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS users_load (LIKE users INCLUDING DEFAULTS) "
+                            "ON COMMIT DELETE ROWS")
+        # an empty csv field is NULL, except the password_hash of an account without a password
+        self.cursor.copy_expert("COPY users_load (%s) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (password_hash))"
+                                % columns,
+                                _copy_buffer(_user_values(row, LOAD_COLUMNS) for row in rows))
+        self.cursor.execute("INSERT INTO users (%s) SELECT %s FROM users_load ON CONFLICT (username) DO NOTHING "
+                            "RETURNING username" % (columns, columns))
+        return {row["username"] for row in self.cursor.fetchall()}
+
+    def load_history(self, rows):
+        """append_history() through COPY, for bulk loads."""
+        self.cursor.copy_expert("COPY user_history (%s) FROM STDIN WITH (FORMAT csv)" % ", ".join(HISTORY_COLUMNS),
+                                _copy_buffer(rows))
+
+    def insert_users(self, rows):
+        """rows: dicts with USER_COLUMNS."""
+        execute_values(self.cursor, '''
+            INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
+                              scroll_mean, scroll_speed, touch_mean, status, last_update)
+            VALUES %s
+        ''', [_user_values(row) for row in rows], page_size=len(rows))
+
+    def set_role(self, username, role):
+        self.cursor.execute("UPDATE users SET role = %s WHERE username = %s", (role, username))
+
+    def lock_user(self, username, locked_until, fraud, last_update):
+        self.cursor.execute('''
+            UPDATE users SET locked_until = %s, status = %s, fraud = %s, last_update = %s
+            WHERE username = %s
+        ''', (locked_until, 'Locked', fraud, last_update, username))
+
+    def update_profile(self, username, profile, fraud, status, last_update, baseline=None):
+        self.cursor.execute('''
+            UPDATE users SET flight_mean = %s, dwell_mean = %s, mouse_mean = %s, scroll_mean = %s,
+                             scroll_speed = %s, touch_mean = %s, fraud = %s, status = %s, last_update = %s,
+                             baseline = coalesce(%s, baseline)
+            WHERE username = %s
+        ''', tuple(profile[k] for k in PROFILE_FIELDS) + (fraud, status, last_update, baseline, username))
+
+    def update_users(self, rows):
+        """Write back profile, fraud, status, last_update, locked_until and baseline of users rows."""
+        execute_values(self.cursor, '''
+            UPDATE users AS u SET
+                flight_mean = v.flight_mean, dwell_mean = v.dwell_mean, mouse_mean = v.mouse_mean,
+                scroll_mean = v.scroll_mean, scroll_speed = v.scroll_speed, touch_mean = v.touch_mean,
+                fraud = v.fraud, status = v.status, last_update = v.last_update, locked_until = v.locked_until,
+                baseline = coalesce(v.baseline, u.baseline)
+            FROM (VALUES %s) AS v(username, flight_mean, dwell_mean, mouse_mean, scroll_mean,
+                                  scroll_speed, touch_mean, fraud, status, last_update, locked_until, baseline)
+            WHERE u.username = v.username
+        ''', [(row["username"],) + tuple(row[k] for k in PROFILE_FIELDS) +
+              (row["fraud"], row["status"], row["last_update"], row["locked_until"] or 0, row.get("baseline"))
+              for row in rows],
+            template="(%s, %s::real, %s::real, %s::real, %s::integer, %s::real, %s::real, %s::integer, %s, %s::bigint, %s::bigint, %s::bytea)",
+            page_size=len(rows))
+
+    def append_history(self, rows):
+        """rows: tuples in HISTORY_COLUMNS order (scoring.history_row)."""
+        if len(rows) == 1:
+            self.cursor.execute(INSERT_HISTORY_SQL, rows[0])
+        elif rows:
+            execute_values(self.cursor, BULK_INSERT_HISTORY_SQL, rows, page_size=len(rows))
+
+    def admin_users(self, after=None, username=None, limit=1, history_limit=50, since=None, before=None,
+                    changed_since=None):
+        """users rows ordered by username, each with its newest `history_limit` history rows
+        (newest first) under "history": the page after `after`, or just `username`; only users
+        written at or after version `changed_since` when it is set."""
+        users_where, users_params = ("username = %s", (username,)) if username is not None else \
+                                    ("username > %s", (after or "",))
+        if changed_since is not None:
+            users_where = users_where + (" AND (version >= %s OR username IN "
+                                         "(SELECT username FROM user_history_changes WHERE version >= %s))")
+            users_params = users_params + (changed_since, changed_since)
+        history_where = ["username = u.username"]
+        history_params = []
+        if since is not None:
+            history_where.append("ts >= %s")
+            history_params.append(since)
+        if before is not None:
+            history_where.append("ts < %s")
+            history_params.append(before)
+        # One statement per page: the LATERAL subquery pulls each user's newest history rows
+        # through user_history_username_ts_idx and aggregates them to JSON server-side.
+        self.cursor.execute('''
+            SELECT u.*, COALESCE(h.history, '[]'::json) AS history
+            FROM (
+                SELECT * FROM users WHERE %s ORDER BY username LIMIT %%s
+            ) u
+            LEFT JOIN LATERAL (
+                SELECT json_agg(x ORDER BY x.ts DESC) AS history
+                FROM (
+                    SELECT * FROM user_history WHERE %s ORDER BY ts DESC LIMIT %%s
+                ) x
+            ) h ON true
+            ORDER BY u.username
+        ''' % (users_where, " AND ".join(history_where)),
+            tuple(users_params) + (limit,) + tuple(history_params) + (history_limit,))
+        return self.cursor.fetchall()
+
+    def profiles(self, changed_since=None):
+        # users.version is not indexed (an index on it would cost /verify its HOT updates), so
+        # a delta read is still a scan; what it saves is the serialization and the transfer
+        self.cursor.execute("""
+            SELECT username,
+                   flight_mean, dwell_mean, mouse_mean, scroll_mean, scroll_speed, touch_mean,
+                   status, fraud, last_update
+            FROM users
+            WHERE %s IS NULL OR version >= %s
+        """, (changed_since, changed_since))
+        return self.cursor.fetchall()
+
+    def counts(self):
+        self.cursor.execute("SELECT (SELECT count(*) FROM users) AS users, "
+                            "(SELECT count(*) FROM user_history) AS history_rows")
+        return dict(self.cursor.fetchone())
+
+    def delete_users(self, prefix):
+        """Remove every user whose name starts with prefix, with all their history (and
+        /analytics rollups)."""
+        for table in USER_TABLES:
+            self.cursor.execute("DELETE FROM %s WHERE left(username, %%s) = %%s" % table, (len(prefix), prefix))
+
+    def remove_users(self, usernames):
+        """Remove exactly these users, with all their history and rollups."""
+        for table in USER_TABLES:
+            self.cursor.execute("DELETE FROM %s WHERE username = ANY(%%s)" % table, (list(usernames),))
+
+
+class PostgresStore:
+    """Postgres through app.py's connection pool. `connect` checks a connection out."""
+    name = "postgres"
+    parse_version = int  # ?changed_since= (see change_state)
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def transaction(self, readonly=False):
+        return PostgresTransaction(self.connect())
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    role TEXT DEFAULT 'customer',
+    flight_mean REAL DEFAULT 0.0,
+    dwell_mean REAL DEFAULT 0.0,
+    mouse_mean REAL DEFAULT 0.0,
+    scroll_mean INTEGER DEFAULT 0,
+    scroll_speed REAL DEFAULT 0.0,
+    touch_mean REAL DEFAULT 0.0,
+    fraud INTEGER DEFAULT 0,
+    status TEXT DEFAULT 'Registered',
+    last_update INTEGER DEFAULT 0,
+    locked_until INTEGER DEFAULT 0,
+    baseline BLOB,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS user_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT REFERENCES users(username),
+    ts INTEGER NOT NULL,
+    flight REAL,
+    dwell REAL,
+    mouse_speed REAL,
+    mouse_metrics TEXT,
+    touch_speed REAL,
+    touch_metrics TEXT,
+    click_positions TEXT,
+    scrolls INTEGER,
+    scroll_speed REAL,
+    scroll_speeds TEXT,
+    clicks INTEGER,
+    fraud INTEGER,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS user_history_username_ts_idx ON user_history (username, ts DESC);
+'''
+
+# users.version for conditional GETs: one counter bumped by every write to users or
+# user_history and stamped on the users row written (SQLite has no txids; the triggers' own
+# UPDATE of users does not fire them again because recursive_triggers is off)
+SQLITE_VERSION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS authguard_version (version INTEGER NOT NULL);
+INSERT INTO authguard_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM authguard_version);
+CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users BEGIN
+    UPDATE authguard_version SET version = version + 1;
+    UPDATE users SET version = (SELECT version FROM authguard_version) WHERE rowid = NEW.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users BEGIN
+    UPDATE authguard_version SET version = version + 1;
+    UPDATE users SET version = (SELECT version FROM authguard_version) WHERE rowid = NEW.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users BEGIN
+    UPDATE authguard_version SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS user_history_version AFTER INSERT ON user_history BEGIN
+    UPDATE authguard_version SET version = version + 1;
+END;
+'''
+
+_HISTORY_INSERT = "INSERT INTO user_history (%s) VALUES (%s)" % (
+    ", ".join(HISTORY_COLUMNS), ", ".join("?" * len(HISTORY_COLUMNS)))
+_REAL_AT = [HISTORY_COLUMNS.index(c) for c in HISTORY_REAL]
+
+
+def _float4(row, fields):
+    # Postgres keeps REAL columns as float4 and rounds into INTEGER ones; store what it would have
+    from scoring import as_stored_real
+    for k in fields:
+        if row.get(k) is not None:
+            row[k] = as_stored_real(row[k])
+    if row.get("scroll_mean") is not None:
+        row["scroll_mean"] = int(round(row["scroll_mean"]))
+    return row
+
+
+def _history_values(row):
+    from scoring import as_stored_real
+    row = list(row)
+    for i in _REAL_AT:
+        row[i] = as_stored_real(row[i])
+    return row
+
+
+def _history_dict(row):
+    # the shape Postgres' json_agg gives /admin: JSON columns decoded, whole REAL values as integers
+    row = dict(row)
+    for k in HISTORY_JSON:
+        if row.get(k) is not None:
+            row[k] = json.loads(row[k])
+    for k in HISTORY_REAL:
+        v = row.get(k)
+        if v is not None and v.is_integer() and abs(v) < 1e15:
+            row[k] = int(v)
+    return row
+
+
+class SqliteTransaction:
+    def __init__(self, conn, readonly):
+        self.conn = conn
+        if conn.in_transaction:
+            # left open by a request on this thread that raised before closing it
+            conn.execute("ROLLBACK")
+        try:
+            # IMMEDIATE takes the write lock up front: a read-then-write transaction that had to
+            # upgrade later could fail with SQLITE_BUSY instead of waiting its turn
+            conn.execute("BEGIN" if readonly else "BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as err:
+            raise StoreBusy(str(err))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+        return False
+
+    def _run(self, sql, params=()):
+        try:
+            return self.conn.execute(sql, params)
+        except sqlite3.OperationalError as err:
+            if "locked" in str(err) or "busy" in str(err):
+                raise StoreBusy(str(err))
+            raise
+
+    def commit(self):
+        if self.conn.in_transaction:
+            self._run("COMMIT")
+
+    def close(self):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+
+    def ping(self):
+        self._run("SELECT 1").fetchone()
+
+    def schema_version(self):
+        return self._run("PRAGMA user_version").fetchone()[0]
+
+    def set_schema_version(self, version):
+        self._run("PRAGMA user_version = %d" % version)
+
+    def change_state(self):
+        # the counter only moves on writes, and no write can be in flight while this
+        # transaction reads (one writer, snapshot reads), so it is always a usable token
+        version = self._run("SELECT version FROM authguard_version").fetchone()[0]
+        return str(version), version + 1
+
+    def lock_state(self, username):
+        row = self._run("SELECT locked_until, fraud FROM users WHERE username = ?", (username,)).fetchone()
+        return dict(row) if row else None
+
+    def user_exists(self, username):
+        return self._run("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+    def get_user(self, username):
+        row = self._run("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        return dict(row) if row else None
+
+    def get_users(self, usernames):
+        names = list(usernames)
+        rows = []
+        for i in range(0, len(names), 500):  # stay under SQLite's bound-parameter limit
+            chunk = names[i:i + 500]
+            rows += self._run("SELECT * FROM users WHERE username IN (%s)" % ", ".join("?" * len(chunk)),
+                              chunk).fetchall()
+        return [dict(row) for row in rows]
+
+    def insert_users(self, rows):
+        self.conn.executemany("INSERT INTO users (%s) VALUES (%s)" % (", ".join(USER_COLUMNS), ", ".join("?" * len(USER_COLUMNS))),
+                              [_user_values(_float4(dict(row), REAL_FIELDS)) for row in rows])
+
+    def existing_usernames(self, usernames):
+        names = list(usernames)
+        found = set()
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            found.update(row[0] for row in self._run(
+                "SELECT username FROM users WHERE username IN (%s)" % ", ".join("?" * len(chunk)), chunk))
+        return found
+
+    def load_users(self, rows):
+        # the write lock is held from BEGIN IMMEDIATE, so nobody can take a name after this check
+        taken = self.existing_usernames(row["username"] for row in rows)
+        rows = [row for row in rows if row["username"] not in taken]
+        self.conn.executemany("INSERT INTO users (%s) VALUES (%s)" % (", ".join(LOAD_COLUMNS), ", ".join("?" * len(LOAD_COLUMNS))),
+                              [_user_values(_float4(dict(row), REAL_FIELDS), LOAD_COLUMNS) for row in rows])
+        return {row["username"] for row in rows}
+
+    def load_history(self, rows):
+        self.append_history(rows)
+
+    def set_role(self, username, role):
+        self._run("UPDATE users SET role = ? WHERE username = ?", (role, username))
+
+    def lock_user(self, username, locked_until, fraud, last_update):
+        self._run("UPDATE users SET locked_until = ?, status = 'Locked', fraud = ?, last_update = ? WHERE username = ?",
+                  (locked_until, fraud, last_update, username))
+
+    def update_profile(self, username, profile, fraud, status, last_update, baseline=None):
+        profile = _float4(dict(profile), REAL_FIELDS)
+        self._run('''
+            UPDATE users SET flight_mean = ?, dwell_mean = ?, mouse_mean = ?, scroll_mean = ?,
+                             scroll_speed = ?, touch_mean = ?, fraud = ?, status = ?, last_update = ?,
+                             baseline = coalesce(?, baseline)
+            WHERE username = ?
+        ''', tuple(profile[k] for k in PROFILE_FIELDS) + (fraud, status, last_update, baseline, username))
+
+    def update_users(self, rows):
+        self.conn.executemany('''
+            UPDATE users SET flight_mean = ?, dwell_mean = ?, mouse_mean = ?, scroll_mean = ?,
+                             scroll_speed = ?, touch_mean = ?, fraud = ?, status = ?, last_update = ?,
+                             locked_until = ?, baseline = coalesce(?, baseline)
+            WHERE username = ?
+        ''', [tuple(_float4({k: row[k] for k in PROFILE_FIELDS}, REAL_FIELDS)[k] for k in PROFILE_FIELDS) +
+              (row["fraud"], row["status"], row["last_update"], row["locked_until"] or 0, row.get("baseline"),
+               row["username"]) for row in rows])
+
+    def append_history(self, rows):
+        self.conn.executemany(_HISTORY_INSERT, [_history_values(row) for row in rows])
+
+    def admin_users(self, after=None, username=None, limit=1, history_limit=50, since=None, before=None,
+                    changed_since=None):
+        changed = "" if changed_since is None else " AND version >= %d" % changed_since
+        if username is not None:
+            users = self._run("SELECT * FROM users WHERE username = ?" + changed, (username,)).fetchall()
+        else:
+            users = self._run("SELECT * FROM users WHERE username > ?%s ORDER BY username LIMIT ?" % changed,
+                              (after or "", limit)).fetchall()
+        users = [dict(u, history=[]) for u in users]
+        if not users or history_limit <= 0:
+            return users
+        where, params = ["username IN (%s)" % ", ".join("?" * len(users))], [u["username"] for u in users]
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if before is not None:
+            where.append("ts < ?")
+            params.append(before)
+        by_name = {u["username"]: u for u in users}
+        for row in self._run('''
+            SELECT * FROM (
+                SELECT *, row_number() OVER (PARTITION BY username ORDER BY ts DESC) AS rank
+                FROM user_history WHERE %s
+            ) WHERE rank <= ? ORDER BY username, ts DESC
+        ''' % " AND ".join(where), params + [history_limit]):
+            row = _history_dict(row)
+            del row["rank"]
+            by_name[row["username"]]["history"].append(row)
+        return users
+
+    def profiles(self, changed_since=None):
+        return [dict(row) for row in self._run('''
+            SELECT username, flight_mean, dwell_mean, mouse_mean, scroll_mean, scroll_speed, touch_mean,
+                   status, fraud, last_update
+            FROM users
+            WHERE ? IS NULL OR version >= ?
+        ''', (changed_since, changed_since))]
+
+    def counts(self):
+        return dict(self._run("SELECT (SELECT count(*) FROM users) AS users, "
+                              "(SELECT count(*) FROM user_history) AS history_rows").fetchone())
+
+    def delete_users(self, prefix):
+        for table in ("user_history", "users"):
+            self._run("DELETE FROM %s WHERE substr(username, 1, ?) = ?" % table, (len(prefix), prefix))
+
+    def remove_users(self, usernames):
+        usernames = list(usernames)
+        for table in ("user_history", "users"):
+            self._run("DELETE FROM %s WHERE username IN (%s)" % (table, ", ".join("?" * len(usernames))), usernames)
+
+
+class SqliteStore:
+    """Embedded store: the same tables in one SQLite file. Readers never block (WAL); writers
+    queue on the file lock for up to `timeout` seconds, then StoreBusy."""
+    name = "sqlite"
+    parse_version = int
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def init(self):
+        conn = self._connect()
+        conn.executescript(SQLITE_SCHEMA)
+        # files made before users.version (schema version 1) get the column here
+        if "version" not in [row["name"] for row in conn.execute("PRAGMA table_info(users)")]:
+            conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.executescript(SQLITE_VERSION_SCHEMA)
+
+    def transaction(self, readonly=False):
+        return SqliteTransaction(self._connect(), readonly)
+
+
+def storage_from_url(url, connect=None):
+    # "postgres" (needs `connect`, a pooled-connection factory), "sqlite:<path>", or "sharded"
+    # (SHARDS, see sharding.py; app.py builds that one itself, with a pool per Postgres shard)
+    if url == "postgres":
+        return PostgresStore(connect)
+    if url.startswith("sqlite:"):
+        return SqliteStore(url[len("sqlite:"):], timeout=float(os.getenv("SQLITE_TIMEOUT", "5")))
+    if url == "sharded":
+        from sharding import ShardedStore  # which imports this module
+        return ShardedStore.from_env()
+    raise ValueError("unknown STORAGE %r (use postgres, sqlite:<path> or sharded)" % url)
+
+
+if __name__ == "__main__":
+    # the original users.json import; bulk_import.py takes over (more formats, --state, workers)
+    import sys
+    if sys.argv[1:2] != ["import"] or len(sys.argv) != 3:
+        sys.exit("usage: python storage.py import users.json (or see python bulk_import.py --help)")
+    from bulk_import import main
+    main(sys.argv[2:])
@@ -0,0 +1,94 @@
+# stream.py - per-connection telemetry windows for the /verify/stream WebSocket (see asgi.py)
+#
+# Over the stream script.js sends only what was recorded since its previous frame. A
+# StreamSession appends those events to bounded windows the same length as the trailing slices
+# the POST loop sends (500 samples), and payload() turns the windows back into an ordinary raw
+# /verify payload, so a stream is scored exactly like the POSTs it replaces.
+import math
+from collections import deque
+
+STREAM_WINDOW = 500
+
+# arrays kept as sliding windows, and the per-frame lists scored once and then cleared (the
+# same "recorded since the last post" lists summary mode sends)
+WINDOW_FIELDS = ("flight", "dwell", "mouse_path", "touch_path")
+ROUND_FIELDS = ("click_positions", "scroll_speeds")
+PATH_FIELDS = ("mouse_path", "touch_path")
+# session-wide values script.js computes itself; the latest frame's value wins
+SCALAR_FIELDS = ("mouse_speed", "touch_speed", "scrolls", "scroll_speed", "clicks", "fraud_score", "ts")
+
+
+class StreamFormatError(ValueError):
+    """A stream frame is not a JSON object of the fields listed in WINDOW/ROUND/SCALAR_FIELDS."""
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _point(value):
+    return isinstance(value, dict) and all(_number(value.get(k)) for k in ("x", "y", "t"))
+
+
+class StreamSession:
+    """One connection's windows: apply() each frame, then payload() and scored() around each
+    /verify of the session."""
+
+    def __init__(self, window=STREAM_WINDOW):
+        self.username = None
+        self.windows = {k: deque(maxlen=window) for k in WINDOW_FIELDS}
+        self.rounds = {k: deque(maxlen=window) for k in ROUND_FIELDS}
+        self.scalars = {}
+        self.pending = False  # events applied since the last scored()
+        self.verdict = None   # (status, fraud_score, locked_until) last pushed to the client
+
+    def apply(self, frame):
+        """Validate a decoded frame and append its events. A frame that fails validation
+        changes nothing."""
+        if not isinstance(frame, dict):
+            raise StreamFormatError("frame must be a JSON object")
+        username = frame.get("username", self.username or "default_user")
+        if not isinstance(username, str):
+            raise StreamFormatError("username must be a string")
+        if self.username is not None and username != self.username:
+            raise StreamFormatError("username cannot change on an open stream")
+        for key in WINDOW_FIELDS + ROUND_FIELDS:
+            values = frame.get(key, [])
+            if not isinstance(values, list):
+                raise StreamFormatError("%s must be a list" % key)
+            check = _point if key in PATH_FIELDS else (_number if key in ("flight", "dwell") else None)
+            if check and not all(map(check, values)):
+                raise StreamFormatError("%s holds malformed values" % key)
+        for key in SCALAR_FIELDS:
+            if key in frame and not _number(frame[key]):
+                raise StreamFormatError("%s must be a number" % key)
+
+        self.username = username
+        for key, window in self.windows.items():
+            window.extend(frame.get(key, ()))
+        for key, window in self.rounds.items():
+            window.extend(frame.get(key, ()))
+        self.scalars.update((k, frame[k]) for k in SCALAR_FIELDS if k in frame)
+        # the scalars only move when events do, so a frame without events is not worth a score
+        self.pending = self.pending or any(frame.get(k) for k in WINDOW_FIELDS + ROUND_FIELDS)
+
+    def payload(self):
+        """The windows as a raw /verify payload."""
+        d = dict(self.scalars, username=self.username or "default_user")
+        d.update((k, list(w)) for k, w in self.windows.items())
+        d.update((k, list(w)) for k, w in self.rounds.items())
+        return d
+
+    def scored(self):
+        # called once payload() has been scored and saved; a failed attempt keeps the round
+        for window in self.rounds.values():
+            window.clear()
+        self.pending = False
+
+    def changed(self, body):
+        """True when a /verify body carries a different verdict from the last one pushed."""
+        verdict = (body.get("status"), body.get("fraud_score"), body.get("locked_until"))
+        if verdict == self.verdict:
+            return False
+        self.verdict = verdict
+        return True
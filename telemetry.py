@@ -0,0 +1,172 @@
+# telemetry.py - compact binary encoding of /verify payloads
+#
+# A frame is
+#
+#     b"AGT1" | uint32 header length | header (UTF-8 JSON) | array blocks
+#
+# (all little-endian). The header holds the payload's scalar fields plus
+# "arrays": [[name, encoding, count], ...] describing the blocks that follow, in order.
+# Point lists such as mouse_path are sent as one block per column, named "mouse_path.x",
+# "mouse_path.y" and "mouse_path.t". Encodings:
+#
+#     "d1" / "d2" / "d4"  integers: int64 first value, then count-1 int8/int16/int32 deltas
+#     "f64"               anything else: count raw float64 values
+#
+# Both are lossless, so a decoded frame scores exactly like the JSON it replaces. Numeric
+# arrays and path columns decode straight into NumPy arrays; click_positions and scroll_speeds,
+# which are stored verbatim in user_history, come back as plain lists.
+import base64
+import json
+import math
+import struct
+
+TELEMETRY_CONTENT_TYPE = "application/vnd.authguard.telemetry"
+MAGIC = b"AGT1"
+POINT_FIELDS = ("x", "y", "t")
+# decoded to Python lists because they are stored as JSON rather than computed on
+LIST_FIELDS = ("click_positions", "scroll_speeds")
+
+# dtype strings rather than np.dtype objects: NumPy is imported by the functions that decode or
+# encode a frame, so app.py can import this module without loading it
+_DELTA_TYPES = {"d1": "<i1", "d2": "<i2", "d4": "<i4"}
+_F64 = "<f8"
+_INT64 = "<i8"
+_HEAD = struct.Struct("<4sI")
+
+
+class TelemetryFormatError(ValueError):
+    """The body is not a well-formed telemetry frame."""
+
+
+def _read_block(buf, offset, enc, count):
+    import numpy as np
+    if enc == "f64":
+        end = offset + count * 8
+        if end > len(buf):
+            raise TelemetryFormatError("frame truncated")
+        values = np.frombuffer(buf, dtype=_F64, count=count, offset=offset)
+        if not np.isfinite(values).all():
+            raise TelemetryFormatError("non-finite float in frame")
+        return values, end
+    dtype = _DELTA_TYPES.get(enc)
+    if dtype is None:
+        raise TelemetryFormatError("unknown encoding %r" % (enc,))
+    if count == 0:
+        return np.zeros(0, dtype=_INT64), offset
+    end = offset + 8 + (count - 1) * np.dtype(dtype).itemsize
+    if end > len(buf):
+        raise TelemetryFormatError("frame truncated")
+    values = np.empty(count, dtype=_INT64)
+    values[0] = np.frombuffer(buf, dtype=_INT64, count=1, offset=offset)[0]
+    values[1:] = np.frombuffer(buf, dtype=dtype, count=count - 1, offset=offset + 8)
+    return np.cumsum(values, out=values), end
+
+
+def decode_telemetry(buf):
+    """Decode a frame into a /verify payload dict."""
+    import numpy as np
+    buf = bytes(buf)
+    if len(buf) < _HEAD.size:
+        raise TelemetryFormatError("frame truncated")
+    magic, header_len = _HEAD.unpack_from(buf)
+    if magic != MAGIC:
+        raise TelemetryFormatError("bad magic %r" % (magic,))
+    offset = _HEAD.size + header_len
+    if offset > len(buf):
+        raise TelemetryFormatError("frame truncated")
+    try:
+        payload = json.loads(buf[_HEAD.size:offset].decode("utf-8"))
+        specs = payload.pop("arrays", [])
+        specs = [(str(name), str(enc), int(count)) for name, enc, count in specs]
+    except (ValueError, TypeError, AttributeError) as err:
+        raise TelemetryFormatError("bad header: %s" % err)
+    if not isinstance(payload, dict):
+        raise TelemetryFormatError("header must be a JSON object")
+
+    for name, enc, count in specs:
+        if count < 0:
+            raise TelemetryFormatError("negative count for %s" % name)
+        values, offset = _read_block(buf, offset, enc, count)
+        field, _, column = name.partition(".")
+        if column:
+            columns = payload.setdefault(field, {})
+            if not isinstance(columns, dict):
+                raise TelemetryFormatError("%s is both a header field and an array" % field)
+            columns[column] = values
+        else:
+            payload[field] = values
+    if offset != len(buf):
+        raise TelemetryFormatError("%d trailing bytes" % (len(buf) - offset))
+
+    for field in LIST_FIELDS:
+        value = payload.get(field)
+        if isinstance(value, dict):
+            columns = [value.get(k) for k in POINT_FIELDS]
+            if any(c is None for c in columns) or len({len(c) for c in columns}) != 1:
+                raise TelemetryFormatError("%s needs equal-length x, y and t columns" % field)
+            payload[field] = [{"x": x, "y": y, "t": t} for x, y, t in zip(*(c.tolist() for c in columns))]
+        elif isinstance(value, np.ndarray):
+            payload[field] = value.tolist()
+    return payload
+
+
+def unpack_fields(payload):
+    """Merge a base64 frame sent as the "packed" field of a JSON payload (for clients that
+    cannot send a binary body). Fields in the frame win over the JSON ones."""
+    packed = payload.get("packed") if isinstance(payload, dict) else None
+    if packed is None:
+        return payload
+    try:
+        raw = base64.b64decode(packed, validate=True)
+    except (TypeError, ValueError) as err:
+        raise TelemetryFormatError("packed is not base64: %s" % err)
+    merged = {k: v for k, v in payload.items() if k != "packed"}
+    merged.update(decode_telemetry(raw))
+    return merged
+
+
+def _is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def _encode_block(values):
+    import numpy as np
+    if values and all(_is_int(v) for v in values) and -2**63 <= min(values) and max(values) < 2**63:
+        deltas = np.diff(np.asarray(values, dtype=_INT64))
+        for enc, dtype in _DELTA_TYPES.items():
+            info = np.iinfo(dtype)
+            if not deltas.size or (deltas.min() >= info.min and deltas.max() <= info.max):
+                return enc, struct.pack("<q", values[0]) + deltas.astype(dtype).tobytes()
+    return "f64", np.asarray(values, dtype=_F64).tobytes()
+
+
+def _is_numbers(value):
+    return isinstance(value, list) and all(
+        _is_int(v) or (isinstance(v, float) and math.isfinite(v)) for v in value)
+
+
+def _is_points(value):
+    return (isinstance(value, list) and value and
+            all(isinstance(p, dict) and p.keys() == set(POINT_FIELDS) and _is_numbers(list(p.values()))
+                for p in value))
+
+
+def encode_telemetry(payload):
+    """Encode a /verify payload dict as a frame. Lists of numbers and lists of {x, y, t}
+    points become array blocks; everything else stays in the JSON header."""
+    header, specs, blocks = {}, [], []
+    for name, value in payload.items():
+        if _is_points(value):
+            columns = [(name + "." + k, [p[k] for p in value]) for k in POINT_FIELDS]
+        elif _is_numbers(value):
+            columns = [(name, value)]
+        else:
+            header[name] = value
+            continue
+        for column, values in columns:
+            enc, data = _encode_block(values)
+            specs.append([column, enc, len(values)])
+            blocks.append(data)
+    header["arrays"] = specs
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return _HEAD.pack(MAGIC, len(head)) + head + b"".join(blocks)
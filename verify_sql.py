@@ -0,0 +1,181 @@
+# verify_sql.py - server-side /verify: lock check, profile read, history append and EMA update
+# in a single round trip.
+#
+# authguard_verify() mirrors the Python scoring in scoring.py operation for operation (same
+# double-precision arithmetic, same literals, same half-even rounding), so fraud_score and the
+# lock decision come out identical. authguard_pyround() reproduces Python's round(x, n) - exact
+# binary value, ties to even - because Postgres' numeric round() rounds ties away from zero.
+# REAL columns are read through ::text to see the same value psycopg2 hands to Python.
+import json
+
+VERIFY_FUNCTIONS_SQL = '''
+CREATE OR REPLACE FUNCTION authguard_pyround(x DOUBLE PRECISION, nd INTEGER)
+RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    bits BIGINT;
+    e INTEGER;
+    n NUMERIC;
+    unit NUMERIC;
+    q NUMERIC;
+    r NUMERIC;
+BEGIN
+    IF x IS NULL OR x = 0 OR x = 'NaN'::float8 OR abs(x) = 'Infinity'::float8 THEN
+        RETURN x;
+    END IF;
+    bits := ('x' || encode(float8send(abs(x)), 'hex'))::bit(64)::bigint;
+    e := ((bits >> 52) & 2047)::integer;
+    n := (bits & 4503599627370495)::numeric;
+    IF e = 0 THEN
+        e := -1074;
+    ELSE
+        n := n + 4503599627370496;
+        e := e - 1075;
+    END IF;
+    -- abs(x) = n * 2^e exactly; with e < 0 that is (n * 5^-e) / 10^-e
+    IF e >= 0 OR -e <= nd THEN
+        RETURN x;
+    END IF;
+    FOR i IN 1..-e LOOP
+        n := n * 5;
+    END LOOP;
+    unit := ('1' || repeat('0', -e - nd))::numeric;
+    q := div(n, unit);
+    r := n - q * unit;
+    IF 2 * r > unit OR (2 * r = unit AND mod(q, 2) = 1) THEN
+        q := q + 1;
+    END IF;
+    RETURN sign(x) * (q::text || 'e-' || nd::text)::float8;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION authguard_perc_dev(a DOUBLE PRECISION, b DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT CASE
+        WHEN b = 0 THEN CASE WHEN a = 0 THEN 0::float8 ELSE 100::float8 END
+        ELSE abs((a - b) / b) * 100::float8
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION authguard_verify(
+    p_username TEXT, p_ts BIGINT, p_now BIGINT, p_password_hash TEXT,
+    p_flight DOUBLE PRECISION, p_dwell DOUBLE PRECISION, p_mouse DOUBLE PRECISION,
+    p_scrolls INTEGER, p_scroll_speed DOUBLE PRECISION, p_touch DOUBLE PRECISION,
+    p_mouse_penalty DOUBLE PRECISION, p_touch_penalty DOUBLE PRECISION, p_incoming INTEGER,
+    p_mouse_metrics JSONB, p_touch_metrics JSONB, p_click_positions JSONB,
+    p_scroll_speeds JSONB, p_clicks INTEGER,
+    OUT o_status TEXT, OUT o_fraud INTEGER, OUT o_locked_until BIGINT
+) AS $$
+DECLARE
+    u users%ROWTYPE;
+    alpha CONSTANT DOUBLE PRECISION := 0.02::float8;
+    fm DOUBLE PRECISION;
+    dm DOUBLE PRECISION;
+    mm DOUBLE PRECISION;
+    sm INTEGER;
+    ssm DOUBLE PRECISION;
+    tm DOUBLE PRECISION;
+    score DOUBLE PRECISION := 0;
+BEGIN
+    SELECT * INTO u FROM users WHERE username = p_username FOR UPDATE;
+
+    IF FOUND AND u.locked_until IS NOT NULL AND u.locked_until > p_now THEN
+        o_status := 'Locked';
+        o_fraud := u.fraud;
+        o_locked_until := u.locked_until;
+        RETURN;
+    END IF;
+
+    IF NOT FOUND THEN
+        fm := authguard_pyround(p_flight, 2);
+        dm := authguard_pyround(p_dwell, 2);
+        mm := authguard_pyround(p_mouse, 2);
+        sm := p_scrolls;
+        ssm := authguard_pyround(p_scroll_speed, 2);
+        tm := authguard_pyround(p_touch, 2);
+        INSERT INTO users (username, password_hash, role, flight_mean, dwell_mean, mouse_mean,
+                           scroll_mean, scroll_speed, touch_mean, status, last_update)
+        VALUES (p_username, p_password_hash, 'customer', fm, dm, mm, sm, ssm, tm, 'Profiled', p_ts);
+    ELSE
+        fm := COALESCE(NULLIF(u.flight_mean::text::float8, 0), NULLIF(p_flight, 0), 1::float8);
+        dm := COALESCE(NULLIF(u.dwell_mean::text::float8, 0), NULLIF(p_dwell, 0), 1::float8);
+        mm := COALESCE(NULLIF(u.mouse_mean::text::float8, 0), NULLIF(p_mouse, 0), 1::float8);
+        sm := COALESCE(NULLIF(u.scroll_mean, 0), NULLIF(p_scrolls, 0), 0);
+        ssm := COALESCE(NULLIF(u.scroll_speed::text::float8, 0), NULLIF(p_scroll_speed, 0), 0::float8);
+        tm := COALESCE(NULLIF(u.touch_mean::text::float8, 0), NULLIF(p_touch, 0), 0::float8);
+    END IF;
+
+    score := score + least(authguard_perc_dev(p_flight, fm) * 0.25::float8, 40::float8);
+    score := score + least(authguard_perc_dev(p_dwell, dm) * 0.2::float8, 30::float8);
+    score := score + least(authguard_perc_dev(p_mouse, mm) * 0.15::float8, 20::float8);
+    score := score + least(authguard_perc_dev(p_scrolls, sm) * 0.1::float8, 10::float8);
+    score := score + least(authguard_perc_dev(p_scroll_speed, ssm) * 0.1::float8, 10::float8);
+    score := score + least(authguard_perc_dev(p_touch, tm) * 0.08::float8, 8::float8);
+    score := score + p_mouse_penalty;
+    score := score + p_touch_penalty;
+    score := score * 0.7::float8 + p_incoming * 0.3::float8;
+    o_fraud := round(least(score, 100::float8))::integer;
+
+    IF o_fraud > 60 THEN
+        o_status := 'Locked';
+        o_locked_until := p_now + 60 * 1000;
+        UPDATE users SET locked_until = o_locked_until, status = o_status, fraud = o_fraud, last_update = p_ts
+        WHERE username = p_username;
+    ELSE
+        o_status := CASE WHEN o_fraud < 40 THEN 'Authenticated'
+                         WHEN o_fraud < 70 THEN 'Suspicious'
+                         ELSE 'Fraud Detected' END;
+        UPDATE users SET
+            flight_mean = authguard_pyround((1 - alpha) * fm + alpha * p_flight, 2),
+            dwell_mean = authguard_pyround((1 - alpha) * dm + alpha * p_dwell, 2),
+            mouse_mean = authguard_pyround((1 - alpha) * mm + alpha * p_mouse, 2),
+            scroll_mean = round((1 - alpha) * sm + alpha * p_scrolls)::integer,
+            scroll_speed = authguard_pyround((1 - alpha) * ssm + alpha * p_scroll_speed, 2),
+            touch_mean = authguard_pyround((1 - alpha) * tm + alpha * p_touch, 2),
+            fraud = o_fraud, status = o_status, last_update = p_ts
+        WHERE username = p_username;
+    END IF;
+
+    INSERT INTO user_history (username, ts, flight, dwell, mouse_speed, mouse_metrics,
+                              touch_speed, touch_metrics, click_positions, scrolls, scroll_speed,
+                              scroll_speeds, clicks, fraud, status)
+    VALUES (p_username, p_ts, authguard_pyround(p_flight, 2), authguard_pyround(p_dwell, 2),
+            authguard_pyround(p_mouse, 2), p_mouse_metrics, authguard_pyround(p_touch, 2),
+            p_touch_metrics, p_click_positions, p_scrolls, authguard_pyround(p_scroll_speed, 2),
+            p_scroll_speeds, p_clicks, o_fraud, o_status);
+END;
+$$ LANGUAGE plpgsql;
+'''
+
+
+SINGLE_TRIP_SQL = '''
+    SELECT o_status, o_fraud, o_locked_until
+    FROM authguard_verify(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+
+def single_trip_params(username, ts, now_ms, password_hash, feat):
+    """Arguments of authguard_verify() for one request; `feat` is scoring.parse_payload() output."""
+    mouse_metrics, touch_metrics = feat["mouse_metrics"], feat["touch_metrics"]
+    mouse_penalty = 5.0 if mouse_metrics and mouse_metrics.get("angular_entropy", 0) < 1.0 else 0.0
+    touch_penalty = 3.0 if touch_metrics and touch_metrics.get("angular_entropy", 0) < 1.0 else 0.0
+    return (
+        username, ts, now_ms, password_hash,
+        feat["flight"], feat["dwell"], feat["mouse_speed"], feat["scrolls"], feat["scroll_speed"],
+        feat["touch_speed"], mouse_penalty, touch_penalty, feat["incoming_score"],
+        json.dumps(mouse_metrics), json.dumps(touch_metrics), json.dumps(feat["click_positions"]),
+        json.dumps(feat["scroll_speeds"]), feat["clicks"]
+    )
+
+
+def single_trip_body(row):
+    """The JSON body verify() sends for an authguard_verify() result row."""
+    if row["o_status"] == "Locked":
+        return {"status": "Locked", "fraud_score": row["o_fraud"], "locked_until": row["o_locked_until"]}
+    return {"status": row["o_status"], "fraud_score": row["o_fraud"], "confidence": max(0, 100 - row["o_fraud"])}
+
+
+def verify_single_trip(cursor, username, ts, now_ms, password_hash, feat):
+    """Run the whole /verify transaction server-side; returns the JSON body verify() sends.
+    `feat` is scoring.parse_payload() output."""
+    cursor.execute(SINGLE_TRIP_SQL, single_trip_params(username, ts, now_ms, password_hash, feat))
+    return single_trip_body(cursor.fetchone())
@@ -0,0 +1,189 @@
+# workers.py - process-pool lanes for CPU-bound request work (password hashing, path metrics)
+import os, threading, logging, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic, perf_counter
+
+log = logging.getLogger(__name__)
+
+
+class WorkerBusy(Exception):
+    """Raised when a lane already has `max_queue` tasks waiting for a worker."""
+
+
+class WorkerTimeout(WorkerBusy):
+    """Raised when a task does not finish within the lane's timeout."""
+
+
+def _timed(fn, args):
+    # runs in the worker; the elapsed time feeds the lane's utilization figure
+    start = perf_counter()
+    result = fn(*args)
+    return perf_counter() - start, result
+
+
+class WorkerLane:
+    """A ProcessPoolExecutor with a bounded backlog.
+
+    Each lane has its own processes, so work queued on one (a burst of logins hashing
+    passwords) never waits behind, or delays, work on another (/verify). At most
+    `processes + max_queue` tasks are in flight; submitting beyond that raises WorkerBusy
+    instead of queueing without bound. Waiting longer than `timeout` raises WorkerTimeout;
+    the task itself cannot be interrupted and keeps its slot until it finishes.
+
+    With `processes=0` the lane is disabled and run() calls the function inline.
+    """
+
+    def __init__(self, name, processes=0, max_queue=32, timeout=5.0):
+        if processes < 0 or max_queue < 0:
+            raise ValueError("invalid lane size: processes=%s max_queue=%s" % (processes, max_queue))
+        self.name = name
+        self.processes = processes
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = 0
+        self._started = monotonic()
+        self._counters = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "timeouts": 0,
+            "restarts": 0,
+            "inline": 0,
+            "busy_seconds": 0.0,
+            "peak_queue": 0,
+        }
+
+    @classmethod
+    def from_env(cls, name, processes_var):
+        return cls(
+            name,
+            processes=int(os.getenv(processes_var, "0")),
+            max_queue=int(os.getenv("WORKER_QUEUE_DEPTH", "32")),
+            timeout=float(os.getenv("WORKER_TIMEOUT", "5")),
+        )
+
+    @property
+    def enabled(self):
+        return self.processes > 0
+
+    def start(self):
+        """Start the worker processes now rather than on the first request.
+
+        Call this before opening database connections or starting threads: workers are forked
+        (where the platform allows) so they do not re-import the app, and a fork is only safe
+        while the parent is still single-threaded.
+        """
+        if not self.enabled:
+            return self
+        self._executor = self._new_executor()
+        # the fork context launches every process on the first submit
+        self._executor.submit(abs, 0).result()
+        self._started = monotonic()
+        return self
+
+    def _new_executor(self):
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) on a worker and return its concurrent.futures.Future."""
+        with self._lock:
+            if self._in_flight >= self.processes + self.max_queue:
+                self._counters["rejected"] += 1
+                raise WorkerBusy("%s lane is full" % self.name)
+            self._in_flight += 1
+            self._counters["submitted"] += 1
+            self._counters["peak_queue"] = max(self._counters["peak_queue"], self._in_flight - self.processes)
+            executor = self._executor
+        try:
+            future = executor.submit(_timed, fn, args)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed by the OOM killer); replace the pool and retry once
+            log.warning("%s worker pool broke, restarting it", self.name)
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+                    self._counters["restarts"] += 1
+                executor = self._executor
+            try:
+                future = executor.submit(_timed, fn, args)
+            except BaseException:
+                self._release(None)
+                raise
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            if future is None or future.cancelled():
+                return
+            if future.exception() is not None:
+                self._counters["failed"] += 1
+            else:
+                self._counters["completed"] += 1
+                self._counters["busy_seconds"] += future.result()[0]
+
+    def result(self, future):
+        """The return value of a future from submit(), waiting at most `timeout` seconds."""
+        try:
+            return future.result(timeout=self.timeout)[1]
+        except FutureTimeout:
+            future.cancel()
+            with self._lock:
+                self._counters["timeouts"] += 1
+            raise WorkerTimeout("%s lane did not answer within %.1fs" % (self.name, self.timeout))
+
+    def run(self, fn, *args):
+        if not self.enabled:
+            with self._lock:
+                self._counters["inline"] += 1
+            return fn(*args)
+        return self.result(self.submit(fn, *args))
+
+    async def run_async(self, fn, *args):
+        """run() for the event loop. A disabled lane runs fn in a thread instead."""
+        import asyncio  # only asgi.py calls this; the Flask app never needs the import
+        if not self.enabled:
+            with self._lock:
+                self._counters["inline"] += 1
+            return await asyncio.to_thread(fn, *args)
+        future = self.submit(fn, *args)
+        try:
+            return (await asyncio.wait_for(asyncio.wrap_future(future), self.timeout))[1]
+        except asyncio.TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._counters["timeouts"] += 1
+            raise WorkerTimeout("%s lane did not answer within %.1fs" % (self.name, self.timeout))
+
+    def shutdown(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            in_flight = self._in_flight
+        elapsed = monotonic() - self._started
+        stats.update({
+            "processes": self.processes,
+            "max_queue": self.max_queue,
+            "in_flight": in_flight,
+            "queue_depth": max(0, in_flight - self.processes),
+            # share of the workers' wall time spent running tasks since start()
+            "utilization": round(stats["busy_seconds"] / (self.processes * elapsed), 4)
+                           if self.enabled and elapsed > 0 else 0.0,
+            "busy_seconds": round(stats["busy_seconds"], 3),
+        })
+        return stats